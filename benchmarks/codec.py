@@ -0,0 +1,352 @@
+"""
+Encode, decode and header peek micro-benchmarks for every version 01 message
+type. The protocol version exchange at the start of a connection isn't
+framed like the others, and isn't covered.
+
+Runs offline, with nothing but the standard library. Results are printed as
+a table and can be saved as JSON, to compare against a later run::
+
+    python -m benchmarks.codec --output before.json
+    # ...change things...
+    python -m benchmarks.codec --compare before.json
+
+Every benchmark is timed over several repeats of enough iterations to run
+for ``--min-time`` seconds, and the fastest repeat is reported, since the
+slower ones only measure interference. Peak allocation is how much memory
+a single call needs on top of what it started with.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import gotalk
+from gotalk.protocol.framing import FrameDecoder
+from gotalk.protocol.messages import peek_header, read_message, \
+    read_messages, write_messages
+from gotalk.protocol.version01.messages import ErrorResultMessage, \
+    HeartbeatMessage, NotificationMessage, ProtocolErrorMessage, \
+    RetryResultMessage, SingleRequestMessage, SingleResultMessage, \
+    StreamRequestMessage, StreamRequestPartMessage, StreamResultMessage
+
+PROTO_VERSION = "01"
+DEFAULT_SIZES = [0, 64, 1024, 64 * 1024, 1024 * 1024, 64 * 1024 * 1024]
+# Bytes per read when feeding a FrameDecoder, like a socket would.
+READ_SIZE = 64 * 1024
+# Multi-frame buffers are kept to about this size, so that the biggest
+# payloads don't need gigabytes of memory.
+MAX_BUFFER_SIZE = 256 * 1024 * 1024
+
+
+def _payload_messages(payload):
+    """
+    :param bytes payload: The payload to give every message.
+    :returns: ``(name, message)`` for every message type with a payload.
+    """
+
+    return [
+        ("SingleRequest", SingleRequestMessage(b"0001", "echo", payload)),
+        ("SingleResult", SingleResultMessage(b"0001", payload)),
+        ("StreamRequest", StreamRequestMessage(b"0001", "echo", payload)),
+        ("StreamRequestPart", StreamRequestPartMessage(b"0001", payload)),
+        ("StreamResult", StreamResultMessage(b"0001", payload)),
+        ("ErrorResult", ErrorResultMessage(b"0001", payload)),
+        ("RetryResult", RetryResultMessage(b"0001", 500, payload)),
+        ("Notification", NotificationMessage("chat message", payload)),
+    ]
+
+
+def _fixed_messages():
+    """
+    :returns: ``(name, message)`` for every message type without a payload,
+        bar the protocol version exchange.
+    """
+
+    return [
+        ("ProtocolError", ProtocolErrorMessage(2)),
+        ("Heartbeat", HeartbeatMessage(3, 1423433370)),
+    ]
+
+
+def _mixed_buffer(size):
+    """
+    A buffer of up to 100 frames of mixed types, as a busy connection would
+    see, or ``None`` if one of each won't fit in ``MAX_BUFFER_SIZE``.
+    """
+
+    payload = b"#" * size
+    messages = [message for _, message in _payload_messages(payload)]
+    messages += [message for _, message in _fixed_messages()]
+    count = min(100, MAX_BUFFER_SIZE // max(size, 1))
+    if count < len(messages):
+        return None
+    frames = [m.to_bytes() for m in messages]
+    return b"".join(frames[i % len(frames)] for i in range(count)), count
+
+
+def _stream_sequence(size):
+    """
+    One stream request and its result stream: the request, its parts, the
+    result parts and the empty parts that end both. Up to 16 parts each
+    way, fewer for big payloads.
+    """
+
+    parts = max(1, min(16, MAX_BUFFER_SIZE // max(size, 1) // 2 - 1))
+    payload = b"#" * size
+    messages = [StreamRequestMessage(b"0001", "upload", payload)]
+    messages += [StreamRequestPartMessage(b"0001", payload)] * parts
+    messages.append(StreamRequestPartMessage(b"0001", b""))
+    messages += [StreamResultMessage(b"0001", payload)] * parts
+    messages.append(StreamResultMessage(b"0001", b""))
+    return messages
+
+
+def _chunked(m_bytes):
+    view = memoryview(m_bytes)
+    return [bytes(view[i:i + READ_SIZE])
+            for i in range(0, len(view), READ_SIZE)]
+
+
+def _feed_all(chunks):
+    decoder = FrameDecoder(PROTO_VERSION)
+    count = 0
+    for chunk in chunks:
+        count += len(decoder.feed(chunk))
+    return count
+
+
+def get_benchmarks(sizes):
+    """
+    Generates the benchmarks one at a time, so that only one benchmark's
+    buffers need to be in memory at once.
+
+    :param list sizes: Payload sizes, in bytes.
+    :returns: An iterator of ``(name, payload_size, bytes_per_call,
+        messages_per_call, function)`` tuples, where ``function`` takes no
+        arguments.
+    """
+
+    for size in sizes:
+        payload = b"#" * size
+        for name, message in _payload_messages(payload):
+            nbytes = sum(len(buf) for buf in message.to_buffers())
+            yield ("encode/" + name, size, nbytes, 1, message.to_bytes)
+            yield ("encode_buffers/" + name, size, nbytes, 1,
+                   message.to_buffers)
+            m_bytes = message.to_bytes()
+            yield ("decode/" + name, size, nbytes, 1,
+                   _bind(read_message, m_bytes, PROTO_VERSION))
+            yield ("peek/" + name, size, nbytes, 1,
+                   _bind(peek_header, m_bytes, PROTO_VERSION))
+            del m_bytes
+        del payload, message
+
+        mixed = _mixed_buffer(size)
+        if mixed is not None:
+            m_bytes, count = mixed
+            del mixed
+            yield ("decode_mixed", size, len(m_bytes), count,
+                   _bind(read_messages, m_bytes, PROTO_VERSION))
+            del m_bytes
+
+        messages = _stream_sequence(size)
+        nbytes = sum(len(buf) for m in messages for buf in m.to_buffers())
+        yield ("encode_stream", size, nbytes, len(messages),
+               _bind(write_messages, messages))
+        chunks = _chunked(b"".join(m.to_bytes() for m in messages))
+        yield ("decode_stream", size, nbytes, len(messages),
+               _bind(_feed_all, chunks))
+        del messages, chunks
+
+    for name, message in _fixed_messages():
+        m_bytes = message.to_bytes()
+        yield ("encode/" + name, 0, len(m_bytes), 1, message.to_bytes)
+        yield ("decode/" + name, 0, len(m_bytes), 1,
+               _bind(read_message, m_bytes, PROTO_VERSION))
+
+
+def _bind(function, *args):
+    return lambda: function(*args)
+
+
+def time_function(function, min_time=0.2, repeat=5):
+    """
+    :param callable function: What to time.
+    :param float min_time: Roughly how long each repeat should take.
+    :param int repeat: How many repeats to take the best of.
+    :rtype: float
+    :returns: Seconds per call.
+    """
+
+    # Find an iteration count that takes long enough to measure.
+    iterations = 1
+    while True:
+        elapsed = _time_iterations(function, iterations)
+        if elapsed >= min_time / 10 or iterations >= 1 << 24:
+            break
+        iterations *= 10
+    iterations = max(1, int(iterations * min_time / max(elapsed, 1e-9)))
+    best = min(
+        _time_iterations(function, iterations) for _ in range(repeat))
+    return best / iterations
+
+
+def _time_iterations(function, iterations):
+    loop = range(iterations)
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in loop:
+            function()
+        return time.perf_counter() - start
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def measure_peak_allocation(function):
+    """
+    :param callable function: What to measure.
+    :rtype: int
+    :returns: The most memory, in bytes, that one call had allocated at
+        once, on top of what was allocated before it.
+    """
+
+    # Warm up caches first, so they aren't counted.
+    function()
+    tracemalloc.start()
+    try:
+        # Tracing has only just started, so the peak covers nothing else.
+        # (tracemalloc.reset_peak() would need Python 3.9.)
+        before = tracemalloc.get_traced_memory()[0]
+        function()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes=DEFAULT_SIZES, min_time=0.2, repeat=5, pattern=None,
+        report=None):
+    """
+    Runs every benchmark.
+
+    :param list sizes: Payload sizes, in bytes.
+    :param float min_time: Roughly how long each repeat should take.
+    :param int repeat: How many repeats to take the best of.
+    :param str pattern: Only run benchmarks whose name contains this.
+    :param callable report: Called with each result as it comes in.
+    :rtype: dict
+    :returns: The results, along with details of the environment.
+    """
+
+    results = []
+    benchmarks = get_benchmarks(sizes)
+    for name, size, nbytes, count, function in benchmarks:
+        if pattern and pattern not in name:
+            continue
+        seconds = time_function(function, min_time, repeat)
+        result = {
+            "name": name,
+            "payload_size": size,
+            "bytes": nbytes,
+            "messages": count,
+            "ns_per_call": seconds * 1e9,
+            "messages_per_sec": count / seconds,
+            "mb_per_sec": nbytes / seconds / 1e6,
+            "peak_alloc_bytes": measure_peak_allocation(function),
+        }
+        results.append(result)
+        if report is not None:
+            report(result)
+        del function
+    return {
+        "gotalk_version": gotalk.__version__,
+        "python": sys.version,
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "min_time": min_time,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(baseline, current):
+    """
+    :param dict baseline: The output of an earlier :py:func:`run`.
+    :param dict current: The output of a later one.
+    :returns: ``(name, payload_size, ratio)`` for every benchmark in both,
+        where ``ratio`` is how many times slower the current run is.
+    """
+
+    before = dict(
+        ((r["name"], r["payload_size"]), r["ns_per_call"])
+        for r in baseline["results"])
+    ratios = []
+    for result in current["results"]:
+        key = (result["name"], result["payload_size"])
+        if key in before:
+            ratios.append(key + (result["ns_per_call"] / before[key],))
+    return ratios
+
+
+def _print_result(result):
+    print("{name:<32} {size:>10} {ns:>14.0f} {msgs:>14.0f} {mbs:>11.1f} "
+          "{alloc:>12}".format(
+              name=result["name"], size=result["payload_size"],
+              ns=result["ns_per_call"], msgs=result["messages_per_sec"],
+              mbs=result["mb_per_sec"], alloc=result["peak_alloc_bytes"]))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", type=lambda s: [int(size) for size in s.split(",")],
+        default=DEFAULT_SIZES,
+        help="Comma-separated payload sizes in bytes.")
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--filter", help="Only run benchmarks whose name contains this.")
+    parser.add_argument("--output", help="Save the results as JSON here.")
+    parser.add_argument(
+        "--compare", help="Compare against results saved with --output.")
+    parser.add_argument(
+        "--threshold", type=float, default=1.1,
+        help="With --compare, exit with status 1 if anything got this many "
+             "times slower.")
+    args = parser.parse_args(argv)
+
+    print("{:<32} {:>10} {:>14} {:>14} {:>11} {:>12}".format(
+        "benchmark", "payload", "ns/call", "messages/s", "MB/s",
+        "peak alloc"))
+    results = run(args.sizes, args.min_time, args.repeat, args.filter,
+                  report=_print_result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressed = False
+        print()
+        for name, size, ratio in compare(baseline, results):
+            flag = ""
+            if ratio > args.threshold:
+                flag = "  SLOWER"
+                regressed = True
+            print("{name:<32} {size:>10} {ratio:>8.2f}x{flag}".format(
+                name=name, size=size, ratio=ratio, flag=flag))
+        if regressed:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,438 @@
+"""
+End-to-end load generator, for sizing how much gotalk traffic a server can
+take.
+
+Opens ``--connections`` connections to an echo server, run in this process
+unless ``--connect`` points at one elsewhere, and drives a mix of single
+requests, stream requests and notifications at it, in one of two modes:
+
+* Open loop (``--rate``): operations start on a fixed schedule, whether or
+  not earlier ones have finished, like independent clients would.
+* Closed loop (``--concurrency``): a fixed number of operations are kept in
+  flight, each one starting as soon as the last one finished.
+
+Usage::
+
+    python -m benchmarks.loadgen --rate 20000 --duration 10
+    python -m benchmarks.loadgen --concurrency 64 \\
+        --mix request=8,stream=1,notify=1
+    # Or with the server in a process of its own:
+    python -m benchmarks.loadgen --serve --port 9000
+    python -m benchmarks.loadgen --connect 127.0.0.1:9000 --rate 5000
+
+Latencies are measured from when an operation was meant to start, not from
+when it actually did, so that a stall in the server, or in the generator,
+shows up in the percentiles instead of just quietly lowering the request
+rate (coordinated omission). In open loop mode that's the schedule. Closed
+loop mode has no schedule, so each slow operation is also recorded as the
+samples the stall would have hidden, one per interval measured during the
+warmup, the way HdrHistogram does it.
+
+Notification latency is timed until the server's handler sees it, which
+only works with the server in this process. Against a server elsewhere, it
+only covers getting the notification onto the wire.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import struct
+import sys
+
+from gotalk.client import connect
+from gotalk.handlers import Handlers
+from gotalk.metrics import LatencyHistogram
+from gotalk.server import start_server
+
+OPERATION_KINDS = ("request", "stream", "notify")
+# Notifications carry the loop time they were scheduled for, so that the
+# server side can time them.
+_STAMP = struct.Struct("!d")
+
+
+def echo_handlers(on_notification=None):
+    """
+    :param callable on_notification: Called with the payload of every
+        ``echo`` notification.
+    :rtype: Handlers
+    :returns: Handlers that send back whatever they're sent, as an
+        ``echo`` request and an ``echo`` stream.
+    """
+
+    handlers = Handlers()
+
+    @handlers.request("echo")
+    def echo(payload):
+        return payload
+
+    @handlers.stream("echo")
+    async def echo_stream(stream):
+        async for part in stream:
+            yield part
+
+    @handlers.notification("echo")
+    def echo_notification(payload):
+        if on_notification is not None:
+            on_notification(payload)
+
+    return handlers
+
+
+async def start_echo_server(host="127.0.0.1", port=0, on_notification=None):
+    """
+    :param str host: The interface to listen on.
+    :param int port: The port to listen on, or 0 for any free one.
+    :param callable on_notification: See :py:func:`echo_handlers`.
+    :rtype: asyncio.AbstractServer
+    """
+
+    return await start_server(
+        echo_handlers(on_notification), host, port)
+
+
+class LoadGenerator(object):
+    """
+    Drives echo traffic over a set of connections and records how long each
+    operation took.
+
+    Operations take turns over the connections, and over the kinds of
+    operation in proportion to ``mix``. Only operations scheduled after the
+    warmup are counted.
+    """
+
+    def __init__(self, connections, mix=None, payload_size=64,
+                 stream_parts=4, local_server=False):
+        """
+        :param list connections: Connections to an echo server.
+        :param dict mix: Relative weights of ``request``, ``stream`` and
+            ``notify`` operations. Defaults to requests only.
+        :param int payload_size: Bytes per request, part or notification.
+        :param int stream_parts: Request parts per stream request, counting
+            the one sent with the request itself.
+        :param bool local_server: Whether the server runs in this process,
+            and passes ``echo`` notifications to
+            :py:meth:`notification_received`.
+        """
+
+        mix = mix or {"request": 1}
+        for kind in mix:
+            if kind not in OPERATION_KINDS:
+                raise ValueError("Unknown operation kind: {}".format(kind))
+        self.connections = connections
+        self.payload = b"#" * payload_size
+        self.stream_parts = max(1, stream_parts)
+        self.local_server = local_server
+        self.histograms = dict(
+            (kind, LatencyHistogram()) for kind in mix)
+        self.completed = dict((kind, 0) for kind in mix)
+        self.errors = dict((kind, 0) for kind in mix)
+        self._warmup = LatencyHistogram()
+        self._kinds = itertools.cycle(
+            [kind for kind, weight in sorted(mix.items())
+             for _ in range(weight)])
+        self._connections = itertools.cycle(connections)
+        self._operations = {
+            "request": self._request,
+            "stream": self._stream,
+            "notify": self._notify,
+        }
+        self._measure_from = float("inf")
+        self._expected_interval = None
+        self._loop = None
+
+    async def run_open(self, rate, duration, warmup=1.0):
+        """
+        Starts ``rate`` operations a second for ``warmup + duration``
+        seconds, then waits for them all to finish.
+
+        :param float rate: Operations per second.
+        :param float duration: Seconds to measure for.
+        :param float warmup: Seconds to run for beforehand, unmeasured.
+        """
+
+        loop = self._loop = asyncio.get_running_loop()
+        start = loop.time()
+        interval = 1.0 / rate
+        # Worked out the same way as the schedule, so that exactly the
+        # operations after the warmup are counted.
+        self._measure_from = start + int(round(warmup * rate)) * interval
+        total = int(round(warmup * rate)) + int(round(duration * rate))
+        tasks = set()
+        started = 0
+        while started < total:
+            # Catch up on everything that's due, in case we fell behind.
+            due = min(int((loop.time() - start) / interval) + 1, total)
+            while started < due:
+                task = loop.create_task(self._execute(
+                    next(self._kinds), next(self._connections),
+                    start + started * interval))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                started += 1
+            if started < total:
+                await asyncio.sleep(start + started * interval - loop.time())
+        if tasks:
+            await asyncio.wait(tasks)
+        await self._barrier()
+
+    async def run_closed(self, concurrency, duration, warmup=1.0):
+        """
+        Keeps ``concurrency`` operations in flight for ``warmup + duration``
+        seconds.
+
+        :param int concurrency: Operations in flight at once.
+        :param float duration: Seconds to measure for.
+        :param float warmup: Seconds to run for beforehand, unmeasured. The
+            mean latency seen during the warmup is what stalls are measured
+            against.
+        """
+
+        loop = self._loop = asyncio.get_running_loop()
+        if warmup > 0:
+            await self._run_workers(concurrency, loop.time() + warmup)
+            await self._barrier()
+            self._expected_interval = self._warmup.mean or None
+        self._measure_from = loop.time()
+        await self._run_workers(concurrency, self._measure_from + duration)
+        await self._barrier()
+
+    def notification_received(self, payload):
+        """
+        Records the latency of an ``echo`` notification, when the server
+        handling it is in this process.
+
+        :param payload: The notification's payload.
+        """
+
+        scheduled = _STAMP.unpack_from(payload)[0]
+        self._record("notify", scheduled)
+
+    def report(self, duration):
+        """
+        :param float duration: The seconds measured for.
+        :rtype: dict
+        :returns: Throughput and latency percentiles in milliseconds, for
+            each kind of operation and overall.
+        """
+
+        overall = LatencyHistogram()
+        operations = {}
+        for kind, histogram in self.histograms.items():
+            overall.merge(histogram)
+            operations[kind] = {
+                "completed": self.completed[kind],
+                "errors": self.errors[kind],
+                "per_sec": self.completed[kind] / duration,
+                "latency_ms": _latencies(histogram),
+            }
+        completed = sum(self.completed.values())
+        return {
+            "duration": duration,
+            "completed": completed,
+            "errors": sum(self.errors.values()),
+            "per_sec": completed / duration,
+            "latency_ms": _latencies(overall),
+            "operations": operations,
+        }
+
+    async def _run_workers(self, concurrency, end):
+        loop = self._loop
+
+        async def worker():
+            while loop.time() < end:
+                await self._execute(
+                    next(self._kinds), next(self._connections), loop.time())
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    async def _barrier(self):
+        # Each connection handles messages in order, so once a request has
+        # been answered, every notification sent before it has been seen.
+        await asyncio.gather(
+            *[connection.request("echo") for connection in self.connections],
+            return_exceptions=True)
+
+    async def _execute(self, kind, connection, scheduled):
+        try:
+            await self._operations[kind](connection, scheduled)
+        except Exception:
+            if scheduled >= self._measure_from:
+                self.errors[kind] += 1
+            return
+        if kind != "notify" or not self.local_server:
+            self._record(kind, scheduled)
+
+    def _record(self, kind, scheduled):
+        latency = self._loop.time() - scheduled
+        if scheduled < self._measure_from:
+            self._warmup.record(latency)
+            return
+        self.completed[kind] += 1
+        self.histograms[kind].record(latency, self._expected_interval)
+
+    async def _request(self, connection, scheduled):
+        await connection.request("echo", self.payload)
+
+    async def _stream(self, connection, scheduled):
+        call = connection.stream_request("echo", self.payload)
+        for _ in range(self.stream_parts - 1):
+            call.send(self.payload)
+        call.close()
+        async for _ in call:
+            pass
+
+    async def _notify(self, connection, scheduled):
+        connection.notify("echo", _STAMP.pack(scheduled) + self.payload)
+        await connection.drain()
+
+
+def _latencies(histogram):
+    summary = histogram.summary()
+    del summary["count"]
+    return dict((key, value * 1000) for key, value in summary.items())
+
+
+def _parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        mix[kind.strip()] = int(weight) if weight else 1
+    return mix
+
+
+def _parse_address(value):
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+async def run(connections=8, rate=None, concurrency=64, duration=10.0,
+              warmup=1.0, mix=None, payload_size=64, stream_parts=4,
+              address=None):
+    """
+    Runs a load test.
+
+    :param int connections: Connections to open.
+    :param float rate: Operations per second, for an open loop test.
+    :param int concurrency: Operations in flight at once, for a closed loop
+        test. Ignored if ``rate`` is given.
+    :param float duration: Seconds to measure for.
+    :param float warmup: Seconds to run for beforehand, unmeasured.
+    :param dict mix: See :py:class:`LoadGenerator`.
+    :param int payload_size: Bytes per request, part or notification.
+    :param int stream_parts: Request parts per stream request.
+    :param tuple address: ``(host, port)`` of an echo server to use. One is
+        started in this process if omitted.
+    :rtype: dict
+    :returns: See :py:meth:`LoadGenerator.report`.
+    """
+
+    server = generator = None
+    if address is None:
+        server = await start_echo_server(
+            on_notification=lambda payload:
+                generator.notification_received(payload))
+        address = server.sockets[0].getsockname()[:2]
+    opened = await asyncio.gather(
+        *[connect(*address) for _ in range(connections)])
+    try:
+        generator = LoadGenerator(
+            opened, mix, payload_size, stream_parts,
+            local_server=server is not None)
+        if rate:
+            await generator.run_open(rate, duration, warmup)
+        else:
+            await generator.run_closed(concurrency, duration, warmup)
+    finally:
+        for connection in opened:
+            connection.close()
+        await asyncio.gather(
+            *[connection.wait_closed() for connection in opened])
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+    results = generator.report(duration)
+    results.update({
+        "mode": "open" if rate else "closed",
+        "rate": rate,
+        "concurrency": None if rate else concurrency,
+        "connections": connections,
+        "payload_size": payload_size,
+        "mix": mix or {"request": 1},
+    })
+    return results
+
+
+async def serve(host, port):
+    """
+    Runs an echo server until cancelled.
+    """
+
+    server = await start_echo_server(host, port)
+    print("Serving on {}:{}".format(*server.sockets[0].getsockname()[:2]))
+    sys.stdout.flush()
+    async with server:
+        await server.serve_forever()
+
+
+def _print_report(results):
+    print("{mode} loop, {completed} operations in {duration:g}s: "
+          "{per_sec:.0f}/s, {errors} errors".format(**results))
+    print("{:<10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "", "per sec", "p50 ms", "p99 ms", "p99.9 ms", "max ms", "errors"))
+    rows = sorted(results["operations"].items())
+    rows.append(("all", results))
+    for kind, stats in rows:
+        latency = stats["latency_ms"]
+        print("{:<10} {:>10.0f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} "
+              "{:>10}".format(kind, stats["per_sec"], latency["p50"],
+                              latency["p99"], latency["p99.9"],
+                              latency["max"], stats["errors"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--serve", action="store_true",
+                        help="Only run an echo server.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="With --serve, the interface to listen on.")
+    parser.add_argument("--port", type=int, default=0,
+                        help="With --serve, the port to listen on.")
+    parser.add_argument("--connect", type=_parse_address,
+                        help="HOST:PORT of an echo server to load.")
+    parser.add_argument("--connections", type=int, default=8)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--rate", type=float,
+                      help="Open loop: operations per second.")
+    mode.add_argument("--concurrency", type=int, default=64,
+                      help="Closed loop: operations in flight at once.")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument(
+        "--mix", type=_parse_mix, default={"request": 1},
+        help="Weights of request, stream and notify operations, e.g. "
+             "request=8,stream=1,notify=1.")
+    parser.add_argument("--size", type=int, default=64,
+                        help="Payload size in bytes.")
+    parser.add_argument("--stream-parts", type=int, default=4)
+    parser.add_argument("--output", help="Save the results as JSON here.")
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        try:
+            asyncio.run(serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    results = asyncio.run(run(
+        args.connections, args.rate, args.concurrency, args.duration,
+        args.warmup, args.mix, args.size, args.stream_parts, args.connect))
+    _print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
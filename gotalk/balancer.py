@@ -0,0 +1,188 @@
+"""
+Spreading requests over several peers that serve the same operations.
+"""
+
+import asyncio
+import random
+import time
+
+from gotalk.client import ConnectionPool
+from gotalk.connection import RTT_SMOOTHING
+from gotalk.exceptions import ConnectionClosedError
+
+# The most a run of failures multiplies a peer's cost by.
+MAX_FAILURE_PENALTY = 64.0
+
+
+class Balancer(object):
+    """
+    Picks a peer for each request, preferring the ones that are least busy.
+
+    A peer's cost is its expected wait: the requests we have outstanding
+    with it plus the load it last reported in a heartbeat, times a moving
+    average of how long its requests take. Peers we haven't heard from yet
+    are assumed to be average. Sub-classes decide which peers to compare.
+
+    Each failure doubles a peer's cost. The penalty halves every
+    :py:attr:`penalty_half_life` seconds, so a peer that has recovered gets
+    tried again, and a success clears it.
+
+    .. tip:: Don't use this class directly!
+    """
+
+    #: Seconds for a failure penalty to lose half its weight.
+    penalty_half_life = 5.0
+
+    def __init__(self, peers, pool=None):
+        """
+        :param list peers: ``(host, port)`` tuples to spread requests over.
+        :param ConnectionPool pool: Where to get connections from. A pool of
+            our own is created if omitted.
+        """
+
+        if not peers:
+            raise ValueError("A balancer needs at least one peer.")
+        self.peers = [tuple(peer) for peer in peers]
+        self.pool = pool if pool is not None else ConnectionPool()
+        # (host, port) -> requests we're waiting on.
+        self._outstanding = dict.fromkeys(self.peers, 0)
+        # (host, port) -> smoothed seconds per request.
+        self._latency = {}
+        # (host, port) -> (cost multiplier, when it was last raised).
+        self._penalties = {}
+
+    async def request(self, operation, payload=b"", timeout=None):
+        """
+        Sends a single request to whichever peer :py:meth:`choose` picks.
+
+        :param str operation: The operation to invoke.
+        :param bytes payload: The request payload.
+        :param float timeout: Seconds to wait for the result, once sent.
+        :returns: The result payload.
+        :raises: See :py:meth:`ConnectionPool.request`.
+        """
+
+        peer = self.choose()
+        loop = asyncio.get_running_loop()
+        self._outstanding[peer] += 1
+        started = loop.time()
+        try:
+            result = await self.pool.request(
+                peer[0], peer[1], operation, payload, timeout)
+        except (ConnectionClosedError, OSError):
+            # Timeouts are OSErrors too. Failing fast mustn't make a broken
+            # peer look attractive, and timing out says little about how
+            # slow it really is.
+            self._penalize(peer)
+            raise
+        else:
+            self._penalties.pop(peer, None)
+            self._record_latency(peer, loop.time() - started)
+            return result
+        finally:
+            self._outstanding[peer] -= 1
+
+    def choose(self):
+        """
+        :rtype: tuple
+        :returns: The ``(host, port)`` of the peer to send a request to.
+        """
+
+        raise NotImplementedError()
+
+    def cost(self, peer):
+        """
+        :param tuple peer: A ``(host, port)`` tuple.
+        :rtype: float
+        :returns: How long we'd expect a request to the peer to wait.
+            Lower is better.
+        """
+
+        load = 0
+        for connection in self.pool.connections(*peer):
+            if connection.peer_load is not None:
+                load = max(load, connection.peer_load)
+        latency = self._latency.get(peer)
+        if latency is None:
+            latency = self._average_latency()
+        return (self._outstanding[peer] + load + 1) * latency * \
+            self._penalty(peer)
+
+    def close(self):
+        """
+        Closes the pool's connections.
+        """
+
+        self.pool.close()
+
+    async def wait_closed(self):
+        """
+        Waits until the pool's connections have been closed.
+        """
+
+        await self.pool.wait_closed()
+
+    def _average_latency(self):
+        if not self._latency:
+            return 1.0
+        return sum(self._latency.values()) / len(self._latency)
+
+    def _penalty(self, peer):
+        entry = self._penalties.get(peer)
+        if entry is None:
+            return 1.0
+        factor, since = entry
+        factor *= 0.5 ** ((time.monotonic() - since) / self.penalty_half_life)
+        if factor <= 1.0:
+            del self._penalties[peer]
+            return 1.0
+        return factor
+
+    def _penalize(self, peer):
+        self._penalties[peer] = (
+            min(self._penalty(peer) * 2, MAX_FAILURE_PENALTY),
+            time.monotonic())
+
+    def _record_latency(self, peer, sample):
+        latency = self._latency.get(peer)
+        if latency is None:
+            self._latency[peer] = sample
+        else:
+            self._latency[peer] = latency + RTT_SMOOTHING * (sample - latency)
+
+
+class LeastOutstandingBalancer(Balancer):
+    """
+    Sends every request to the cheapest peer. Best with a handful of peers,
+    since every choice looks at all of them.
+    """
+
+    def choose(self):
+        return min(self.peers, key=self.cost)
+
+
+class PowerOfTwoChoicesBalancer(Balancer):
+    """
+    Sends each request to the cheaper of two peers picked at random. Nearly
+    as good as checking every peer, at a constant cost, and less prone to
+    herding onto whichever peer looked best a moment ago.
+    """
+
+    def __init__(self, peers, pool=None, rng=None):
+        """
+        :param list peers: ``(host, port)`` tuples to spread requests over.
+        :param ConnectionPool pool: Where to get connections from. A pool of
+            our own is created if omitted.
+        :param random.Random rng: Source of the random choices.
+        """
+
+        super(PowerOfTwoChoicesBalancer, self).__init__(peers, pool)
+        self._random = rng if rng is not None else random.Random()
+
+    def choose(self):
+        if len(self.peers) < 2:
+            return self.peers[0]
+        first, second = self._random.sample(self.peers, 2)
+        if self.cost(second) < self.cost(first):
+            return second
+        return first
@@ -0,0 +1,249 @@
+"""
+Helpers for opening client connections, and for sharing them between
+requests.
+"""
+
+import asyncio
+
+from gotalk.connection import Connection
+from gotalk.exceptions import ConnectionClosedError
+
+
+async def connect(host, port, handlers=None, connection_class=Connection,
+                  **kwargs):
+    """
+    Opens a connection to a gotalk server and completes the protocol version
+    handshake.
+
+    :param str host: The host to connect to.
+    :param int port: The port to connect to.
+    :param Handlers handlers: Operations the server may invoke on us.
+    :param type connection_class: The ``Connection`` sub-class to use.
+    :param kwargs: Passed on to ``loop.create_connection()``.
+    :rtype: Connection
+    :raises: ProtocolError if the server doesn't speak our protocol version.
+    """
+
+    loop = asyncio.get_running_loop()
+    _, connection = await loop.create_connection(
+        lambda: connection_class(handlers), host, port, **kwargs)
+    try:
+        await connection.ready
+    except Exception:
+        connection.close()
+        raise
+    return connection
+
+
+class ConnectionPool(object):
+    """
+    Client connections to any number of peers, keyed by ``(host, port)``.
+
+    Requests to the same peer share its connections: each request goes to
+    the connection with the fewest in flight, and another connection is only
+    opened once they're all carrying ``max_in_flight`` requests. Connections
+    that have had nothing in flight for ``idle_timeout`` seconds are closed.
+
+    Usage::
+
+        async with ConnectionPool() as pool:
+            result = await pool.request("10.0.0.7", 1234, "echo", b"hi")
+    """
+
+    def __init__(self, handlers=None, max_per_host=4, max_in_flight=64,
+                 idle_timeout=60.0, connection_class=Connection, **kwargs):
+        """
+        :param Handlers handlers: Operations peers may invoke on us.
+        :param int max_per_host: The most connections to keep open to any
+            one peer.
+        :param int max_in_flight: How many requests a connection carries
+            before another one is opened to the same peer.
+        :param float idle_timeout: Seconds a connection may sit unused before
+            it's closed, or ``None`` to keep connections open. Idle
+            connections are swept periodically, so they can linger for up
+            to twice this.
+        :param type connection_class: The ``Connection`` sub-class to use.
+        :param kwargs: Passed on to :py:func:`connect`.
+        """
+
+        self.handlers = handlers
+        self.max_per_host = max_per_host
+        self.max_in_flight = max_in_flight
+        self.idle_timeout = idle_timeout
+        self.connection_class = connection_class
+        self._connect_kwargs = kwargs
+        # (host, port) -> [Connection]
+        self._connections = {}
+        # (host, port) -> [Task], for connections still being opened.
+        self._connecting = {}
+        # Connection -> when it was last handed out or finished a request.
+        self._last_used = {}
+        self._sweep_handle = None
+        self._closed = False
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of open connections, across all peers.
+        """
+
+        return len(self._last_used)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+        await self.wait_closed()
+
+    async def get(self, host, port):
+        """
+        Picks a connection to the given peer, opening one if needed.
+
+        :param str host: The peer's host.
+        :param int port: The peer's port.
+        :rtype: Connection
+        :raises: ConnectionClosedError if the pool has been closed.
+        :raises: Whatever :py:func:`connect` raises, if opening a connection
+            fails.
+        """
+
+        key = (host, port)
+        while True:
+            if self._closed:
+                raise ConnectionClosedError("Connection pool closed.")
+            connections = self._live_connections(key)
+            connecting = self._connecting.get(key, ())
+            at_limit = \
+                len(connections) + len(connecting) >= self.max_per_host
+            best = None
+            for connection in connections:
+                if best is None or connection.in_flight < best.in_flight:
+                    best = connection
+            if best is not None and (
+                    best.in_flight < self.max_in_flight or
+                    at_limit and not connecting):
+                self._last_used[best] = asyncio.get_running_loop().time()
+                return best
+            if connecting:
+                # Wait for the connection that's already opening rather than
+                # open one each for a burst of requests.
+                await asyncio.wait(
+                    list(connecting), return_when=asyncio.FIRST_COMPLETED)
+            elif not at_limit:
+                return await self._open(key)
+
+    def connections(self, host, port):
+        """
+        :param str host: The peer's host.
+        :param int port: The peer's port.
+        :rtype: list
+        :returns: The open connections to the peer.
+        """
+
+        return list(self._live_connections((host, port)))
+
+    async def request(self, host, port, operation, payload=b"",
+                      timeout=None):
+        """
+        Sends a single request to the given peer over a pooled connection.
+
+        :param str host: The peer's host.
+        :param int port: The peer's port.
+        :param str operation: The operation to invoke on the peer.
+        :param bytes payload: The request payload.
+        :param float timeout: Seconds to wait for the result, once sent.
+        :returns: The result payload.
+        :raises: See :py:meth:`get` and :py:meth:`Connection.request`.
+        """
+
+        connection = await self.get(host, port)
+        try:
+            return await connection.request(operation, payload, timeout)
+        finally:
+            if connection in self._last_used:
+                self._last_used[connection] = \
+                    asyncio.get_running_loop().time()
+
+    def close(self):
+        """
+        Closes every connection, and stops opening new ones.
+        """
+
+        self._closed = True
+        if self._sweep_handle is not None:
+            self._sweep_handle.cancel()
+            self._sweep_handle = None
+        for connecting in self._connecting.values():
+            for task in connecting:
+                task.cancel()
+        for connection in self._last_used:
+            connection.close()
+
+    async def wait_closed(self):
+        """
+        Waits until every connection has been closed.
+        """
+
+        await asyncio.gather(
+            *[connection.wait_closed() for connection in self._last_used])
+        self._connections.clear()
+        self._last_used.clear()
+
+    def _live_connections(self, key):
+        connections = self._connections.get(key)
+        if not connections:
+            return ()
+        for connection in connections:
+            if connection.is_closing:
+                break
+        else:
+            return connections
+        for connection in connections:
+            if connection.is_closing:
+                del self._last_used[connection]
+        connections[:] = [c for c in connections if not c.is_closing]
+        return connections
+
+    async def _open(self, key):
+        host, port = key
+        task = asyncio.ensure_future(connect(
+            host, port, self.handlers, self.connection_class,
+            **self._connect_kwargs))
+        connecting = self._connecting.setdefault(key, [])
+        connecting.append(task)
+        try:
+            connection = await task
+        finally:
+            connecting.remove(task)
+            if not connecting:
+                del self._connecting[key]
+        if self._closed:
+            connection.close()
+            raise ConnectionClosedError("Connection pool closed.")
+        self._connections.setdefault(key, []).append(connection)
+        self._last_used[connection] = asyncio.get_running_loop().time()
+        self._schedule_sweep()
+        return connection
+
+    def _schedule_sweep(self):
+        if self._sweep_handle is None and self.idle_timeout is not None:
+            self._sweep_handle = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self._sweep)
+
+    def _sweep(self):
+        self._sweep_handle = None
+        loop = asyncio.get_running_loop()
+        idle_since = loop.time() - self.idle_timeout
+        for key, connections in list(self._connections.items()):
+            for connection in list(connections):
+                if connection.is_closing or (
+                        not connection.in_flight and
+                        self._last_used[connection] <= idle_since):
+                    connections.remove(connection)
+                    del self._last_used[connection]
+                    connection.close()
+            if not connections:
+                del self._connections[key]
+        if self._connections:
+            self._schedule_sweep()
@@ -0,0 +1,865 @@
+"""
+asyncio transport that ties the message layer together into a working
+gotalk connection.
+"""
+
+import asyncio
+import inspect
+
+from gotalk.exceptions import ConnectionClosedError, \
+    InvalidMessageTypeIDError, InvalidPayloadError, \
+    InvalidProtocolVersionError, ProtocolError, RemoteError, \
+    RequestTimeoutError, RetryRequestedError
+from gotalk.handlers import Handlers
+from gotalk.metrics import OUTCOME_CANCELLED, OUTCOME_CLOSED, OUTCOME_ERROR, \
+    OUTCOME_OK, get_outcome
+from gotalk.payloads import DEFAULT_CHUNK_SIZE, FilePayload, iter_chunks
+from gotalk.protocol.defines import PROTOCOL_ERROR_INVALID_MESSAGE, \
+    PROTOCOL_ERROR_UNSUPPORTED_VERSION
+from gotalk.protocol.framing import FrameDecoder
+from gotalk.protocol.messages import coalesce_buffers, read_version_message
+from gotalk.protocol.version01.messages import ProtocolVersionMessage, \
+    ProtocolErrorMessage, SingleRequestMessage, SingleResultMessage, \
+    StreamRequestMessage, StreamRequestPartMessage, StreamResultMessage, \
+    ErrorResultMessage, RetryResultMessage, NotificationMessage, \
+    HeartbeatMessage
+from gotalk.request_ids import RequestIDAllocator
+from gotalk.streams import DEFAULT_CONNECTION_BUFFER_LIMIT, \
+    DEFAULT_STREAM_BUFFER_LIMIT, FlowControl, Stream
+from gotalk.timers import get_timer_wheel
+
+# Seconds between heartbeats, as in the reference implementation.
+DEFAULT_HEARTBEAT_INTERVAL = 20.0
+# Weight of each new sample in the smoothed round-trip time, as in TCP.
+RTT_SMOOTHING = 0.125
+# Stands in for requests we've given up on in the in-flight table. Their
+# IDs stay reserved until the peer's answer turns up, so that it can't be
+# taken for the answer to a later request that was handed the same ID.
+_ABANDONED = object()
+
+
+class StreamRequest(object):
+    """
+    The client's side of an in-progress stream request. Send request parts
+    with :py:meth:`send`, finish the request with :py:meth:`close`, and read
+    result parts with ``async for``.
+    """
+
+    def __init__(self, connection, request_id, results):
+        self.connection = connection
+        self.request_id = request_id
+        #: The :py:class:`gotalk.streams.Stream` of result payloads.
+        self.results = results
+
+    def __aiter__(self):
+        return self.results.__aiter__()
+
+    def send(self, payload):
+        """
+        Sends another part of the request. Empty payloads are skipped, since
+        an empty part is what ends the request.
+        """
+
+        if len(payload):
+            self.connection.write_message(
+                StreamRequestPartMessage(self.request_id, payload))
+
+    async def send_from(self, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Sends a large payload as request parts of at most ``chunk_size``
+        bytes, reading lazily from ``source`` and waiting for the connection
+        to drain between parts. Doesn't close the request.
+
+        :param source: Anything :py:func:`gotalk.payloads.iter_chunks`
+            accepts, or an async iterable of byte strings.
+        :param int chunk_size: The largest part to send.
+        :raises: ConnectionClosedError if the connection goes away first.
+        """
+
+        if hasattr(source, "__aiter__"):
+            async for piece in source:
+                for chunk in iter_chunks((piece,), chunk_size):
+                    self.send(chunk)
+                    await self.drain()
+        else:
+            for chunk in iter_chunks(source, chunk_size):
+                self.send(chunk)
+                await self.drain()
+
+    def close(self):
+        """
+        Tells the peer that there are no more request parts coming.
+        """
+
+        self.connection.write_message(
+            StreamRequestPartMessage(self.request_id, b""))
+
+    async def drain(self):
+        """
+        Waits until the connection is ready for more data to be sent. Call
+        this between parts when sending a lot of them.
+        """
+
+        await self.connection.drain()
+
+    def cancel(self):
+        """
+        Gives up on the request. Buffered results are dropped, and any that
+        arrive later are ignored. Gotalk 01 can't tell the peer to stop, so
+        it will carry on until it's done.
+        """
+
+        self.connection._cancel_request(self.request_id, self.results)
+        self.results.close()
+
+
+class Connection(asyncio.Protocol):
+    """
+    A gotalk connection. The same class is used on both ends: either side can
+    send requests and notifications, and either side will dispatch incoming
+    ones to its :py:class:`gotalk.handlers.Handlers`.
+
+    Many requests can be in flight at once. Results are matched back up with
+    their requests by request ID, regardless of the order they arrive in.
+
+    Outgoing messages are encoded right away, but only handed to the
+    transport once per event loop iteration, so a burst of small results
+    goes out in a single write.
+
+    Incoming stream parts are buffered until consumed, and reading from the
+    socket is paused while a stream, or all streams together, have more
+    buffered than their limits allow. Stream results we send wait for the
+    transport to drain, so a slow peer slows down our stream handlers.
+
+    Both ends send a heartbeat every ``heartbeat_interval`` seconds. If
+    nothing at all arrives from a peer for ``heartbeat_timeout`` seconds,
+    the connection is presumed dead and dropped, which fails whatever was
+    waiting on it. Peers that don't send heartbeats themselves are only held
+    to the timeout while we're waiting on them for something.
+
+    Requests can be given a timeout, after which they fail with
+    ``RequestTimeoutError``. Gotalk 01 has no way to cancel a request, so
+    the peer carries on with it regardless. Its request ID stays reserved
+    until its result turns up, which is then discarded, and the same goes
+    for requests that are cancelled.
+
+    Given a :py:class:`gotalk.metrics.MetricsSink`, the connection reports
+    every message it sends and receives, the single requests it sends, and
+    the requests it handles.
+    """
+
+    def __init__(self, handlers=None, message_pool=None,
+                 stream_buffer_limit=DEFAULT_STREAM_BUFFER_LIMIT,
+                 connection_buffer_limit=DEFAULT_CONNECTION_BUFFER_LIMIT,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 heartbeat_timeout=None, request_timeout=None, metrics=None):
+        """
+        :param Handlers handlers: The operations and notifications this end
+            of the connection handles. If omitted, every incoming request is
+            answered with an error.
+        :param MessagePool message_pool: If given, incoming messages are
+            decoded into recycled instances from this pool and handed back
+            to it once dispatched. Handlers only ever see payloads, so this
+            is safe to share between connections on the same event loop.
+        :param int stream_buffer_limit: Bytes a single incoming stream may
+            buffer before reading is paused.
+        :param int connection_buffer_limit: Bytes all incoming streams may
+            buffer between them before reading is paused.
+        :param float heartbeat_interval: Seconds between the heartbeats we
+            send, or ``None`` to send none and not watch for dead peers.
+        :param float heartbeat_timeout: Seconds of silence from the peer
+            after which the connection is dropped. Defaults to three
+            heartbeat intervals.
+        :param float request_timeout: The default timeout, in seconds, for
+            requests that don't specify their own. ``None`` means requests
+            wait as long as the connection lasts.
+        :param MetricsSink metrics: Where to report what the connection is
+            doing. Nothing is reported if omitted.
+        """
+
+        self.handlers = handlers if handlers is not None else Handlers()
+        self.proto_version = ProtocolVersionMessage.protocol_version
+        self.transport = None
+        #: Resolves to the peer's protocol version once the handshake is done.
+        self.ready = None
+        self._loop = None
+        self._closed = None
+        self._peer_version = None
+        self._version_buffer = b""
+        self._pool = message_pool
+        self._decoder = FrameDecoder(self.proto_version, pool=message_pool)
+        # Requests we've sent and are waiting on. Single requests map to a
+        # future, stream requests to the Stream their results go to.
+        self._requests = RequestIDAllocator()
+        # How many of those we've given up on.
+        self._abandoned = 0
+        # Stream -> Timer, for the deadlines of stream requests we've sent.
+        self._stream_deadlines = {}
+        # Request ID -> Stream, for parts of stream requests we're handling.
+        self._request_streams = {}
+        self._tasks = set()
+        self._write_queue = []
+        self._flush_scheduled = False
+        self._write_paused = False
+        self._drain_waiters = []
+        # FilePayloads in the write queue, and the task sending one, if any.
+        self._queued_files = 0
+        self._sending_file = None
+        self._close_requested = False
+        self.stream_buffer_limit = stream_buffer_limit
+        self._flow_control = FlowControl(connection_buffer_limit)
+        self.heartbeat_interval = heartbeat_interval
+        if heartbeat_timeout is None and heartbeat_interval is not None:
+            heartbeat_timeout = heartbeat_interval * 3
+        self.heartbeat_timeout = heartbeat_timeout
+        #: The load the peer reported in its last heartbeat.
+        self.peer_load = None
+        #: The peer's clock, in seconds since the epoch, as of its last
+        #: heartbeat.
+        self.peer_time = None
+        #: Smoothed round-trip time of our requests, in seconds. Heartbeats
+        #: only flow one way, so this includes the peer's handling time.
+        self.rtt = None
+        self._heartbeat_handle = None
+        self._last_received = None
+        self.request_timeout = request_timeout
+        self._timers = None
+        self.metrics = metrics
+        self._dispatch = {
+            SingleRequestMessage: self._on_single_request,
+            StreamRequestMessage: self._on_stream_request,
+            StreamRequestPartMessage: self._on_stream_request_part,
+            SingleResultMessage: self._on_single_result,
+            StreamResultMessage: self._on_stream_result,
+            ErrorResultMessage: self._on_error_result,
+            RetryResultMessage: self._on_retry_result,
+            NotificationMessage: self._on_notification,
+            ProtocolErrorMessage: self._on_protocol_error,
+            HeartbeatMessage: self._on_heartbeat,
+        }
+
+    @property
+    def in_flight(self):
+        """
+        :rtype: int
+        :returns: The number of requests we're waiting on the peer for.
+        """
+
+        return len(self._requests) - self._abandoned
+
+    @property
+    def is_closing(self):
+        """
+        :rtype: bool
+        :returns: ``True`` if the connection is closed or on its way there.
+        """
+
+        return self._closed is not None or self._close_requested or \
+            self.transport is None or self.transport.is_closing()
+
+    # asyncio.Protocol callbacks
+
+    def connection_made(self, transport):
+        self._loop = asyncio.get_running_loop()
+        self.ready = self._loop.create_future()
+        self._closed_future = self._loop.create_future()
+        self.transport = transport
+        self._flow_control.attach(transport)
+        self._timers = get_timer_wheel()
+        self.write_message(ProtocolVersionMessage())
+        self._last_received = self._loop.time()
+        if self.heartbeat_interval is not None:
+            self._heartbeat_handle = self._loop.call_later(
+                self.heartbeat_interval, self._heartbeat)
+
+    def data_received(self, data):
+        self._last_received = self._loop.time()
+        if self._peer_version is None:
+            data = self._receive_version(data)
+            if not data:
+                return
+        metrics = self.metrics
+        frame_sizes = [] if metrics is not None else None
+        try:
+            messages = self._decoder.feed(data, frame_sizes)
+        except (InvalidMessageTypeIDError, InvalidPayloadError,
+                ValueError) as exc:
+            self._send_protocol_error(PROTOCOL_ERROR_INVALID_MESSAGE, str(exc))
+            return
+        if metrics is not None:
+            for message, nbytes in zip(messages, frame_sizes):
+                metrics.frame_received(message.type_id, nbytes)
+        dispatch = self._dispatch
+        pool = self._pool
+        for message in messages:
+            dispatch[message.__class__](message)
+            if pool is not None:
+                pool.release(message)
+
+    def connection_lost(self, exc):
+        if self._closed is None:
+            self._closed = ConnectionClosedError(
+                str(exc) if exc else "Connection closed.")
+        error = self._closed
+        if not self.ready.done():
+            self.ready.set_exception(error)
+            # Nobody is obliged to wait on the handshake, so don't complain
+            # about the exception going unretrieved.
+            self.ready.exception()
+        for entry in self._requests.clear():
+            _fail(entry, error)
+        self._abandoned = 0
+        deadlines, self._stream_deadlines = self._stream_deadlines, {}
+        for deadline in deadlines.values():
+            deadline.cancel()
+        request_streams, self._request_streams = self._request_streams, {}
+        for stream in request_streams.values():
+            stream.set_exception(error)
+        for task in list(self._tasks):
+            task.cancel()
+        if self._heartbeat_handle is not None:
+            self._heartbeat_handle.cancel()
+            self._heartbeat_handle = None
+        self._wake_drain_waiters()
+        if not self._closed_future.done():
+            self._closed_future.set_result(None)
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._wake_drain_waiters()
+
+    def get_load(self):
+        """
+        Reports how busy we are in the heartbeats we send. Override this to
+        report something more meaningful to your peers.
+
+        :rtype: int
+        :returns: The number of requests we're currently handling.
+        """
+
+        return len(self._tasks)
+
+    # Public API
+
+    def write_message(self, message):
+        """
+        Sends a message to the peer.
+
+        :param message: An instance of a GotalkMessage child.
+        :raises: ConnectionClosedError if the connection is closed.
+        """
+
+        if self.is_closing:
+            raise ConnectionClosedError("Connection closed.")
+        # Encoding now means bad messages are reported to the caller.
+        buffers = message.to_buffers()
+        # The version exchange isn't a message type of its own.
+        if self.metrics is not None and \
+                message.__class__ is not ProtocolVersionMessage:
+            self.metrics.frame_sent(
+                message.type_id, sum(len(buf) for buf in buffers))
+        if buffers[-1].__class__ is FilePayload:
+            self._queued_files += 1
+        self._write_queue.extend(buffers)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self.flush)
+
+    def flush(self):
+        """
+        Hands everything written so far to the transport. This happens
+        automatically once per event loop iteration.
+        """
+
+        self._flush_scheduled = False
+        if self._sending_file is not None:
+            # Picked up again once the file has been sent.
+            return
+        queue, self._write_queue = self._write_queue, []
+        if not queue or self.transport is None or \
+                self.transport.is_closing():
+            return
+        if self._queued_files:
+            for i, buf in enumerate(queue):
+                if buf.__class__ is FilePayload:
+                    # Everything after the file has to wait for it.
+                    self._queued_files -= 1
+                    self._write_queue = queue[i + 1:]
+                    queue = queue[:i]
+                    self._sending_file = self._spawn(self._send_file(buf))
+                    break
+        if queue:
+            self.transport.writelines(coalesce_buffers(queue))
+
+    async def request(self, operation, payload=b"", timeout=None):
+        """
+        Sends a single request and waits for its result.
+
+        :param str operation: The operation to invoke on the peer.
+        :param bytes payload: The request payload.
+        :param float timeout: Seconds to wait for the result. Defaults to
+            the connection's ``request_timeout``.
+        :returns: The result payload.
+        :raises: RemoteError if the peer responds with an error.
+        :raises: RetryRequestedError if the peer asks us to try again later.
+        :raises: RequestTimeoutError if the result doesn't arrive in time.
+        :raises: ConnectionClosedError if the connection goes away first.
+        """
+
+        metrics = self.metrics
+        future = self._loop.create_future()
+        request_id = self._requests.allocate(future)
+        deadline = self._set_deadline(request_id, future, timeout)
+        started = self._loop.time()
+        if metrics is not None:
+            metrics.request_started(operation)
+        outcome = OUTCOME_CANCELLED
+        sent = False
+        try:
+            self.write_message(
+                SingleRequestMessage(request_id, operation, payload))
+            sent = True
+            result = await future
+            outcome = OUTCOME_OK
+            self._record_rtt(self._loop.time() - started)
+            return result
+        except Exception as exc:
+            outcome = get_outcome(exc)
+            raise
+        finally:
+            if deadline is not None:
+                deadline.cancel()
+            if self._requests.get(request_id) is future:
+                if sent:
+                    self._abandon_request(request_id)
+                else:
+                    self._requests.pop(request_id)
+            if metrics is not None:
+                metrics.request_finished(
+                    operation, outcome, self._loop.time() - started)
+
+    def stream_request(self, operation, payload=b"", timeout=None):
+        """
+        Starts a stream request.
+
+        :param str operation: The operation to invoke on the peer.
+        :param bytes payload: The first part of the request.
+        :param float timeout: Seconds for the whole result stream to arrive
+            in. Defaults to the connection's ``request_timeout``. Reading
+            past the deadline raises ``RequestTimeoutError``.
+        :rtype: StreamRequest
+        :raises: ConnectionClosedError if the connection is closed.
+        """
+
+        if self.is_closing:
+            raise ConnectionClosedError("Connection closed.")
+        results = self._new_stream(None)
+        request_id = results.request_id = self._requests.allocate(results)
+        try:
+            self.write_message(
+                StreamRequestMessage(request_id, operation, payload))
+        except Exception:
+            self._requests.pop(request_id)
+            raise
+        deadline = self._set_deadline(request_id, results, timeout)
+        if deadline is not None:
+            self._stream_deadlines[results] = deadline
+        return StreamRequest(self, request_id, results)
+
+    def notify(self, name, payload=b""):
+        """
+        Sends a notification, which the peer doesn't respond to.
+
+        :param str name: The notification name.
+        :param bytes payload: The notification payload.
+        """
+
+        self.write_message(NotificationMessage(name, payload))
+
+    async def drain(self):
+        """
+        Waits until the transport's write buffer has room again. Returns
+        right away unless the peer is reading slower than we're writing.
+
+        :raises: ConnectionClosedError if the connection is closed.
+        """
+
+        if self.is_closing:
+            raise ConnectionClosedError("Connection closed.")
+        # Whatever is still queued counts too, and handing it over is what
+        # tells the transport whether it's backed up.
+        if self._write_queue:
+            self.flush()
+        while self._write_paused or self._sending_file is not None:
+            waiter = self._loop.create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+            if self._closed is not None:
+                raise ConnectionClosedError("Connection closed.")
+
+    def close(self):
+        """
+        Closes the connection. Anything still waiting on the peer fails with
+        ``ConnectionClosedError``. If a file is being sent, the connection
+        closes once it and everything written after it have gone out.
+        """
+
+        self._close_requested = True
+        if self.transport is None:
+            return
+        if self._sending_file is None:
+            self.flush()
+        if self._sending_file is None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        """
+        Waits until the connection has been closed.
+        """
+
+        await asyncio.shield(self._closed_future)
+
+    # Internals
+
+    def _receive_version(self, data):
+        """
+        Consumes the peer's protocol version from the start of the
+        connection.
+
+        :returns: Whatever data was left over after the version.
+        """
+
+        self._version_buffer += data
+        if len(self._version_buffer) < 2:
+            return None
+        version_bytes = self._version_buffer[:2]
+        data = self._version_buffer[2:]
+        self._version_buffer = b""
+        try:
+            peer_version = read_version_message(version_bytes)
+        except InvalidProtocolVersionError:
+            peer_version = None
+        if peer_version != self.proto_version:
+            self._send_protocol_error(
+                PROTOCOL_ERROR_UNSUPPORTED_VERSION,
+                "Unsupported protocol version {version!r}.".format(
+                    version=version_bytes))
+            return None
+        self._peer_version = peer_version
+        self.ready.set_result(peer_version)
+        return data
+
+    def _send_protocol_error(self, code, reason):
+        if not self.is_closing:
+            self.write_message(ProtocolErrorMessage(code))
+        self._abort(ProtocolError(code, reason))
+
+    def _abort(self, exc):
+        if self._closed is None:
+            self._closed = exc
+        self.close()
+
+    async def _send_file(self, payload):
+        try:
+            await self._loop.sendfile(
+                self.transport, payload.file, payload.offset, payload.length)
+        except Exception as exc:
+            # Some of the frame may have gone out already, so nothing else
+            # can follow it.
+            if self._closed is None:
+                self._closed = ConnectionClosedError(
+                    "Failed to send file: {exc}".format(exc=exc))
+            self.transport.abort()
+        finally:
+            payload.close()
+            self._sending_file = None
+            self.flush()
+            if self._close_requested and self._sending_file is None and \
+                    not self.transport.is_closing():
+                self.transport.close()
+            self._wake_drain_waiters()
+
+    def _heartbeat(self):
+        self._heartbeat_handle = None
+        if self.is_closing:
+            return
+        now = self._loop.time()
+        if not self.transport.is_reading():
+            # While we've stopped reading, for flow control, we wouldn't
+            # hear the peer anyway. Silence counts from when we start again.
+            self._last_received = now
+        silence = now - self._last_received
+        if silence > self.heartbeat_timeout and (
+                self.peer_time is not None or self._requests or
+                self._request_streams):
+            # Half-open connections can take the OS many minutes to notice,
+            # so don't wait for it.
+            self._closed = ConnectionClosedError(
+                "Nothing heard from the peer in {silence:.1f} seconds.".format(
+                    silence=silence))
+            self.transport.abort()
+            return
+        self.write_message(HeartbeatMessage(self.get_load()))
+        self._heartbeat_handle = self._loop.call_later(
+            self.heartbeat_interval, self._heartbeat)
+
+    def _set_deadline(self, request_id, entry, timeout):
+        if timeout is None:
+            timeout = self.request_timeout
+            if timeout is None:
+                return None
+        return self._timers.call_later(
+            timeout, self._expire_request, request_id, entry, timeout)
+
+    def _cancel_request(self, request_id, entry):
+        self._cancel_deadline(entry)
+        if self._requests.get(request_id) is entry:
+            self._abandon_request(request_id)
+
+    def _abandon_request(self, request_id):
+        self._requests[request_id] = _ABANDONED
+        self._abandoned += 1
+
+    def _release_abandoned(self, request_id):
+        self._requests.pop(request_id)
+        self._abandoned -= 1
+
+    def _cancel_deadline(self, entry):
+        deadline = self._stream_deadlines.pop(entry, None)
+        if deadline is not None:
+            deadline.cancel()
+
+    def _expire_request(self, request_id, entry, timeout):
+        self._stream_deadlines.pop(entry, None)
+        # The request may have finished since.
+        if self._requests.get(request_id) is entry:
+            self._abandon_request(request_id)
+            _fail(entry, RequestTimeoutError(
+                "No result within {timeout} seconds.".format(
+                    timeout=timeout)))
+
+    def _record_rtt(self, sample):
+        if self.rtt is None:
+            self.rtt = sample
+        else:
+            self.rtt += RTT_SMOOTHING * (sample - self.rtt)
+
+    def _new_stream(self, request_id):
+        return Stream(
+            request_id, limit=self.stream_buffer_limit,
+            flow_control=self._flow_control)
+
+    def _wake_drain_waiters(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _respond(self, message):
+        # Responses to a peer that has gone away have nowhere to go.
+        if not self.is_closing:
+            self.write_message(message)
+
+    # Incoming requests
+
+    def _on_single_request(self, message):
+        handler = self.handlers.request_handlers.get(message.operation)
+        if handler is None:
+            self._respond(_unknown_operation(message))
+            return
+        # Messages may be recycled once dispatched, so the handler task only
+        # gets the fields it needs.
+        self._spawn(self._run_request_handler(
+            handler, message.operation, message.request_id, message.payload))
+
+    async def _run_request_handler(self, handler, operation, request_id,
+                                   payload):
+        started = self._handler_started(operation)
+        outcome = OUTCOME_CANCELLED
+        try:
+            result = handler(payload)
+            if inspect.isawaitable(result):
+                result = await result
+            if result is None:
+                result = b""
+            # A result that can't be encoded, say one that isn't a buffer,
+            # is the handler's error like any other.
+            self._respond(SingleResultMessage(request_id, result))
+        except Exception as exc:
+            outcome = OUTCOME_ERROR
+            self._respond(ErrorResultMessage(request_id, str(exc)))
+        else:
+            outcome = OUTCOME_OK
+        finally:
+            self._handler_finished(operation, outcome, started)
+
+    def _on_stream_request(self, message):
+        handler = self.handlers.stream_handlers.get(message.operation)
+        if handler is None:
+            self._respond(_unknown_operation(message))
+            return
+        request_id = message.request_id
+        stream = self._new_stream(request_id)
+        # The first part rides along with the request itself. Unlike later
+        # parts, an empty one here doesn't end the stream.
+        if len(message.payload):
+            stream.feed(message.payload)
+        self._request_streams[request_id] = stream
+        self._spawn(self._run_stream_handler(
+            handler, message.operation, request_id, stream))
+
+    def _on_stream_request_part(self, message):
+        stream = self._request_streams.get(message.request_id)
+        if stream is not None:
+            stream.feed(message.payload)
+
+    async def _run_stream_handler(self, handler, operation, request_id,
+                                  stream):
+        started = self._handler_started(operation)
+        outcome = OUTCOME_CANCELLED
+        try:
+            results = handler(stream)
+            if inspect.isawaitable(results):
+                results = await results
+            # Big payloads, files and such go out in chunks rather than as
+            # one huge part.
+            if hasattr(results, "__aiter__"):
+                async for payload in results:
+                    for chunk in iter_chunks((payload,)):
+                        await self._respond_stream_part(request_id, chunk)
+            elif results is not None:
+                for chunk in iter_chunks(results):
+                    await self._respond_stream_part(request_id, chunk)
+        except ConnectionClosedError:
+            outcome = OUTCOME_CLOSED
+        except Exception as exc:
+            outcome = OUTCOME_ERROR
+            self._respond(ErrorResultMessage(request_id, str(exc)))
+        else:
+            outcome = OUTCOME_OK
+            self._respond(StreamResultMessage(request_id, b""))
+        finally:
+            self._handler_finished(operation, outcome, started)
+            self._request_streams.pop(request_id, None)
+            # Whatever the handler didn't read shouldn't hold up the
+            # connection.
+            stream.close()
+
+    def _handler_started(self, operation):
+        if self.metrics is None:
+            return None
+        self.metrics.handler_started(operation)
+        return self._loop.time()
+
+    def _handler_finished(self, operation, outcome, started):
+        if self.metrics is not None and started is not None:
+            self.metrics.handler_finished(
+                operation, outcome, self._loop.time() - started)
+
+    async def _respond_stream_part(self, request_id, payload):
+        self.write_message(StreamResultMessage(request_id, payload))
+        await self.drain()
+
+    def _on_notification(self, message):
+        handler = self.handlers.notification_handlers.get(message.name)
+        if handler is None:
+            return
+        # Nobody is waiting on a notification to report errors to, but a
+        # broken handler mustn't take the connection down with it.
+        try:
+            result = handler(message.payload)
+        except Exception as exc:
+            self._report_notification_error(message.name, exc)
+            return
+        if inspect.isawaitable(result):
+            self._spawn(self._run_notification_handler(message.name, result))
+
+    async def _run_notification_handler(self, name, awaitable):
+        try:
+            await awaitable
+        except Exception as exc:
+            self._report_notification_error(name, exc)
+
+    def _report_notification_error(self, name, exc):
+        self._loop.call_exception_handler({
+            'message': 'Exception in handler for notification "{name}"'.format(
+                name=name),
+            'exception': exc,
+            'protocol': self,
+        })
+
+    def _on_heartbeat(self, message):
+        self.peer_load = message.load
+        self.peer_time = message.time
+
+    # Incoming results
+
+    def _on_single_result(self, message):
+        future = self._requests.get(message.request_id)
+        if future is _ABANDONED:
+            self._release_abandoned(message.request_id)
+        # Anything else is nonsense from the peer.
+        elif isinstance(future, asyncio.Future):
+            self._requests.pop(message.request_id)
+            if not future.done():
+                future.set_result(message.payload)
+
+    def _on_stream_result(self, message):
+        request_id = message.request_id
+        stream = self._requests.get(request_id)
+        if stream is _ABANDONED:
+            # An empty part is the end of the results.
+            if not len(message.payload):
+                self._release_abandoned(request_id)
+            return
+        if not isinstance(stream, Stream):
+            return
+        stream.feed(message.payload)
+        if not len(message.payload):
+            self._requests.pop(request_id)
+            self._cancel_deadline(stream)
+
+    def _on_error_result(self, message):
+        self._fail_request(message.request_id, RemoteError(message.payload))
+
+    def _on_retry_result(self, message):
+        self._fail_request(
+            message.request_id,
+            RetryRequestedError(message.wait, message.payload))
+
+    def _fail_request(self, request_id, exc):
+        entry = self._requests.pop(request_id)
+        if entry is _ABANDONED:
+            self._abandoned -= 1
+        elif entry is not None:
+            self._cancel_deadline(entry)
+            _fail(entry, exc)
+
+    def _on_protocol_error(self, message):
+        self._abort(ProtocolError(message.code))
+
+
+def _fail(entry, exc):
+    """
+    Fails whatever is waiting on a request, be it a future or a stream.
+    """
+
+    if isinstance(entry, Stream):
+        entry.set_exception(exc)
+    elif entry is not _ABANDONED and not entry.done():
+        entry.set_exception(exc)
+
+
+def _unknown_operation(message):
+    return ErrorResultMessage(
+        message.request_id,
+        'Unknown operation "{operation}"'.format(operation=message.operation))
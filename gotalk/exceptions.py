@@ -56,3 +56,72 @@ class PayloadTooLongError(InvalidPayloadError):
     """
 
     pass
+
+
+class InvalidRequestIDError(Exception):
+    """
+    Raised when a request ID can't be represented in the 4 bytes the
+    protocol allows for it.
+    """
+
+    pass
+
+
+class RequestIDsExhaustedError(Exception):
+    """
+    Raised when a connection has so many requests in flight that there are
+    no request IDs left to hand out.
+    """
+
+    pass
+
+
+class ConnectionClosedError(Exception):
+    """
+    Raised for requests and streams that were still waiting on the peer when
+    the connection went away.
+    """
+
+    pass
+
+
+class RequestTimeoutError(TimeoutError):
+    """
+    Raised when a request's deadline passes before its result arrives.
+    """
+
+    pass
+
+
+class RemoteError(Exception):
+    """
+    Raised when the peer answers a request with an error result. The error's
+    payload is available as ``payload``.
+    """
+
+    def __init__(self, payload):
+        super(RemoteError, self).__init__(bytes(payload))
+        self.payload = payload
+
+
+class RetryRequestedError(RemoteError):
+    """
+    Raised when the peer answers a request with a retry result, asking that
+    the request be sent again after ``wait`` milliseconds.
+    """
+
+    def __init__(self, wait, payload):
+        super(RetryRequestedError, self).__init__(payload)
+        self.wait = wait
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer sends us a protocol error, or sends something that
+    we can't make sense of. ``code`` holds the protocol error code.
+    """
+
+    def __init__(self, code, message=None):
+        super(ProtocolError, self).__init__(
+            message or "Protocol error {code}.".format(code=code))
+        self.code = code
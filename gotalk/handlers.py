@@ -0,0 +1,143 @@
+"""
+Registry of the operations and notifications a connection knows how to
+handle.
+"""
+
+import asyncio
+import functools
+
+
+class Handlers(object):
+    """
+    Maps operation and notification names to the callables that handle
+    them. One instance is typically shared by every connection of a server.
+
+    Request handlers are called with the request payload and return the
+    result payload. Stream handlers are called with a
+    :py:class:`gotalk.streams.Stream` of incoming payloads and return an
+    iterable or async iterable of result payloads. Notification handlers are
+    called with the notification payload, and whatever they return is
+    ignored. Any of them may be coroutine functions.
+
+    Payloads are handed over as ``memoryview`` slices of the receive buffer.
+    Call ``bytes()`` on one to get a copy that doesn't pin the buffer.
+
+    CPU-heavy request and notification handlers can be registered with
+    ``offload=True`` to run in an executor instead of on the event loop, so
+    that they don't hold up every other request on the connection. They're
+    passed ``bytes`` rather than a ``memoryview``, which also lets them run
+    in a ``ProcessPoolExecutor`` as long as they can be pickled.
+
+    Usage::
+
+        handlers = Handlers()
+
+        @handlers.request("echo")
+        async def echo(payload):
+            return payload
+
+        @handlers.request("resize", offload=True)
+        def resize(payload):
+            return make_thumbnail(payload)
+    """
+
+    def __init__(self, executor=None):
+        """
+        :param concurrent.futures.Executor executor: Where offloaded handlers
+            run, unless registered with an executor of their own. Defaults
+            to the event loop's default executor, a thread pool.
+        """
+
+        self.executor = executor
+        self.request_handlers = {}
+        self.stream_handlers = {}
+        self.notification_handlers = {}
+
+    def register_request(self, operation, handler, offload=False,
+                         executor=None):
+        """
+        :param str operation: The operation name to handle.
+        :param callable handler: Called with the payload of each request.
+            Returns the result payload: ``bytes``, a ``str``, an ``mmap``,
+            or a :py:class:`gotalk.payloads.FilePayload` to send part of a
+            file without reading it in.
+        :param bool offload: Run ``handler`` in an executor rather than on
+            the event loop. Implied by ``executor``.
+        :param concurrent.futures.Executor executor: The executor to run
+            ``handler`` in, rather than the default one.
+        """
+
+        if offload or executor is not None:
+            handler = self._offload(handler, executor)
+        self.request_handlers[operation] = handler
+
+    def register_stream(self, operation, handler):
+        """
+        :param str operation: The operation name to handle.
+        :param callable handler: Called with a ``Stream`` of request
+            payloads for each stream request. Returns (or is) an iterable or
+            async iterable of result payloads, or anything else
+            :py:func:`gotalk.payloads.iter_chunks` can split into parts,
+            such as an open file. Empty payloads are skipped, and big ones
+            are sent in chunks.
+        """
+
+        self.stream_handlers[operation] = handler
+
+    def register_notification(self, name, handler, offload=False,
+                              executor=None):
+        """
+        :param str name: The notification name to handle.
+        :param callable handler: Called with the payload of each
+            notification.
+        :param bool offload: Run ``handler`` in an executor rather than on
+            the event loop. Implied by ``executor``.
+        :param concurrent.futures.Executor executor: The executor to run
+            ``handler`` in, rather than the default one.
+        """
+
+        if offload or executor is not None:
+            handler = self._offload(handler, executor)
+        self.notification_handlers[name] = handler
+
+    def request(self, operation, offload=False, executor=None):
+        """
+        Decorator form of :py:meth:`register_request`.
+        """
+
+        def decorator(handler):
+            self.register_request(operation, handler, offload, executor)
+            return handler
+        return decorator
+
+    def stream(self, operation):
+        """
+        Decorator form of :py:meth:`register_stream`.
+        """
+
+        def decorator(handler):
+            self.register_stream(operation, handler)
+            return handler
+        return decorator
+
+    def notification(self, name, offload=False, executor=None):
+        """
+        Decorator form of :py:meth:`register_notification`.
+        """
+
+        def decorator(handler):
+            self.register_notification(name, handler, offload, executor)
+            return handler
+        return decorator
+
+    def _offload(self, handler, executor):
+        @functools.wraps(handler)
+        async def offloaded(payload):
+            # Looked up per call, so that the default can be changed after
+            # registering.
+            run_in = executor if executor is not None else self.executor
+            # A memoryview can't be pickled, and would pin the receive
+            # buffer for as long as the handler runs.
+            return await asyncio.get_running_loop().run_in_executor(
+                run_in, handler, bytes(payload))
+        return offloaded
@@ -0,0 +1,321 @@
+"""
+Counters and latency histograms for watching what connections are up to.
+"""
+
+import math
+
+from gotalk.exceptions import ConnectionClosedError, RequestTimeoutError, \
+    RetryRequestedError
+
+# How requests end, as passed to MetricsSink.request_finished() and
+# MetricsSink.handler_finished().
+OUTCOME_OK = "ok"
+OUTCOME_ERROR = "error"
+OUTCOME_RETRY = "retry"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_CLOSED = "closed"
+OUTCOME_CANCELLED = "cancelled"
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class MetricsSink(object):
+    """
+    Receives events from the connections it's passed to. Every method does
+    nothing, so sub-classes only need to override what they're interested
+    in, to forward events to statsd, Prometheus and the like.
+
+    Methods are called on the event loop, in the middle of reading and
+    writing messages, so they have to be quick.
+    """
+
+    def frame_sent(self, type_id, nbytes):
+        """
+        :param str type_id: The message type, from
+            ``gotalk.protocol.defines``.
+        :param int nbytes: The length of the whole message.
+        """
+
+    def frame_received(self, type_id, nbytes):
+        """
+        :param str type_id: The message type, from
+            ``gotalk.protocol.defines``.
+        :param int nbytes: The length of the whole message.
+        """
+
+    def request_started(self, operation):
+        """
+        We've sent a single request to the peer.
+
+        :param str operation: The operation requested.
+        """
+
+    def request_finished(self, operation, outcome, duration):
+        """
+        A single request we sent has been answered, or given up on.
+
+        :param str operation: The operation requested.
+        :param str outcome: One of the ``OUTCOME_*`` constants.
+        :param float duration: Seconds since it was sent.
+        """
+
+    def handler_started(self, operation):
+        """
+        We've started handling a single or stream request from the peer.
+
+        :param str operation: The operation requested.
+        """
+
+    def handler_finished(self, operation, outcome, duration):
+        """
+        We're done with a request from the peer. For stream requests, that's
+        once the last result part has been sent.
+
+        :param str operation: The operation requested.
+        :param str outcome: One of the ``OUTCOME_*`` constants.
+        :param float duration: Seconds since the handler was started.
+        """
+
+
+class LatencyHistogram(object):
+    """
+    Latencies in logarithmic buckets, each ``precision`` times wider than
+    the last, like HdrHistogram. Every percentile is within ``precision`` of
+    the true one, recording is O(1), and memory use doesn't grow with the
+    number of samples.
+    """
+
+    def __init__(self, precision=0.01, lowest=1e-6):
+        """
+        :param float precision: The relative error allowed.
+        :param float lowest: The smallest latency told apart from zero, in
+            seconds.
+        """
+
+        self.precision = precision
+        self.lowest = lowest
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._log_base = math.log1p(precision)
+        # bucket index -> samples.
+        self._counts = {}
+
+    def record(self, value, expected_interval=None):
+        """
+        :param float value: A latency, in seconds.
+        :param float expected_interval: If given, ``value`` is taken to have
+            held up samples that would otherwise have been taken every
+            ``expected_interval`` seconds, and those are recorded as well:
+            ``value - expected_interval``, ``value - 2 * expected_interval``
+            and so on, down to ``expected_interval``.
+        """
+
+        self._add(value)
+        if expected_interval:
+            missed = value - expected_interval
+            while missed >= expected_interval:
+                self._add(missed)
+                missed -= expected_interval
+
+    def merge(self, other):
+        """
+        Adds another histogram's samples to this one's.
+
+        :param LatencyHistogram other: Must have the same buckets.
+        """
+
+        for index, count in other._counts.items():
+            self._counts[index] = self._counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        """
+        :rtype: float
+        """
+
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        """
+        :param float percent: Between 0 and 100.
+        :rtype: float
+        :returns: The latency that ``percent`` percent of samples were at
+            or under, rounded up to its bucket's edge.
+        """
+
+        if not self.count:
+            return 0.0
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                return min(self.lowest * math.exp(index * self._log_base),
+                           self.max)
+        return self.max
+
+    def summary(self):
+        """
+        :rtype: dict
+        :returns: The count, mean, max and usual percentiles, in seconds.
+        """
+
+        summary = dict(
+            ("p{:g}".format(percent), self.percentile(percent))
+            for percent in PERCENTILES)
+        summary.update(count=self.count, mean=self.mean, max=self.max)
+        return summary
+
+    def _add(self, value):
+        if value <= self.lowest:
+            index = 0
+        else:
+            index = int(math.log(value / self.lowest) / self._log_base) + 1
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+class OperationMetrics(object):
+    """
+    What's been seen of one operation, from one end of the connection.
+    """
+
+    __slots__ = ('in_flight', 'outcomes', 'latency')
+
+    def __init__(self):
+        #: Requests started and not yet finished.
+        self.in_flight = 0
+        #: Outcome -> requests that finished that way.
+        self.outcomes = {}
+        #: Durations of finished requests.
+        self.latency = LatencyHistogram()
+
+    @property
+    def count(self):
+        """
+        :rtype: int
+        :returns: The number of requests finished.
+        """
+
+        return sum(self.outcomes.values())
+
+    def snapshot(self):
+        """
+        :rtype: dict
+        """
+
+        return {
+            "in_flight": self.in_flight,
+            "outcomes": dict(self.outcomes),
+            "latency": self.latency.summary(),
+        }
+
+
+class Metrics(MetricsSink):
+    """
+    Keeps everything in memory, in plain counters and
+    :py:class:`LatencyHistogram` buckets, cheap enough to leave on. Share
+    one between the connections on an event loop to see them all together.
+
+    Usage::
+
+        metrics = Metrics()
+        await start_server(
+            handlers, "0.0.0.0", 1234,
+            connection_class=lambda handlers: Connection(
+                handlers, metrics=metrics))
+        ...
+        print(metrics.snapshot())
+    """
+
+    def __init__(self):
+        #: Message type -> messages sent.
+        self.frames_sent = {}
+        #: Message type -> bytes sent.
+        self.bytes_sent = {}
+        #: Message type -> messages received.
+        self.frames_received = {}
+        #: Message type -> bytes received.
+        self.bytes_received = {}
+        #: Operation -> :py:class:`OperationMetrics` for requests we sent.
+        self.requests = {}
+        #: Operation -> :py:class:`OperationMetrics` for requests we handled.
+        self.handlers = {}
+
+    def frame_sent(self, type_id, nbytes):
+        self.frames_sent[type_id] = self.frames_sent.get(type_id, 0) + 1
+        self.bytes_sent[type_id] = self.bytes_sent.get(type_id, 0) + nbytes
+
+    def frame_received(self, type_id, nbytes):
+        self.frames_received[type_id] = \
+            self.frames_received.get(type_id, 0) + 1
+        self.bytes_received[type_id] = \
+            self.bytes_received.get(type_id, 0) + nbytes
+
+    def request_started(self, operation):
+        _get_operation(self.requests, operation).in_flight += 1
+
+    def request_finished(self, operation, outcome, duration):
+        _finish(_get_operation(self.requests, operation), outcome, duration)
+
+    def handler_started(self, operation):
+        _get_operation(self.handlers, operation).in_flight += 1
+
+    def handler_finished(self, operation, outcome, duration):
+        _finish(_get_operation(self.handlers, operation), outcome, duration)
+
+    def snapshot(self):
+        """
+        :rtype: dict
+        :returns: Everything recorded so far, as plain data that can be
+            serialized as JSON. Latencies are in seconds.
+        """
+
+        return {
+            "frames_sent": dict(self.frames_sent),
+            "bytes_sent": dict(self.bytes_sent),
+            "frames_received": dict(self.frames_received),
+            "bytes_received": dict(self.bytes_received),
+            "requests": dict(
+                (operation, stats.snapshot())
+                for operation, stats in self.requests.items()),
+            "handlers": dict(
+                (operation, stats.snapshot())
+                for operation, stats in self.handlers.items()),
+        }
+
+
+def get_outcome(exc):
+    """
+    :param Exception exc: What a request failed with.
+    :rtype: str
+    :returns: The matching ``OUTCOME_*`` constant.
+    """
+
+    if isinstance(exc, RetryRequestedError):
+        return OUTCOME_RETRY
+    if isinstance(exc, RequestTimeoutError):
+        return OUTCOME_TIMEOUT
+    if isinstance(exc, ConnectionClosedError):
+        return OUTCOME_CLOSED
+    return OUTCOME_ERROR
+
+
+def _get_operation(operations, operation):
+    stats = operations.get(operation)
+    if stats is None:
+        stats = operations[operation] = OperationMetrics()
+    return stats
+
+
+def _finish(stats, outcome, duration):
+    stats.in_flight -= 1
+    stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+    stats.latency.record(duration)
@@ -0,0 +1,227 @@
+"""
+Helpers for sending payloads too big to hold in memory, either as a stream
+of smaller parts or straight from a file.
+"""
+
+import mmap
+import os
+
+# Big enough to keep per-frame overhead negligible, small enough that a
+# handful of in-flight parts don't add up to much.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class FilePayload(object):
+    """
+    A payload that's a byte range of an open file. Connections send these
+    with ``sendfile()`` where the transport supports it, so the data goes
+    from the page cache to the socket without passing through Python.
+
+    Usage::
+
+        @handlers.request("artifact")
+        def artifact(payload):
+            return FilePayload.open(artifact_path(payload))
+
+    The size comes from the file's metadata, so nothing is read just to
+    check it against the protocol's payload limit. The file mustn't shrink
+    before the payload has been sent.
+    """
+
+    __slots__ = ('file', 'offset', 'length', '_owns_file')
+
+    def __init__(self, file, offset=0, length=None):
+        """
+        :param file: A file object opened in binary mode, or a file
+            descriptor. Either way it's left open once sent.
+        :param int offset: Where in the file the payload starts.
+        :param int length: The payload length. Defaults to the rest of the
+            file.
+        :raises: ValueError if the range isn't within the file.
+        """
+
+        if isinstance(file, int):
+            file = open(file, "rb", closefd=False)
+        size = os.fstat(file.fileno()).st_size
+        if not 0 <= offset <= size:
+            raise ValueError(
+                "Offset {offset} is outside of the file "
+                "({size} bytes).".format(offset=offset, size=size))
+        if length is None:
+            length = size - offset
+        elif not 0 <= length <= size - offset:
+            raise ValueError(
+                "{length} bytes at offset {offset} don't fit in the file "
+                "({size} bytes).".format(
+                    length=length, offset=offset, size=size))
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self._owns_file = False
+
+    @classmethod
+    def open(cls, path, offset=0, length=None):
+        """
+        Opens ``path`` for sending. Unlike a payload made from a file you
+        opened yourself, the file is closed once the payload has been sent.
+
+        :param str path: The file to send.
+        :param int offset: Where in the file the payload starts.
+        :param int length: The payload length. Defaults to the rest of the
+            file.
+        :rtype: FilePayload
+        """
+
+        f = open(path, "rb")
+        try:
+            payload = cls(f, offset, length)
+        except Exception:
+            f.close()
+            raise
+        payload._owns_file = True
+        return payload
+
+    def __len__(self):
+        return self.length
+
+    def __bytes__(self):
+        return b"".join(self.read_chunks())
+
+    def fileno(self):
+        """
+        :rtype: int
+        :returns: The underlying file descriptor.
+        """
+
+        return self.file.fileno()
+
+    def slice(self, start, length):
+        """
+        :param int start: Where the slice starts, relative to this payload.
+        :param int length: The length of the slice.
+        :rtype: FilePayload
+        :returns: A payload for part of this one's range, without reading
+            anything. If this payload closes its file once sent, a slice
+            that runs to the end of the range takes that over.
+        """
+
+        part = FilePayload.__new__(FilePayload)
+        part.file = self.file
+        part.offset = self.offset + start
+        part.length = max(0, min(length, self.length - start))
+        part._owns_file = self._owns_file and \
+            start + part.length >= self.length
+        return part
+
+    def read_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Reads the payload into memory a chunk at a time, for transports that
+        can't ``sendfile()``. Reads don't move the file position.
+
+        :param int chunk_size: The most bytes to read at once.
+        :returns: An iterator of ``bytes``.
+        """
+
+        fd = self.fileno()
+        position = self.offset
+        end = self.offset + self.length
+        while position < end:
+            chunk = os.pread(fd, min(chunk_size, end - position), position)
+            if not chunk:
+                raise ValueError("File shrank while it was being sent.")
+            position += len(chunk)
+            yield chunk
+
+    def read(self):
+        """
+        Reads the whole payload into memory, for writers that can only send
+        buffers, and closes the file as if it had been sent.
+
+        :rtype: bytes
+        """
+
+        try:
+            return b"".join(self.read_chunks())
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Called once the payload has been sent. Closes the file if it was
+        opened by :py:meth:`open`.
+        """
+
+        if self._owns_file:
+            self.file.close()
+
+
+def iter_chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Splits a payload source into parts of at most ``chunk_size`` bytes,
+    reading from it lazily. Nothing is copied for in-memory sources: their
+    parts are memoryview slices.
+
+    Usage::
+
+        with open("blob.bin", "rb") as f:
+            call = connection.stream_request("upload")
+            await call.send_from(f)
+            call.close()
+
+    :param source: ``bytes``, ``bytearray``, ``memoryview`` or ``mmap``; a
+        :py:class:`FilePayload`, which is split into smaller ranges of the
+        same file; a binary file object (anything with ``read()``); or an
+        iterable of any of the above, such as a generator. Strings in an
+        iterable are encoded as UTF-8.
+    :param int chunk_size: The largest part to yield.
+    :returns: An iterator of non-empty parts.
+    :raises: ValueError if ``chunk_size`` isn't positive.
+    """
+
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive.")
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return _iter_buffer_chunks(source, chunk_size)
+    if isinstance(source, FilePayload):
+        return _iter_file_payload_chunks(source, chunk_size)
+    if hasattr(source, "read"):
+        return _iter_file_chunks(source, chunk_size)
+    return _iter_iterable_chunks(source, chunk_size)
+
+
+def _iter_buffer_chunks(buffer, chunk_size):
+    view = memoryview(buffer)
+    try:
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+    finally:
+        # Let go of the export so an mmap can be closed afterwards.
+        view.release()
+
+
+def _iter_file_payload_chunks(payload, chunk_size):
+    if not len(payload):
+        # There's no last part to close the file once it's been sent.
+        payload.close()
+        return
+    for start in range(0, len(payload), chunk_size):
+        yield payload.slice(start, chunk_size)
+
+
+def _iter_file_chunks(f, chunk_size):
+    read = f.read
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_iterable_chunks(iterable, chunk_size):
+    for piece in iterable:
+        if isinstance(piece, str):
+            piece = piece.encode("utf-8")
+        if len(piece) > chunk_size:
+            yield from iter_chunks(piece, chunk_size)
+        elif len(piece):
+            yield piece
@@ -0,0 +1,63 @@
+"""
+Per-protocol-version lookup tables for message codecs.
+"""
+
+
+class CodecRegistry(object):
+    """
+    Maps the type byte at the start of each message straight to the functions
+    that handle it, so the hot decode paths cost a single dict lookup.
+
+    Tables are keyed by the integer value of the type byte, which is what
+    indexing into ``bytes``/``bytearray``/``memoryview`` gives you.
+    """
+
+    def __init__(self, proto_version):
+        """
+        :param str proto_version: The protocol version these codecs speak.
+        """
+
+        self.proto_version = proto_version
+        #: Type byte -> ``GotalkMessage`` sub-class.
+        self.message_classes = {}
+        #: Type byte -> the class's ``from_bytes``.
+        self.decoders = {}
+        #: Type byte -> the class's ``get_frame_length``.
+        self.frame_lengths = {}
+        #: Type byte -> the class's ``peek_header``.
+        self.header_readers = {}
+
+    def register(self, message_class, replace=False):
+        """
+        Adds a message type. Can be used as a class decorator.
+
+        :param type message_class: A ``GotalkMessage`` sub-class with a
+            ``type_id``.
+        :param bool replace: Allow replacing the codec for a type ID that's
+            already registered.
+        :returns: ``message_class``, unchanged.
+        :raises: ValueError if the type ID is taken and ``replace`` is false.
+        """
+
+        type_byte = ord(message_class.type_id)
+        existing = self.message_classes.get(type_byte)
+        if existing is not None and existing is not message_class and \
+                not replace:
+            raise ValueError(
+                "Message type {type_id!r} is already handled by "
+                "{existing}.".format(
+                    type_id=message_class.type_id, existing=existing.__name__))
+        self.message_classes[type_byte] = message_class
+        self.decoders[type_byte] = message_class.from_bytes
+        self.frame_lengths[type_byte] = message_class.get_frame_length
+        self.header_readers[type_byte] = message_class.peek_header
+        return message_class
+
+    def get_message_class(self, type_byte):
+        """
+        :param int type_byte: The first byte of a message.
+        :rtype: type or None
+        :returns: The registered ``GotalkMessage`` sub-class, if any.
+        """
+
+        return self.message_classes.get(type_byte)
@@ -13,17 +13,8 @@ ERROR_RESULT_TYPE = "E"
 PROTOCOL_ERROR_TYPE = "f"
 RETRY_RESULT_TYPE = "e"
 NOTIFICATION_TYPE = "n"
+HEARTBEAT_TYPE = "h"
 
-# Maps the single-character message type ID to some standardized class names
-# that we use for all versions of the protocol.
-MESSAGE_TYPE_TO_CLASS_MAP = {
-    SINGLE_REQUEST_TYPE: 'SingleRequestMessage',
-    SINGLE_RESULT_TYPE: 'SingleResultMessage',
-    STREAM_REQUEST_TYPE: 'StreamRequestMessage',
-    STREAM_REQUEST_PART_TYPE: 'StreamRequestPartMessage',
-    STREAM_RESULT_TYPE: 'StreamResultMessage',
-    ERROR_RESULT_TYPE: 'ErrorResultMessage',
-    PROTOCOL_ERROR_TYPE: 'ProtocolErrorMessage',
-    RETRY_RESULT_TYPE: 'RetryResultMessage',
-    NOTIFICATION_TYPE: 'NotificationMessage',
-}
+# Codes carried by protocol error messages.
+PROTOCOL_ERROR_UNSUPPORTED_VERSION = 1
+PROTOCOL_ERROR_INVALID_MESSAGE = 2
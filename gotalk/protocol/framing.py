@@ -0,0 +1,120 @@
+"""
+Incremental message framing for data that arrives in arbitrarily sized
+chunks, like socket reads.
+"""
+
+from gotalk.protocol.messages import get_codecs, read_headers, \
+    read_messages
+
+
+class FrameDecoder(object):
+    """
+    Stateful decoder that accepts chunks of any size and hands back complete
+    messages as soon as all of their bytes have arrived.
+
+    Incoming chunks are held in a list and only joined once there are enough
+    bytes to parse something, so a large message that trickles in over many
+    reads is copied into a single buffer once rather than once per read.
+    When the header of the next message has been seen, its full length is
+    remembered so that we don't look at the buffer again until that many
+    bytes are available.
+
+    Decoded payloads are ``memoryview`` slices of the joined receive buffer,
+    so holding on to a message keeps that buffer alive.
+
+    A lazy decoder only reads message headers, and hands back
+    ``MessageHeader`` instances instead of messages, for code that routes
+    messages without looking inside them.
+
+    Usage::
+
+        decoder = FrameDecoder("01")
+        for message in decoder.feed(chunk):
+            handle(message)
+    """
+
+    def __init__(self, proto_version, pool=None, lazy=False):
+        """
+        :param str proto_version: The protocol version to use in the exchange.
+        :param MessagePool pool: If given, messages may be recycled instances
+            from this pool. See ``gotalk.protocol.pool.MessagePool``.
+        :param bool lazy: Hand back ``MessageHeader`` instances rather than
+            fully decoded messages. See
+            ``gotalk.protocol.messages.peek_header()``.
+        """
+
+        self.proto_version = proto_version
+        self.pool = pool
+        self.lazy = lazy
+        self._frame_lengths = get_codecs(proto_version).frame_lengths
+        self._chunks = []
+        self._buffered = 0
+        # Number of buffered bytes required before it's worth parsing again.
+        self._needed = 1
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of bytes buffered towards incomplete messages.
+        """
+
+        return self._buffered
+
+    def feed(self, chunk, frame_sizes=None):
+        """
+        Adds a chunk of received data to the decoder.
+
+        :param bytes chunk: The next chunk of data, in the order it was
+            received. A ``bytearray`` or ``memoryview`` chunk is copied on
+            arrival, so it's safe to re-use the underlying buffer afterwards.
+        :param list frame_sizes: If given, the length in bytes of every
+            message returned is appended to it.
+        :rtype: list
+        :returns: A list of ``GotalkMessage`` instances, or ``MessageHeader``
+            instances for a lazy decoder, that were completed by this chunk.
+            May be empty.
+        :raises: InvalidMessageTypeIDError if the data doesn't look like a
+            gotalk message.
+        :raises: InvalidPayloadError if a message's header is malformed.
+        """
+
+        if not chunk:
+            return []
+        if type(chunk) is not bytes:
+            chunk = bytes(chunk)
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered < self._needed:
+            return []
+
+        if len(self._chunks) == 1:
+            buf = chunk
+        else:
+            buf = b"".join(self._chunks)
+        buf_length = len(buf)
+
+        if self.lazy:
+            messages, offset = read_headers(
+                buf, self.proto_version, frame_sizes)
+        else:
+            messages, offset = read_messages(
+                buf, self.proto_version, self.pool, frame_sizes)
+        if offset < buf_length:
+            frame_length = self._frame_lengths[buf[offset]](buf, offset)
+            if frame_length is None:
+                # The header itself is incomplete. It's short, so we'll just
+                # try again once anything else arrives.
+                self._needed = buf_length - offset + 1
+            else:
+                self._needed = frame_length
+        else:
+            self._needed = 1
+
+        if offset == buf_length:
+            self._chunks = []
+        elif offset == 0:
+            self._chunks = [buf]
+        else:
+            self._chunks = [memoryview(buf)[offset:]]
+        self._buffered = buf_length - offset
+        return messages
@@ -3,61 +3,258 @@ The top-level API for Gotalk message marshalling/unmarshalling.
 """
 
 from gotalk.exceptions import InvalidMessageTypeIDError, \
-    InvalidProtocolVersionError
+    InvalidPayloadError, InvalidProtocolVersionError
+from gotalk.payloads import FilePayload
 from gotalk.protocol import version01
-from gotalk.protocol.defines import MESSAGE_TYPE_TO_CLASS_MAP
 
 PROTOCOL_VERSION_MAP = {
     "01": version01,
 }
 
+# Buffers smaller than this get copied together when coalescing writes.
+# Anything bigger is passed along by reference.
+WRITE_COPY_THRESHOLD = 16384
+
 
 def read_version_message(m_bytes):
     """
     Communication alway starts with an exchange of the protocol version.
     Hopefully this won't ever change...
 
-    :param str m_bytes: The byte string to parse.
-    :rtype: int
+    :param bytes m_bytes: The byte string to parse.
+    :rtype: str
     :returns: The version number shared in the message.
     :raises: InvalidProtocolVersionError if the version is mal-formed.
     """
 
     if len(m_bytes) != 2:
         raise InvalidProtocolVersionError()
-    version_str = m_bytes[0:2]
+    try:
+        version_str = str(m_bytes[0:2], 'ascii')
+    except UnicodeDecodeError:
+        raise InvalidProtocolVersionError()
     return version_str
 
 
-def read_message(m_bytes, proto_version):
+def get_codecs(proto_version):
+    """
+    :param str proto_version: The protocol version to use in the exchange.
+    :rtype: gotalk.protocol.codecs.CodecRegistry
+    :returns: The message codecs for the protocol version.
+    :raises: InvalidProtocolVersionError if we don't know how to handle
+        the encountered version.
+    """
+
+    try:
+        return PROTOCOL_VERSION_MAP[proto_version].codecs
+    except KeyError:
+        # TODO: Depending on the backwards-compatibility policy with gotalk,
+        # we might be able to fall back to the latest known version and
+        # potentially limp along. Too early to know.
+        raise InvalidProtocolVersionError("Invalid gotalk protocol version.")
+
+
+def register_message_type(message_class, replace=False):
+    """
+    Teaches the message layer about a new message type, for the protocol
+    version given by the class's ``protocol_version``.
+
+    :param type message_class: A ``GotalkMessage`` sub-class with a
+        ``type_id``, ``from_bytes()`` and ``get_frame_length()``.
+    :param bool replace: Allow replacing the codec for a type ID that's
+        already registered.
+    :returns: ``message_class``, so this can be used as a class decorator.
+    """
+
+    codecs = get_codecs(message_class.protocol_version)
+    return codecs.register(message_class, replace=replace)
+
+
+def get_message_class(type_id, proto_version):
+    """
+    Looks up the ``GotalkMessage`` sub-class that handles a message type.
+
+    :param str type_id: The single-character message type ID.
+    :param str proto_version: The protocol version to use in the exchange.
+    :rtype: type
+    :returns: One of the ``GotalkMessage`` sub-classes.
+    :raises: InvalidProtocolVersionError if we don't know how to handle
+        the encountered version.
+    :raises: InvalidMessageTypeIDError if the type ID isn't one we know.
+    """
+
+    msg_class = get_codecs(proto_version).get_message_class(ord(type_id))
+    if msg_class is None:
+        raise InvalidMessageTypeIDError()
+    return msg_class
+
+
+def read_message(m_bytes, proto_version, pool=None):
     """
     Parses a messages, spitting out a properly formed instance of the
     appropriate ``GotalkMessage`` sub-class.
 
-    :param str m_bytes: The unmodified m_bytes to parse.
+    :param bytes m_bytes: The unmodified m_bytes to parse. Anything that
+        supports the buffer protocol (``bytearray``, ``memoryview``) works,
+        and the message's payload will be a ``memoryview`` slice of it.
     :param str proto_version: The protocol version to use in the exchange.
+    :param MessagePool pool: If given, the message may be a recycled
+        instance from this pool. See ``gotalk.protocol.pool.MessagePool``.
     :rtype: GotalkMessage
     :returns: One of the ``GotalkMessage` sub-class.
     :raises: InvalidProtocolVersionError if we don't know how to handle
         the encountered version.
+    :raises: InvalidMessageTypeIDError if the type ID isn't one we know.
     """
 
-    # This is the sub-module for the specified proto version.
+    codecs = get_codecs(proto_version)
     try:
-        proto_module = PROTOCOL_VERSION_MAP[proto_version]
+        if pool is not None:
+            return pool.read(codecs.message_classes[m_bytes[0]], m_bytes)
+        decoder = codecs.decoders[m_bytes[0]]
     except KeyError:
-        # TODO: Depending on the backwards-compatibility policy with gotalk,
-        # we might be able to fall back to the latest known version and
-        # potentially limp along. Too early to know.
-        raise InvalidProtocolVersionError("Invalid gotalk protocol version.")
+        raise InvalidMessageTypeIDError()
+    return decoder(m_bytes)
+
+
+def peek_header(m_bytes, proto_version, offset=0):
+    """
+    Reads just the header of a message: its type, request ID, operation or
+    notification name, and lengths. Enough to route or filter a message by,
+    at a cost that doesn't depend on the size of its payload.
+
+    :param bytes m_bytes: A buffer holding at least the message's header.
+        Anything that supports the buffer protocol works.
+    :param str proto_version: The protocol version to use in the exchange.
+    :param int offset: Where in ``m_bytes`` the message starts.
+    :rtype: MessageHeader or None
+    :returns: The header, or ``None`` if ``m_bytes`` doesn't hold all of it
+        yet. See ``gotalk.protocol.version01.MessageHeader``.
+    :raises: InvalidProtocolVersionError if we don't know how to handle
+        the encountered version.
+    :raises: InvalidMessageTypeIDError if the type ID isn't one we know.
+    """
 
-    type_id = m_bytes[0]
+    codecs = get_codecs(proto_version)
+    if offset >= len(m_bytes):
+        # Not even the type ID has arrived yet.
+        return None
     try:
-        msg_class_name = MESSAGE_TYPE_TO_CLASS_MAP[type_id]
+        reader = codecs.header_readers[m_bytes[offset]]
     except KeyError:
         raise InvalidMessageTypeIDError()
-    msg_class = getattr(proto_module, msg_class_name)
-    return msg_class.from_bytes(m_bytes)
+    return reader(m_bytes, offset)
+
+
+def read_headers(m_bytes, proto_version, frame_sizes=None):
+    """
+    Like :py:func:`read_messages`, but only reads the headers of the
+    messages, and leaves their payloads where they are in ``m_bytes``.
+
+    :param bytes m_bytes: The buffer to parse. Anything that supports the
+        buffer protocol works.
+    :param str proto_version: The protocol version to use in the exchange.
+    :param list frame_sizes: If given, the length in bytes of every message
+        is appended to it, in the same order as the headers.
+    :rtype: tuple
+    :returns: A ``(headers, consumed)`` tuple, where ``headers`` is a list
+        of ``MessageHeader`` instances for every complete message, and
+        ``consumed`` is the number of bytes those messages took up.
+    :raises: InvalidProtocolVersionError if we don't know how to handle
+        the encountered version.
+    :raises: InvalidMessageTypeIDError if the type ID isn't one we know.
+    :raises: InvalidPayloadError if a message's header is malformed.
+    """
+
+    header_readers = get_codecs(proto_version).header_readers
+    headers = []
+    offset = 0
+    buf_length = len(m_bytes)
+    while offset < buf_length:
+        try:
+            reader = header_readers[m_bytes[offset]]
+        except KeyError:
+            raise InvalidMessageTypeIDError()
+        header = reader(m_bytes, offset)
+        if header is None:
+            break
+        frame_length = _check_frame_length(header.frame_length)
+        if offset + frame_length > buf_length:
+            break
+        headers.append(header)
+        if frame_sizes is not None:
+            frame_sizes.append(frame_length)
+        offset += frame_length
+    return headers, offset
+
+
+def read_messages(m_bytes, proto_version, pool=None, frame_sizes=None):
+    """
+    Parses every complete message at the start of a buffer, such as the
+    result of a socket read that picked up many small messages at once.
+
+    Messages are decoded in place, with a cursor walking through the buffer,
+    rather than slicing each message out of it first. Payloads are
+    ``memoryview`` slices of ``m_bytes``.
+
+    :param bytes m_bytes: The buffer to parse. Anything that supports the
+        buffer protocol works.
+    :param str proto_version: The protocol version to use in the exchange.
+    :param MessagePool pool: If given, messages may be recycled instances
+        from this pool. See ``gotalk.protocol.pool.MessagePool``.
+    :param list frame_sizes: If given, the length in bytes of every message
+        parsed is appended to it, in the same order as the messages.
+    :rtype: tuple
+    :returns: A ``(messages, consumed)`` tuple, where ``messages`` is a list
+        of ``GotalkMessage`` instances and ``consumed`` is the number of
+        bytes they took up. Anything after that is an incomplete message.
+    :raises: InvalidProtocolVersionError if we don't know how to handle
+        the encountered version.
+    :raises: InvalidMessageTypeIDError if the type ID isn't one we know.
+    :raises: InvalidPayloadError if a message's header is malformed.
+    """
+
+    codecs = get_codecs(proto_version)
+    decoders = codecs.decoders
+    frame_lengths = codecs.frame_lengths
+    messages = []
+    append = messages.append
+    offset = 0
+    buf_length = len(m_bytes)
+    while offset < buf_length:
+        type_byte = m_bytes[offset]
+        try:
+            get_frame_length = frame_lengths[type_byte]
+        except KeyError:
+            raise InvalidMessageTypeIDError()
+        frame_length = get_frame_length(m_bytes, offset)
+        if frame_length is None:
+            break
+        if offset + _check_frame_length(frame_length) > buf_length:
+            break
+        if pool is None:
+            append(decoders[type_byte](m_bytes, offset))
+        else:
+            append(pool.read(
+                codecs.message_classes[type_byte], m_bytes, offset))
+        if frame_sizes is not None:
+            frame_sizes.append(frame_length)
+        offset += frame_length
+    return messages, offset
+
+
+def _check_frame_length(frame_length):
+    """
+    Makes sure that a message's frame length moves us forward through the
+    buffer, so that a bad header can't stall a decoding loop.
+
+    :raises: InvalidPayloadError if the frame length isn't positive.
+    """
+
+    if frame_length < 1:
+        raise InvalidPayloadError(
+            "Invalid frame length: {}".format(frame_length))
+    return frame_length
 
 
 def write_message(message):
@@ -65,8 +262,70 @@ def write_message(message):
     Given a message, dump it to bytes.
 
     :param message: An instance of a GotalkMessage child.
-    :rtype: str
+    :rtype: bytes
     :returns: The bytes to send for the given message.
     """
 
     return message.to_bytes()
+
+
+def write_message_buffers(message):
+    """
+    Given a message, dump it to a list of buffers without joining the header
+    and payload. See ``GotalkMessage.to_buffers()``.
+
+    :param message: An instance of a GotalkMessage child.
+    :rtype: list
+    :returns: The buffers to send, in order, for the given message.
+    """
+
+    return message.to_buffers()
+
+
+def coalesce_buffers(buffers, copy_threshold=WRITE_COPY_THRESHOLD):
+    """
+    Packs runs of small buffers together so that they can be written with
+    one syscall and a short ``writev`` vector. Large buffers are kept as-is
+    rather than copied. A ``FilePayload`` can't be written like the rest,
+    so it's read into memory, then closed.
+
+    :param iterable buffers: The buffers to send, in order.
+    :param int copy_threshold: Buffers at least this long aren't copied.
+    :rtype: list
+    :returns: A list of buffers with the same contents, in the same order.
+    """
+
+    coalesced = []
+    pending = bytearray()
+    for buf in buffers:
+        if buf.__class__ is FilePayload:
+            buf = buf.read()
+        if len(buf) < copy_threshold:
+            pending += buf
+        else:
+            if pending:
+                coalesced.append(pending)
+                pending = bytearray()
+            coalesced.append(buf)
+    if pending:
+        coalesced.append(pending)
+    return coalesced
+
+
+def write_messages(messages, copy_threshold=WRITE_COPY_THRESHOLD):
+    """
+    Dumps a batch of messages to a short list of buffers, ready to be sent
+    with a single ``writelines()``/``sendmsg()`` call. Headers and small
+    payloads are packed into shared ``bytearray`` buffers, while large
+    payloads are passed through without being copied.
+
+    :param iterable messages: GotalkMessage instances to send, in order.
+    :param int copy_threshold: Payloads at least this long aren't copied.
+    :rtype: list
+    :returns: The buffers to send, in order.
+    """
+
+    buffers = []
+    for message in messages:
+        buffers.extend(message.to_buffers())
+    return coalesce_buffers(buffers, copy_threshold)
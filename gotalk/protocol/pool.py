@@ -0,0 +1,81 @@
+"""
+Recycling of decoded message objects.
+"""
+
+
+class MessagePool(object):
+    """
+    Bounded free-lists of message instances, one per message class.
+
+    When a pool is passed to :py:func:`gotalk.protocol.messages.read_message`
+    and friends, decoded messages re-use instances that were handed back with
+    :py:meth:`release` instead of allocating new ones. This is only safe if
+    nothing holds on to a message after releasing it, so it's opt-in.
+
+    Usage::
+
+        pool = MessagePool()
+        for message in read_messages(m_bytes, "01", pool=pool)[0]:
+            handle(message.request_id, message.payload)
+            pool.release(message)
+    """
+
+    def __init__(self, max_size=1024):
+        """
+        :param int max_size: The most instances to keep around per message
+            class. Releasing beyond that just lets the instance be freed.
+        """
+
+        self.max_size = max_size
+        self._free = {}
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of instances waiting to be re-used.
+        """
+
+        return sum(len(free) for free in self._free.values())
+
+    def read(self, message_class, m_bytes, offset=0):
+        """
+        Parses a message into a recycled instance if one is available.
+
+        :param type message_class: The class of the message at ``offset``.
+        :param bytes m_bytes: The buffer to parse.
+        :param int offset: Where in ``m_bytes`` the message starts.
+        :returns: An instance of ``message_class``.
+        """
+
+        read_fields = getattr(message_class, '_read_fields', None)
+        if read_fields is None:
+            return message_class.from_bytes(m_bytes, offset)
+        fields = read_fields(m_bytes, offset)
+        free = self._free.get(message_class)
+        if not free:
+            return message_class(*fields)
+        message = free.pop()
+        message.__init__(*fields)
+        return message
+
+    def release(self, message):
+        """
+        Hands a message back for re-use. The message's payload reference is
+        dropped right away, so it no longer keeps the receive buffer alive.
+        Don't touch the message after releasing it.
+        """
+
+        free = self._free.get(message.__class__)
+        if free is None:
+            free = self._free[message.__class__] = []
+        if len(free) < self.max_size:
+            if hasattr(message, 'payload'):
+                message.payload = None
+            free.append(message)
+
+    def clear(self):
+        """
+        Drops every pooled instance.
+        """
+
+        self._free.clear()
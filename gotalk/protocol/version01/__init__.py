@@ -2,4 +2,4 @@ from . messages import GotalkMessage, GotalkRequestMessage, GotalkResultMessage,
     ProtocolVersionMessage, SingleRequestMessage, SingleResultMessage, \
     StreamRequestMessage, StreamRequestPartMessage, StreamResultMessage, \
     ErrorResultMessage, RetryResultMessage, NotificationMessage, \
-    ProtocolErrorMessage
+    ProtocolErrorMessage, HeartbeatMessage, MessageHeader, codecs
@@ -2,10 +2,145 @@
 Version 00 message marshalling/unmarshalling.
 """
 
-from gotalk.exceptions import PayloadTooLongError, OperationTooLongError
+import time
+
+from gotalk.exceptions import PayloadTooLongError, OperationTooLongError, \
+    InvalidPayloadError, InvalidRequestIDError
+from gotalk.payloads import FilePayload
+from gotalk.protocol.codecs import CodecRegistry
 from gotalk.protocol.defines import SINGLE_REQUEST_TYPE, SINGLE_RESULT_TYPE, \
     STREAM_REQUEST_TYPE, STREAM_REQUEST_PART_TYPE, STREAM_RESULT_TYPE, \
-    ERROR_RESULT_TYPE, NOTIFICATION_TYPE, RETRY_RESULT_TYPE, PROTOCOL_ERROR_TYPE
+    ERROR_RESULT_TYPE, NOTIFICATION_TYPE, RETRY_RESULT_TYPE, \
+    PROTOCOL_ERROR_TYPE, HEARTBEAT_TYPE
+from gotalk.request_ids import REQUEST_ID_LENGTH, format_request_id
+
+
+_HEX_DIGITS = b"0123456789abcdefABCDEF"
+
+
+def _read_hex(m_bytes, start, end):
+    """
+    Parses a fixed-width hex field. ``bytes()`` is a no-op for ``bytes``
+    input, and only copies the few header bytes for a ``memoryview``.
+
+    ``int()`` on its own would also take signs, whitespace, underscores and
+    a ``0x`` prefix, so that a field like ``-000000d`` could make a message
+    look shorter than its header.
+
+    :raises: InvalidPayloadError if the field isn't all hex digits.
+    """
+
+    field = bytes(m_bytes[start:end])
+    if not field or field.translate(None, _HEX_DIGITS):
+        raise InvalidPayloadError("Invalid hex field: {!r}".format(field))
+    return int(field, 16)
+
+
+def _read_text(m_bytes, start, end):
+    return str(m_bytes[start:end], 'utf-8')
+
+
+def _encode_text(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+def _coerce_payload(payload):
+    """
+    Payloads are sent as-is if they support the buffer protocol (``bytes``,
+    ``bytearray``, ``memoryview``, ...). Text is encoded as UTF-8.
+    """
+
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    return payload
+
+
+class MessageHeader(object):
+    """
+    The header fields of a message, read without decoding the rest of it.
+    The payload is only sliced out of the buffer when it's asked for, and
+    the full message only decoded by :py:meth:`decode`, so peeking at a
+    message costs the same however big its payload is.
+
+    Fields that the message type doesn't have are ``None``.
+    """
+
+    __slots__ = ('message_class', 'request_id', 'operation', 'name',
+                 'header_length', 'payload_length', '_buffer', '_offset')
+
+    def __init__(self, message_class, m_bytes, offset, header_length,
+                 payload_length, request_id=None, operation=None, name=None):
+        """
+        :param type message_class: The message's ``GotalkMessage`` class.
+        :param bytes m_bytes: The buffer holding the message.
+        :param int offset: Where in ``m_bytes`` the message starts.
+        :param int header_length: Bytes before the payload.
+        :param int payload_length: Bytes of payload.
+        """
+
+        self.message_class = message_class
+        self.request_id = request_id
+        self.operation = operation
+        self.name = name
+        self.header_length = header_length
+        self.payload_length = payload_length
+        self._buffer = m_bytes
+        self._offset = offset
+
+    @property
+    def type_id(self):
+        """
+        :rtype: str
+        :returns: The message type, from ``gotalk.protocol.defines``.
+        """
+
+        return self.message_class.type_id
+
+    @property
+    def frame_length(self):
+        """
+        :rtype: int
+        :returns: The length of the whole message.
+        """
+
+        return self.header_length + self.payload_length
+
+    @property
+    def payload(self):
+        """
+        :rtype: memoryview
+        :returns: A view of the payload within the buffer.
+        :raises: InvalidPayloadError if the buffer doesn't hold all of it.
+        """
+
+        start = self._offset + self.header_length
+        return _slice_frame(self._buffer, start, self.payload_length)
+
+    @property
+    def frame(self):
+        """
+        :rtype: memoryview
+        :returns: A view of the whole message within the buffer, for passing
+            it along as it is.
+        :raises: InvalidPayloadError if the buffer doesn't hold all of it.
+        """
+
+        return _slice_frame(self._buffer, self._offset, self.frame_length)
+
+    def decode(self):
+        """
+        :returns: The full message, as a ``GotalkMessage`` instance.
+        """
+
+        return self.message_class.from_bytes(self._buffer, self._offset)
+
+
+def _slice_frame(m_bytes, start, length):
+    if len(m_bytes) < start + length:
+        raise InvalidPayloadError("Payload is truncated.")
+    return memoryview(m_bytes)[start:start + length]
 
 
 class GotalkMessage(object):
@@ -13,6 +148,8 @@ class GotalkMessage(object):
     .. tip:: Don't use this class directly!
     """
 
+    __slots__ = ()
+
     protocol_version = "01"
     payload_max_length = 4294967295
 
@@ -20,8 +157,24 @@ class GotalkMessage(object):
     _request_id_end = 5
     _payload_length_bytes = 8
 
+    def __init_subclass__(cls, **kwargs):
+        super(GotalkMessage, cls).__init_subclass__(**kwargs)
+        # Encode the type ID once per class rather than once per message.
+        type_id = getattr(cls, 'type_id', None)
+        if type_id is not None:
+            cls._type_prefix = type_id.encode('ascii')
+
     def _pad_request_id(self, request_id):
-        return str(request_id).zfill(3)
+        if isinstance(request_id, int):
+            return format_request_id(request_id)
+        if isinstance(request_id, str):
+            request_id = request_id.encode('ascii')
+        request_id = bytes(request_id).zfill(REQUEST_ID_LENGTH)
+        if len(request_id) != REQUEST_ID_LENGTH:
+            raise InvalidRequestIDError(
+                "Request IDs must be 4 bytes, got {request_id!r}.".format(
+                    request_id=request_id))
+        return request_id
 
     def _check_payload_length(self, payload):
         payload_length = len(payload)
@@ -30,14 +183,171 @@ class GotalkMessage(object):
                 "Payload length limit exceeded. Must be < 4 GB.")
         return payload_length
 
+    def _get_header(self, payload_length):
+        """
+        :param int payload_length: The length of the payload that will
+            follow the header.
+        :rtype: bytes
+        :returns: Everything that goes on the wire before the payload.
+        """
+
+        return b"%s%s%08x" % (
+            self._type_prefix,
+            self._pad_request_id(self.request_id), payload_length)
+
+    def to_buffers(self):
+        """
+        Encodes the message as a short header followed by the payload object
+        itself, without concatenating them. Hand the result to
+        ``socket.sendmsg()`` or ``transport.writelines()`` to avoid copying
+        large payloads just to put a header in front of them.
+
+        :rtype: list
+        :returns: The header ``bytes``, followed by the payload if it isn't
+            empty. An empty ``FilePayload`` is closed, as it's already been
+            sent in full.
+        """
+
+        payload = _coerce_payload(self.payload)
+        payload_length = self._check_payload_length(payload)
+        header = self._get_header(payload_length)
+        if not payload_length:
+            if payload.__class__ is FilePayload:
+                payload.close()
+            return [header]
+        return [header, payload]
+
+    def to_bytes(self):
+        """
+        :rtype: bytes
+        :returns: The full encoded message. A ``FilePayload`` is read into
+            memory, then closed.
+        """
+
+        buffers = self.to_buffers()
+        if buffers[-1].__class__ is FilePayload:
+            buffers[-1] = buffers[-1].read()
+        return b"".join(buffers)
+
+    @classmethod
+    def from_bytes(cls, m_bytes, offset=0):
+        """
+        Parses the message that starts at ``offset`` in ``m_bytes``.
+
+        :param bytes m_bytes: The buffer to parse. Anything that supports the
+            buffer protocol works.
+        :param int offset: Where in ``m_bytes`` the message starts.
+        :returns: An instance of this class. Its payload is a
+            ``memoryview`` slice of ``m_bytes``.
+        """
+
+        return cls(*cls._read_fields(m_bytes, offset))
+
     @classmethod
-    def _get_request_id_from_bytes(cls, m_bytes):
-        return m_bytes[cls._request_id_start:cls._request_id_end]
+    def peek_header(cls, m_bytes, offset=0):
+        """
+        Reads the header of the message that starts at ``offset``, leaving
+        the payload alone. Only the header has to be in ``m_bytes``.
+
+        :param bytes m_bytes: The buffer to parse. Anything that supports the
+            buffer protocol works.
+        :param int offset: Where in ``m_bytes`` the message starts.
+        :rtype: MessageHeader or None
+        :returns: The header, or ``None`` if ``m_bytes`` doesn't hold all of
+            it yet.
+        """
+
+        fields = cls._peek_fields(m_bytes, offset)
+        if fields is None:
+            return None
+        request_id, operation, name, payload_length_start = fields
+        header_end = payload_length_start + cls._payload_length_bytes
+        if len(m_bytes) < header_end:
+            return None
+        return MessageHeader(
+            cls, m_bytes, offset, header_end - offset,
+            _read_hex(m_bytes, payload_length_start, header_end),
+            request_id, operation, name)
+
+    @classmethod
+    def _read_fields(cls, m_bytes, offset=0):
+        """
+        :returns: A tuple of the constructor arguments encoded in the message
+            that starts at ``offset`` in ``m_bytes``.
+        """
+
+        raise NotImplementedError()
+
+    @classmethod
+    def _peek_fields(cls, m_bytes, offset=0):
+        """
+        Reads everything in the header up to the payloadSize field in one
+        go, for :py:meth:`peek_header`.
+
+        :returns: A ``(request_id, operation, name, payload_length_start)``
+            tuple, with ``None`` for the fields the message doesn't have, or
+            ``None`` if more bytes are needed to find the payloadSize field.
+        """
+
+        return (cls._get_request_id_from_bytes(m_bytes, offset), None, None,
+                cls._get_payload_length_start(m_bytes, offset))
+
+    @classmethod
+    def _get_request_id_from_bytes(cls, m_bytes, offset=0):
+        return bytes(m_bytes[offset + cls._request_id_start:
+                             offset + cls._request_id_end])
 
     @classmethod
     def _get_payload_from_bytes(cls, m_bytes, payload_length_start):
+        """
+        :rtype: memoryview
+        :returns: A zero-copy view of the payload within ``m_bytes``.
+        :raises: InvalidPayloadError if ``m_bytes`` is shorter than the
+            payloadSize field says it should be.
+        """
+
+        payload_length_end = payload_length_start + cls._payload_length_bytes
+        payload_length = _read_hex(
+            m_bytes, payload_length_start, payload_length_end)
+        payload_end = payload_length_end + payload_length
+        if len(m_bytes) < payload_end:
+            raise InvalidPayloadError("Payload is truncated.")
+        return memoryview(m_bytes)[payload_length_end:payload_end]
+
+    @classmethod
+    def _get_payload_length_start(cls, m_bytes, offset):
+        """
+        :returns: The offset of the payloadSize field for the message that
+            starts at ``offset``, or ``None`` if more bytes are needed to
+            find it.
+        """
+
+        return offset + cls._request_id_end
+
+    @classmethod
+    def get_frame_length(cls, m_bytes, offset=0):
+        """
+        Uses the header fields of the message starting at ``offset`` to
+        figure out how long the whole message is, without touching the
+        payload.
+
+        :param bytes m_bytes: A buffer holding at least the start of a
+            message. Anything supporting the buffer protocol works.
+        :param int offset: Where in ``m_bytes`` the message starts.
+        :rtype: int or None
+        :returns: The length of the full message, or ``None`` if the header
+            in ``m_bytes`` is incomplete.
+        """
+
+        payload_length_start = cls._get_payload_length_start(m_bytes, offset)
+        if payload_length_start is None:
+            return None
         payload_length_end = payload_length_start + cls._payload_length_bytes
-        return m_bytes[payload_length_end:]
+        if len(m_bytes) < payload_length_end:
+            return None
+        payload_length = _read_hex(
+            m_bytes, payload_length_start, payload_length_end)
+        return payload_length_end - offset + payload_length
 
 
 class GotalkRequestMessage(GotalkMessage):
@@ -45,6 +355,8 @@ class GotalkRequestMessage(GotalkMessage):
     .. tip:: Don't use this class directly!
     """
 
+    __slots__ = ()
+
     operation_max_length = 4095
 
     _operation_length_bytes = 3
@@ -59,20 +371,43 @@ class GotalkRequestMessage(GotalkMessage):
         return operation_length
 
     @classmethod
-    def _get_operation_from_bytes(cls, m_bytes):
-        op_length_hex = m_bytes[cls._operation_length_start:cls._operation_length_end]
-        operation_length = int(op_length_hex, 16)
-        operation_end = cls._operation_length_end + operation_length
-        operation = m_bytes[cls._operation_length_end: operation_end]
+    def _get_operation_from_bytes(cls, m_bytes, offset=0):
+        operation_start = offset + cls._operation_length_end
+        operation_length = _read_hex(
+            m_bytes, offset + cls._operation_length_start, operation_start)
+        operation_end = operation_start + operation_length
+        operation = _read_text(m_bytes, operation_start, operation_end)
         return operation, operation_end
 
+    @classmethod
+    def _peek_fields(cls, m_bytes, offset=0):
+        operation_start = offset + cls._operation_length_end
+        if len(m_bytes) < operation_start:
+            return None
+        operation_end = operation_start + _read_hex(
+            m_bytes, offset + cls._operation_length_start, operation_start)
+        # Decoding a partial operation could split a UTF-8 sequence.
+        if len(m_bytes) < operation_end:
+            return None
+        return (cls._get_request_id_from_bytes(m_bytes, offset),
+                _read_text(m_bytes, operation_start, operation_end), None,
+                operation_end)
+
+    @classmethod
+    def _get_payload_length_start(cls, m_bytes, offset):
+        op_length_end = offset + cls._operation_length_end
+        if len(m_bytes) < op_length_end:
+            return None
+        return op_length_end + _read_hex(
+            m_bytes, offset + cls._operation_length_start, op_length_end)
+
 
 class GotalkResultMessage(GotalkMessage):
     """
     .. tip:: Don't use this class directly!
     """
 
-    pass
+    __slots__ = ()
 
 
 class ProtocolVersionMessage(GotalkMessage):
@@ -80,8 +415,13 @@ class ProtocolVersionMessage(GotalkMessage):
     ProtocolVersion = <hexdigit> <hexdigit>
     """
 
+    __slots__ = ()
+
     def to_bytes(self):
-        return self.protocol_version
+        return self.protocol_version.encode('ascii')
+
+    def to_buffers(self):
+        return [self.to_bytes()]
 
 
 class ProtocolErrorMessage(GotalkMessage):
@@ -103,6 +443,8 @@ class ProtocolErrorMessage(GotalkMessage):
     f00000001
     """
 
+    __slots__ = ('code',)
+
     type_id = PROTOCOL_ERROR_TYPE
 
     _code_bytes = 8
@@ -112,13 +454,27 @@ class ProtocolErrorMessage(GotalkMessage):
     def __init__(self, code):
         self.code = code
 
+    @classmethod
+    def get_frame_length(cls, m_bytes, offset=0):
+        return cls._code_end
+
+    @classmethod
+    def peek_header(cls, m_bytes, offset=0):
+        if len(m_bytes) < offset + cls._code_end:
+            return None
+        return MessageHeader(cls, m_bytes, offset, cls._code_end, 0)
+
     def to_bytes(self):
-        return "{type_id}{code:08x}".format(type_id=self.type_id, code=self.code)
+        return b"%s%08x" % (self._type_prefix, self.code)
+
+    def to_buffers(self):
+        return [self.to_bytes()]
 
     @classmethod
-    def from_bytes(cls, m_bytes):
-        code = int(m_bytes[cls._code_start:cls._code_end], 16)
-        return cls(code)
+    def _read_fields(cls, m_bytes, offset=0):
+        code = _read_hex(
+            m_bytes, offset + cls._code_start, offset + cls._code_end)
+        return (code,)
 
 
 class SingleRequestMessage(GotalkRequestMessage):
@@ -144,6 +500,8 @@ class SingleRequestMessage(GotalkRequestMessage):
     r0001004echo00000019{"message":"Hello World"}
     """
 
+    __slots__ = ('request_id', 'operation', 'payload')
+
     type_id = SINGLE_REQUEST_TYPE
 
     def __init__(self, request_id, operation, payload):
@@ -151,23 +509,21 @@ class SingleRequestMessage(GotalkRequestMessage):
         self.operation = operation
         self.payload = payload
 
-    def to_bytes(self):
-        operation_length = self._check_operation_length(self.operation)
-        payload_length = self._check_payload_length(self.payload)
-        return "{type_id}{request_id}" \
-               "{operation_length:03d}{operation}" \
-               "{payload_length:08x}{payload}".format(
-                type_id=self.type_id,
-                request_id=self._pad_request_id(self.request_id),
-                operation_length=operation_length, operation=self.operation,
-                payload_length=payload_length, payload=self.payload)
-
-    @classmethod
-    def from_bytes(cls, m_bytes):
-        request_id = cls._get_request_id_from_bytes(m_bytes)
-        operation, operation_end = cls._get_operation_from_bytes(m_bytes)
+    def _get_header(self, payload_length):
+        operation = _encode_text(self.operation)
+        operation_length = self._check_operation_length(operation)
+        return b"%s%s%03x%s%08x" % (
+            self._type_prefix,
+            self._pad_request_id(self.request_id),
+            operation_length, operation, payload_length)
+
+    @classmethod
+    def _read_fields(cls, m_bytes, offset=0):
+        request_id = cls._get_request_id_from_bytes(m_bytes, offset)
+        operation, operation_end = cls._get_operation_from_bytes(
+            m_bytes, offset)
         payload = cls._get_payload_from_bytes(m_bytes, operation_end)
-        return cls(request_id, operation, payload)
+        return request_id, operation, payload
 
 
 class SingleResultMessage(GotalkResultMessage):
@@ -186,25 +542,20 @@ class SingleResultMessage(GotalkResultMessage):
     R000100000019{"message":"Hello World"}
     """
 
+    __slots__ = ('request_id', 'payload')
+
     type_id = SINGLE_RESULT_TYPE
 
     def __init__(self, request_id, payload):
         self.request_id = request_id
         self.payload = payload
 
-    def to_bytes(self):
-        payload_length = self._check_payload_length(self.payload)
-        return "{type_id}{request_id}{payload_length:08x}{payload}".format(
-            type_id=self.type_id,
-            request_id=self._pad_request_id(self.request_id),
-            payload_length=payload_length, payload=self.payload)
-
     @classmethod
-    def from_bytes(cls, m_bytes):
-        request_id = cls._get_request_id_from_bytes(m_bytes)
+    def _read_fields(cls, m_bytes, offset=0):
+        request_id = cls._get_request_id_from_bytes(m_bytes, offset)
         payload = cls._get_payload_from_bytes(
-            m_bytes, payload_length_start=cls._request_id_end)
-        return cls(request_id, payload)
+            m_bytes, payload_length_start=offset + cls._request_id_end)
+        return request_id, payload
 
 
 class StreamRequestMessage(GotalkRequestMessage):
@@ -230,6 +581,8 @@ class StreamRequestMessage(GotalkRequestMessage):
     s0001004echo0000000b{"message":
     """
 
+    __slots__ = ('request_id', 'operation', 'payload')
+
     type_id = STREAM_REQUEST_TYPE
 
     def __init__(self, request_id, operation, payload):
@@ -237,23 +590,21 @@ class StreamRequestMessage(GotalkRequestMessage):
         self.operation = operation
         self.payload = payload
 
-    def to_bytes(self):
-        operation_length = self._check_operation_length(self.operation)
-        payload_length = self._check_payload_length(self.payload)
-        return "{type_id}{request_id}" \
-               "{operation_length:03d}{operation}" \
-               "{payload_length:08x}{payload}".format(
-                type_id=self.type_id,
-                request_id=self._pad_request_id(self.request_id),
-                operation_length=operation_length, operation=self.operation,
-                payload_length=payload_length, payload=self.payload)
-
-    @classmethod
-    def from_bytes(cls, m_bytes):
-        request_id = cls._get_request_id_from_bytes(m_bytes)
-        operation, operation_end = cls._get_operation_from_bytes(m_bytes)
+    def _get_header(self, payload_length):
+        operation = _encode_text(self.operation)
+        operation_length = self._check_operation_length(operation)
+        return b"%s%s%03x%s%08x" % (
+            self._type_prefix,
+            self._pad_request_id(self.request_id),
+            operation_length, operation, payload_length)
+
+    @classmethod
+    def _read_fields(cls, m_bytes, offset=0):
+        request_id = cls._get_request_id_from_bytes(m_bytes, offset)
+        operation, operation_end = cls._get_operation_from_bytes(
+            m_bytes, offset)
         payload = cls._get_payload_from_bytes(m_bytes, operation_end)
-        return cls(request_id, operation, payload)
+        return request_id, operation, payload
 
 
 class StreamRequestPartMessage(GotalkRequestMessage):
@@ -272,25 +623,30 @@ class StreamRequestPartMessage(GotalkRequestMessage):
     p00010000000e"Hello World"}
     """
 
+    __slots__ = ('request_id', 'payload')
+
     type_id = STREAM_REQUEST_PART_TYPE
 
     def __init__(self, request_id, payload):
         self.request_id = request_id
         self.payload = payload
 
-    def to_bytes(self):
-        payload_length = self._check_payload_length(self.payload)
-        return "{type_id}{request_id}{payload_length:08x}{payload}".format(
-                type_id=self.type_id,
-                request_id=self._pad_request_id(self.request_id),
-                payload_length=payload_length, payload=self.payload)
+    @classmethod
+    def _get_payload_length_start(cls, m_bytes, offset):
+        # Parts don't carry an operation, unlike the other request messages.
+        return offset + cls._request_id_end
+
+    @classmethod
+    def _peek_fields(cls, m_bytes, offset=0):
+        return (cls._get_request_id_from_bytes(m_bytes, offset), None, None,
+                offset + cls._request_id_end)
 
     @classmethod
-    def from_bytes(cls, m_bytes):
-        request_id = cls._get_request_id_from_bytes(m_bytes)
+    def _read_fields(cls, m_bytes, offset=0):
+        request_id = cls._get_request_id_from_bytes(m_bytes, offset)
         payload = cls._get_payload_from_bytes(
-            m_bytes, payload_length_start=cls._request_id_end)
-        return cls(request_id, payload)
+            m_bytes, payload_length_start=offset + cls._request_id_end)
+        return request_id, payload
 
 
 class StreamResultMessage(GotalkResultMessage):
@@ -309,25 +665,20 @@ class StreamResultMessage(GotalkResultMessage):
     S00010000000b{"message":
     """
 
+    __slots__ = ('request_id', 'payload')
+
     type_id = STREAM_RESULT_TYPE
 
     def __init__(self, request_id, payload):
         self.request_id = request_id
         self.payload = payload
 
-    def to_bytes(self):
-        payload_length = self._check_payload_length(self.payload)
-        return "{type_id}{request_id}{payload_length:08x}{payload}".format(
-            type_id=self.type_id,
-            request_id=self._pad_request_id(self.request_id),
-            payload_length=payload_length, payload=self.payload)
-
     @classmethod
-    def from_bytes(cls, m_bytes):
-        request_id = cls._get_request_id_from_bytes(m_bytes)
+    def _read_fields(cls, m_bytes, offset=0):
+        request_id = cls._get_request_id_from_bytes(m_bytes, offset)
         payload = cls._get_payload_from_bytes(
-            m_bytes, payload_length_start=cls._request_id_end)
-        return cls(request_id, payload)
+            m_bytes, payload_length_start=offset + cls._request_id_end)
+        return request_id, payload
 
 
 class ErrorResultMessage(GotalkResultMessage):
@@ -346,25 +697,20 @@ class ErrorResultMessage(GotalkResultMessage):
     E000100000026{"error":"Unknown operation \"echo\""}
     """
 
+    __slots__ = ('request_id', 'payload')
+
     type_id = ERROR_RESULT_TYPE
 
     def __init__(self, request_id, payload):
         self.request_id = request_id
         self.payload = payload
 
-    def to_bytes(self):
-        payload_length = self._check_payload_length(self.payload)
-        return "{type_id}{request_id}{payload_length:08x}{payload}".format(
-            type_id=self.type_id,
-            request_id=self._pad_request_id(self.request_id),
-            payload_length=payload_length, payload=self.payload)
-
     @classmethod
-    def from_bytes(cls, m_bytes):
-        request_id = cls._get_request_id_from_bytes(m_bytes)
+    def _read_fields(cls, m_bytes, offset=0):
+        request_id = cls._get_request_id_from_bytes(m_bytes, offset)
         payload = cls._get_payload_from_bytes(
-            m_bytes, payload_length_start=cls._request_id_end)
-        return cls(request_id, payload)
+            m_bytes, payload_length_start=offset + cls._request_id_end)
+        return request_id, payload
 
 
 class RetryResultMessage(GotalkResultMessage):
@@ -385,6 +731,8 @@ class RetryResultMessage(GotalkResultMessage):
     e00010000000000000014"service restarting"
     """
 
+    __slots__ = ('request_id', 'wait', 'payload')
+
     type_id = RETRY_RESULT_TYPE
     _wait_bytes = 8
     _wait_start = GotalkRequestMessage._request_id_end
@@ -397,24 +745,27 @@ class RetryResultMessage(GotalkResultMessage):
         self.wait = wait
         self.payload = payload
 
-    def to_bytes(self):
-        payload_length = self._check_payload_length(self.payload)
-        return "{type_id}{request_id}{wait:08x}{payload_length:08x}{payload}".format(
-            type_id=self.type_id,
-            request_id=self._pad_request_id(self.request_id),
-            wait=self.wait, payload_length=payload_length, payload=self.payload)
+    def _get_header(self, payload_length):
+        return b"%s%s%08x%08x" % (
+            self._type_prefix,
+            self._pad_request_id(self.request_id), self.wait, payload_length)
 
     @classmethod
-    def from_bytes(cls, m_bytes):
-        request_id = cls._get_request_id_from_bytes(m_bytes)
-        wait = cls._get_wait_from_bytes(m_bytes)
+    def _read_fields(cls, m_bytes, offset=0):
+        request_id = cls._get_request_id_from_bytes(m_bytes, offset)
+        wait = cls._get_wait_from_bytes(m_bytes, offset)
         payload = cls._get_payload_from_bytes(
-            m_bytes, payload_length_start=cls._wait_end)
-        return cls(request_id, wait, payload)
+            m_bytes, payload_length_start=offset + cls._wait_end)
+        return request_id, wait, payload
+
+    @classmethod
+    def _get_wait_from_bytes(cls, m_bytes, offset=0):
+        return _read_hex(
+            m_bytes, offset + cls._wait_start, offset + cls._wait_end)
 
     @classmethod
-    def _get_wait_from_bytes(cls, m_bytes):
-        return int(m_bytes[cls._wait_start: cls._wait_end], 16)
+    def _get_payload_length_start(cls, m_bytes, offset):
+        return offset + cls._wait_end
 
 
 class NotificationMessage(GotalkMessage):
@@ -438,29 +789,120 @@ class NotificationMessage(GotalkMessage):
     n00cchat message00000032{"message":"Hi","from":"nthn","chat_room":"gonuts"}
     """
 
+    __slots__ = ('name', 'payload')
+
     type_id = NOTIFICATION_TYPE
 
     def __init__(self, name, payload):
         self.name = name
         self.payload = payload
 
-    def to_bytes(self):
-        name_size = len(self.name)
-        payload_length = self._check_payload_length(self.payload)
-        return "{type_id}{name_size:03x}{name}{payload_length:08x}{payload}".format(
-            type_id=self.type_id, name_size=name_size, name=self.name,
-            payload_length=payload_length, payload=self.payload)
+    def _get_header(self, payload_length):
+        name = _encode_text(self.name)
+        return b"%s%03x%s%08x" % (
+            self._type_prefix, len(name), name, payload_length)
 
     @classmethod
-    def from_bytes(cls, m_bytes):
-        name, name_end = cls._get_name_from_bytes(m_bytes)
+    def _read_fields(cls, m_bytes, offset=0):
+        name, name_end = cls._get_name_from_bytes(m_bytes, offset)
         payload = cls._get_payload_from_bytes(
             m_bytes, payload_length_start=name_end)
-        return cls(name, payload)
+        return name, payload
 
     @classmethod
-    def _get_name_from_bytes(cls, m_bytes):
-        name_length = int(m_bytes[1:4], 16)
-        name_end = 4 + name_length
-        name = m_bytes[4: name_end]
+    def _get_name_from_bytes(cls, m_bytes, offset=0):
+        name_length = _read_hex(m_bytes, offset + 1, offset + 4)
+        name_end = offset + 4 + name_length
+        name = _read_text(m_bytes, offset + 4, name_end)
         return name, name_end
+
+    @classmethod
+    def _peek_fields(cls, m_bytes, offset=0):
+        if len(m_bytes) < offset + 4:
+            return None
+        name_end = offset + 4 + _read_hex(m_bytes, offset + 1, offset + 4)
+        if len(m_bytes) < name_end:
+            return None
+        return (None, None, _read_text(m_bytes, offset + 4, name_end),
+                name_end)
+
+    @classmethod
+    def _get_payload_length_start(cls, m_bytes, offset):
+        if len(m_bytes) < offset + 4:
+            return None
+        return offset + 4 + _read_hex(m_bytes, offset + 1, offset + 4)
+
+
+class HeartbeatMessage(GotalkMessage):
+    """
+    Heartbeat       = "h" load time
+
+    load            = hexUInt4
+    time            = hexUInt8
+
+    +------------------ Heartbeat
+    |   +-------------- load    2
+    |   |       +------ time    2015-02-08 22:09:30 UTC
+    |   |       |
+    h000254d7de9a
+    """
+
+    __slots__ = ('load', 'time')
+
+    type_id = HEARTBEAT_TYPE
+
+    load_max = 0xffff
+
+    _load_start = 1
+    _load_end = _load_start + 4
+    _time_end = _load_end + 8
+
+    def __init__(self, load, time=None):
+        """
+        :param int load: How busy the sender is. Clamped to ``load_max``.
+        :param int time: The sender's clock, in seconds since the epoch.
+            Defaults to now.
+        """
+
+        self.load = load
+        self.time = time if time is not None else _now()
+
+    @classmethod
+    def get_frame_length(cls, m_bytes, offset=0):
+        return cls._time_end
+
+    @classmethod
+    def peek_header(cls, m_bytes, offset=0):
+        if len(m_bytes) < offset + cls._time_end:
+            return None
+        return MessageHeader(cls, m_bytes, offset, cls._time_end, 0)
+
+    def to_bytes(self):
+        return b"%s%04x%08x" % (
+            self._type_prefix, min(max(self.load, 0), self.load_max),
+            self.time & 0xffffffff)
+
+    def to_buffers(self):
+        return [self.to_bytes()]
+
+    @classmethod
+    def _read_fields(cls, m_bytes, offset=0):
+        load = _read_hex(
+            m_bytes, offset + cls._load_start, offset + cls._load_end)
+        time = _read_hex(
+            m_bytes, offset + cls._load_end, offset + cls._time_end)
+        return load, time
+
+
+def _now():
+    return int(time.time())
+
+
+#: Type byte lookup tables for every version 01 message, built once here.
+codecs = CodecRegistry(GotalkMessage.protocol_version)
+for _message_class in (
+        SingleRequestMessage, SingleResultMessage, StreamRequestMessage,
+        StreamRequestPartMessage, StreamResultMessage, ErrorResultMessage,
+        ProtocolErrorMessage, RetryResultMessage, NotificationMessage,
+        HeartbeatMessage):
+    codecs.register(_message_class)
@@ -0,0 +1,134 @@
+"""
+Request ID allocation and in-flight request tracking.
+"""
+
+from gotalk.exceptions import InvalidRequestIDError, RequestIDsExhaustedError
+
+# Request IDs are four bytes on the wire. Like the Go reference
+# implementation, we fill them with base-36 digits, so they stay printable.
+REQUEST_ID_LENGTH = 4
+REQUEST_ID_DIGITS = b"0123456789abcdefghijklmnopqrstuvwxyz"
+REQUEST_ID_SPACE = len(REQUEST_ID_DIGITS) ** REQUEST_ID_LENGTH
+
+# Every two-digit combination, so formatting an ID is two lookups and a join.
+_PAIR_SPACE = len(REQUEST_ID_DIGITS) ** 2
+_PAIRS = [bytes((high, low))
+          for high in REQUEST_ID_DIGITS for low in REQUEST_ID_DIGITS]
+
+
+def format_request_id(number):
+    """
+    :param int number: A request number in ``range(REQUEST_ID_SPACE)``.
+    :rtype: bytes
+    :returns: The 4-byte wire form of the request ID.
+    :raises: InvalidRequestIDError if the number doesn't fit in 4 bytes.
+    """
+
+    if not 0 <= number < REQUEST_ID_SPACE:
+        raise InvalidRequestIDError(
+            "Request ID {number} out of range.".format(number=number))
+    return _PAIRS[number // _PAIR_SPACE] + _PAIRS[number % _PAIR_SPACE]
+
+
+class RequestIDAllocator(object):
+    """
+    Hands out unique request IDs for one connection, and maps each in-flight
+    ID to whatever state the connection needs to keep for it (a future, a
+    stream, ...).
+
+    IDs are handed out in sequence and wrap around at the end of the ID
+    space. IDs that are still in flight when we come back around to them are
+    skipped, so a slow request never has its ID handed to another one.
+    """
+
+    def __init__(self, start=1):
+        """
+        :param int start: The first request number to hand out.
+        """
+
+        self._next = start % REQUEST_ID_SPACE
+        self._in_flight = {}
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of requests in flight.
+        """
+
+        return len(self._in_flight)
+
+    def __contains__(self, request_id):
+        return request_id in self._in_flight
+
+    def allocate(self, value=None):
+        """
+        Reserves a request ID.
+
+        :param value: The state to associate with the request.
+        :rtype: bytes
+        :returns: The request ID to send.
+        :raises: RequestIDsExhaustedError if every ID is in flight.
+        """
+
+        in_flight = self._in_flight
+        if len(in_flight) >= REQUEST_ID_SPACE:
+            raise RequestIDsExhaustedError(
+                "All {count} request IDs are in flight.".format(
+                    count=REQUEST_ID_SPACE))
+        number = self._next
+        request_id = format_request_id(number)
+        while request_id in in_flight:
+            number = (number + 1) % REQUEST_ID_SPACE
+            request_id = format_request_id(number)
+        self._next = (number + 1) % REQUEST_ID_SPACE
+        in_flight[request_id] = value
+        return request_id
+
+    def get(self, request_id, default=None):
+        """
+        :returns: The state associated with an in-flight request, or
+            ``default`` if the ID isn't in flight.
+        """
+
+        return self._in_flight.get(request_id, default)
+
+    def __setitem__(self, request_id, value):
+        """
+        Replaces the state associated with an in-flight request.
+
+        :raises: KeyError if the ID isn't in flight.
+        """
+
+        if request_id not in self._in_flight:
+            raise KeyError(request_id)
+        self._in_flight[request_id] = value
+
+    def pop(self, request_id, default=None):
+        """
+        Releases a request ID so it can eventually be handed out again.
+
+        :returns: The state that was associated with the request, or
+            ``default`` if the ID wasn't in flight.
+        """
+
+        return self._in_flight.pop(request_id, default)
+
+    def items(self):
+        """
+        :returns: A view of ``(request_id, value)`` pairs for every request
+            in flight.
+        """
+
+        return self._in_flight.items()
+
+    def clear(self):
+        """
+        Releases every request ID.
+
+        :rtype: list
+        :returns: The values that were associated with the released IDs.
+        """
+
+        values = list(self._in_flight.values())
+        self._in_flight.clear()
+        return values
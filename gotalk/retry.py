@@ -0,0 +1,131 @@
+"""
+Automatic retries for requests the peer asks us to send again.
+"""
+
+import asyncio
+import random
+
+from gotalk.exceptions import RetryRequestedError
+from gotalk.timers import TimerHeap
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a fraction of requests, so that a struggling peer sees
+    at most ``ratio`` times more traffic because of them, rather than a
+    multiple of it.
+
+    Every request earns ``ratio`` tokens, up to ``max_tokens``, and every
+    retry spends one. The budget starts out full, so a quiet client can
+    still retry a few times.
+    """
+
+    def __init__(self, ratio=0.2, max_tokens=10.0):
+        """
+        :param float ratio: Retries allowed per request, in the long run.
+        :param float max_tokens: The most retries that can be saved up.
+        """
+
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        """
+        Called for every request.
+        """
+
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        """
+        Called before every retry.
+
+        :rtype: bool
+        :returns: ``True`` if the retry is within budget.
+        """
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Retrier(object):
+    """
+    Sends requests again when the peer answers with a retry result, after
+    the wait it asked for.
+
+    Waits are stretched by a random amount of up to ``jitter`` times their
+    length, so that a crowd of clients told to come back at the same time
+    don't all do so at once. Pending retries all share one
+    :py:class:`gotalk.timers.TimerHeap`, not a timer each.
+
+    Usage::
+
+        retrier = Retrier()
+        result = await retrier.call(connection.request, "echo", b"hi")
+        # Anything that sends a request works, e.g. a ConnectionPool:
+        result = await retrier.call(pool.request, host, port, "echo", b"hi")
+    """
+
+    def __init__(self, max_attempts=5, jitter=0.5, min_wait=0.0, budget=None,
+                 timers=None, rng=None):
+        """
+        :param int max_attempts: The most times to send a request, counting
+            the first.
+        :param float jitter: The most a wait is stretched by, as a fraction
+            of its length.
+        :param float min_wait: The shortest wait in seconds, for peers that
+            ask for a retry without saying when.
+        :param RetryBudget budget: Shared between retriers to cap retries
+            across them. Each retrier gets its own if omitted.
+        :param TimerHeap timers: Where to schedule retries.
+        :param random.Random rng: Source of the jitter.
+        """
+
+        self.max_attempts = max_attempts
+        self.jitter = jitter
+        self.min_wait = min_wait
+        self.budget = budget if budget is not None else RetryBudget()
+        self.timers = timers if timers is not None else TimerHeap()
+        self._random = rng if rng is not None else random.Random()
+
+    async def call(self, send, *args, timeout=None):
+        """
+        :param send: Sends the request, and returns its result. Called with
+            ``args`` for every attempt.
+        :param args: Passed on to ``send``.
+        :param float timeout: Seconds after which to stop retrying. Attempts
+            that would start after this aren't made.
+        :returns: The result of the first attempt that isn't retried.
+        :raises: RetryRequestedError from the last attempt, if we run out of
+            attempts, budget or time.
+        """
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        self.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                return await send(*args)
+            except RetryRequestedError as exc:
+                delay = self.get_delay(exc.wait)
+                if attempt >= self.max_attempts or (
+                        deadline is not None and
+                        loop.time() + delay > deadline) or \
+                        not self.budget.withdraw():
+                    raise
+            await self.timers.sleep(delay)
+            attempt += 1
+
+    def get_delay(self, wait):
+        """
+        :param int wait: The wait the peer asked for, in milliseconds.
+        :rtype: float
+        :returns: Seconds to wait before trying again.
+        """
+
+        delay = max(wait / 1000.0, self.min_wait)
+        return delay * (1 + self.jitter * self._random.random())
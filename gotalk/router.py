@@ -0,0 +1,542 @@
+"""
+A gateway that forwards requests to backend servers by operation name,
+without decoding them.
+"""
+
+import asyncio
+
+from gotalk.connection import DEFAULT_HEARTBEAT_INTERVAL
+from gotalk.exceptions import InvalidMessageTypeIDError, \
+    InvalidPayloadError, InvalidProtocolVersionError, \
+    RequestIDsExhaustedError
+from gotalk.protocol.defines import ERROR_RESULT_TYPE, NOTIFICATION_TYPE, \
+    PROTOCOL_ERROR_INVALID_MESSAGE, PROTOCOL_ERROR_TYPE, \
+    PROTOCOL_ERROR_UNSUPPORTED_VERSION, RETRY_RESULT_TYPE, \
+    SINGLE_REQUEST_TYPE, SINGLE_RESULT_TYPE, STREAM_REQUEST_PART_TYPE, \
+    STREAM_REQUEST_TYPE, STREAM_RESULT_TYPE
+from gotalk.protocol.framing import FrameDecoder
+from gotalk.protocol.messages import coalesce_buffers, read_version_message
+from gotalk.protocol.version01.messages import ErrorResultMessage, \
+    HeartbeatMessage, ProtocolErrorMessage, ProtocolVersionMessage
+from gotalk.request_ids import REQUEST_ID_LENGTH, RequestIDAllocator
+
+# Where the request ID sits in the messages that have one.
+_REQUEST_ID_START = 1
+_REQUEST_ID_END = _REQUEST_ID_START + REQUEST_ID_LENGTH
+
+
+class Router(object):
+    """
+    Accepts gotalk connections and forwards every single request, stream
+    request and notification to the backend server for its operation or
+    notification name. Results come back the same way.
+
+    Only message headers are parsed. Request IDs are rewritten into the
+    backend connection's ID space on the way in, and back on the way out,
+    and everything else, payloads included, is passed along as it arrived,
+    without being decoded, copied or re-encoded.
+
+    Each backend gets a single connection, opened when it's first needed,
+    that requests from every client are multiplexed over. Reading from
+    clients is paused while any backend has a full write buffer, and reading
+    from a backend while any client with requests on it has one.
+
+    Usage::
+
+        router = Router({
+            "resize": ("images.internal", 1234),
+            "search": ("search.internal", 1234),
+        })
+        server = await router.start("0.0.0.0", 1234)
+
+    Requests and notifications from backends aren't forwarded. Requests are
+    answered with an error, notifications are dropped.
+    """
+
+    def __init__(self, routes=None, default=None,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL):
+        """
+        :param dict routes: Operation or notification name ->
+            ``(host, port)`` of the backend that handles it.
+        :param tuple default: ``(host, port)`` of the backend for operations
+            that aren't in ``routes``. Requests for those are answered with
+            an error if omitted.
+        :param float heartbeat_interval: Seconds between the heartbeats sent
+            to clients and backends, or ``None`` to send none. Peers that
+            we're waiting on are dropped after three intervals of silence.
+        """
+
+        self.routes = dict(routes or {})
+        self.default = default
+        self.heartbeat_interval = heartbeat_interval
+        self._server = None
+        # (host, port) -> _BackendLink.
+        self._backends = {}
+        self._clients = set()
+        self._paused_backends = set()
+
+    def add_route(self, operation, host, port):
+        """
+        :param str operation: An operation or notification name.
+        :param str host: The host of the backend that handles it.
+        :param int port: The port of the backend that handles it.
+        """
+
+        self.routes[operation] = (host, port)
+
+    def get_backend_address(self, operation):
+        """
+        Picks the backend for an operation. Override this for routing that
+        a lookup table can't do.
+
+        :param str operation: An operation or notification name.
+        :rtype: tuple or None
+        :returns: ``(host, port)`` of the backend, or ``None`` if nothing
+            handles the operation.
+        """
+
+        return self.routes.get(operation, self.default)
+
+    def get_load(self):
+        """
+        Reports how busy we are in the heartbeats we send.
+
+        :rtype: int
+        :returns: The number of requests waiting on backends.
+        """
+
+        return sum(len(backend.requests)
+                   for backend in self._backends.values())
+
+    async def start(self, host=None, port=None, **kwargs):
+        """
+        Starts accepting client connections.
+
+        :param str host: The interface(s) to listen on.
+        :param int port: The port to listen on.
+        :param kwargs: Passed on to ``loop.create_server()``.
+        :rtype: asyncio.AbstractServer
+        """
+
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: _ClientLink(self), host, port, **kwargs)
+        return self._server
+
+    def close(self):
+        """
+        Stops accepting connections, and closes every client and backend
+        connection.
+        """
+
+        if self._server is not None:
+            self._server.close()
+        for link in list(self._clients) + list(self._backends.values()):
+            link.close()
+
+    async def wait_closed(self):
+        """
+        Waits until every connection is closed.
+        """
+
+        if self._server is not None:
+            await self._server.wait_closed()
+        links = list(self._clients) + list(self._backends.values())
+        await asyncio.gather(*[link.closed for link in links])
+
+    def _get_backend(self, operation):
+        address = self.get_backend_address(operation)
+        if address is None:
+            return None
+        backend = self._backends.get(address)
+        if backend is None:
+            backend = self._backends[address] = _BackendLink(self, address)
+            backend.open()
+        return backend
+
+    def _client_connected(self, client):
+        self._clients.add(client)
+        if self._paused_backends:
+            client.transport.pause_reading()
+
+    def _client_lost(self, client):
+        self._clients.discard(client)
+
+    def _backend_lost(self, backend):
+        if self._backends.get(backend.address) is backend:
+            del self._backends[backend.address]
+        self._backend_resumed(backend)
+
+    def _backend_paused(self, backend):
+        if not self._paused_backends:
+            for client in self._clients:
+                client.transport.pause_reading()
+        self._paused_backends.add(backend)
+
+    def _backend_resumed(self, backend):
+        if backend not in self._paused_backends:
+            return
+        self._paused_backends.discard(backend)
+        if not self._paused_backends:
+            for client in self._clients:
+                if not client.transport.is_closing():
+                    client.transport.resume_reading()
+
+
+class _Route(object):
+    """
+    A request forwarded to a backend, and where its results go.
+    """
+
+    __slots__ = ('client', 'request_id')
+
+    def __init__(self, client, request_id):
+        #: The client link, or ``None`` once the client has gone away.
+        self.client = client
+        #: The client's ID for the request.
+        self.request_id = request_id
+
+
+class _FrameLink(asyncio.Protocol):
+    """
+    One end of a connection that the router handles as frames rather than
+    messages: the version exchange, lazy decoding, coalesced writes and
+    heartbeats.
+    """
+
+    def __init__(self, router):
+        self.router = router
+        self.transport = None
+        self.closed = None
+        self._loop = None
+        self._peer_version = None
+        self._version_buffer = b""
+        self._decoder = FrameDecoder(
+            ProtocolVersionMessage.protocol_version, lazy=True)
+        self._write_queue = []
+        self._flush_scheduled = False
+        self._last_received = None
+        self._heartbeat_handle = None
+
+    def connection_made(self, transport):
+        self._loop = asyncio.get_running_loop()
+        self.transport = transport
+        transport.write(ProtocolVersionMessage().to_bytes())
+        self.flush()
+        self._last_received = self._loop.time()
+        if self.router.heartbeat_interval is not None:
+            self._heartbeat_handle = self._loop.call_later(
+                self.router.heartbeat_interval, self._heartbeat)
+
+    def data_received(self, data):
+        self._last_received = self._loop.time()
+        if self._peer_version is None:
+            data = self._receive_version(data)
+            if not data:
+                return
+        try:
+            headers = self._decoder.feed(data)
+        except (InvalidMessageTypeIDError, InvalidPayloadError,
+                ValueError):
+            self._send_protocol_error(PROTOCOL_ERROR_INVALID_MESSAGE)
+            return
+        on_frame = self._on_frame
+        for header in headers:
+            on_frame(header)
+
+    def connection_lost(self, exc):
+        if self._heartbeat_handle is not None:
+            self._heartbeat_handle.cancel()
+            self._heartbeat_handle = None
+        self._write_queue = []
+        self._on_lost(exc)
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(None)
+
+    @property
+    def is_closing(self):
+        return self.transport is not None and self.transport.is_closing()
+
+    def write(self, buffers):
+        """
+        Queues buffers to be written with the next flush.
+        """
+
+        self._write_queue.extend(buffers)
+        if not self._flush_scheduled and self.transport is not None:
+            self._flush_scheduled = True
+            self._loop.call_soon(self.flush)
+
+    def forward(self, header, request_id):
+        """
+        Queues a frame with its request ID swapped for ``request_id``. The
+        rest of the frame is passed along as a view of the receive buffer.
+        """
+
+        frame = header.frame
+        self.write((bytes(frame[:_REQUEST_ID_START]) + request_id,
+                    frame[_REQUEST_ID_END:]))
+
+    def send_message(self, message):
+        self.write(message.to_buffers())
+
+    def flush(self):
+        self._flush_scheduled = False
+        queue, self._write_queue = self._write_queue, []
+        if queue and self.transport is not None and \
+                not self.transport.is_closing():
+            self.transport.writelines(coalesce_buffers(queue))
+
+    def close(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.flush()
+            self.transport.close()
+
+    def get_pending(self):
+        """
+        :rtype: int
+        :returns: The number of requests waiting on the peer.
+        """
+
+        raise NotImplementedError()
+
+    def _on_frame(self, header):
+        raise NotImplementedError()
+
+    def _on_lost(self, exc):
+        raise NotImplementedError()
+
+    def _receive_version(self, data):
+        self._version_buffer += data
+        if len(self._version_buffer) < 2:
+            return None
+        version_bytes = self._version_buffer[:2]
+        data = self._version_buffer[2:]
+        self._version_buffer = b""
+        try:
+            peer_version = read_version_message(version_bytes)
+        except InvalidProtocolVersionError:
+            peer_version = None
+        if peer_version != ProtocolVersionMessage.protocol_version:
+            self._send_protocol_error(PROTOCOL_ERROR_UNSUPPORTED_VERSION)
+            return None
+        self._peer_version = peer_version
+        return data
+
+    def _send_protocol_error(self, code):
+        if not self.is_closing:
+            self.send_message(ProtocolErrorMessage(code))
+        self.close()
+
+    def _heartbeat(self):
+        self._heartbeat_handle = None
+        if self.is_closing:
+            return
+        interval = self.router.heartbeat_interval
+        now = self._loop.time()
+        if not self.transport.is_reading():
+            # Paused for backpressure, so the peer can't be heard from.
+            self._last_received = now
+        if now - self._last_received > interval * 3 and \
+                self.get_pending():
+            self.transport.abort()
+            return
+        self.send_message(HeartbeatMessage(self.router.get_load()))
+        self._heartbeat_handle = self._loop.call_later(
+            interval, self._heartbeat)
+
+
+class _ClientLink(_FrameLink):
+    """
+    A connection from a client, whose requests are forwarded to backends.
+    """
+
+    def __init__(self, router):
+        super(_ClientLink, self).__init__(router)
+        # Client request ID -> (backend link, backend request ID).
+        self.outstanding = {}
+        # Backends we've stopped reading from while our write buffer is
+        # full.
+        self._paused_backends = set()
+        self._write_paused = False
+
+    def connection_made(self, transport):
+        self.closed = asyncio.get_running_loop().create_future()
+        super(_ClientLink, self).connection_made(transport)
+        self.router._client_connected(self)
+
+    def get_pending(self):
+        # Clients don't owe us anything.
+        return 0
+
+    def pause_writing(self):
+        self._write_paused = True
+        for backend, _ in self.outstanding.values():
+            self._pause_backend(backend)
+
+    def resume_writing(self):
+        self._write_paused = False
+        paused, self._paused_backends = self._paused_backends, set()
+        for backend in paused:
+            backend.resume_reading(self)
+
+    def _on_frame(self, header):
+        type_id = header.type_id
+        if type_id == SINGLE_REQUEST_TYPE or type_id == STREAM_REQUEST_TYPE:
+            self._on_request(header)
+        elif type_id == STREAM_REQUEST_PART_TYPE:
+            entry = self.outstanding.get(header.request_id)
+            if entry is not None:
+                entry[0].forward(header, entry[1])
+        elif type_id == NOTIFICATION_TYPE:
+            backend = self.router._get_backend(header.name)
+            if backend is not None:
+                backend.write((header.frame,))
+        elif type_id == PROTOCOL_ERROR_TYPE:
+            self.close()
+        # Heartbeats only need to arrive, and results are for requests we
+        # never sent.
+
+    def _on_request(self, header):
+        request_id = header.request_id
+        backend = self.router._get_backend(header.operation)
+        if backend is None:
+            self.send_message(ErrorResultMessage(
+                request_id, 'Unknown operation "{operation}"'.format(
+                    operation=header.operation)))
+            return
+        try:
+            backend_id = backend.requests.allocate(_Route(self, request_id))
+        except RequestIDsExhaustedError as exc:
+            self.send_message(ErrorResultMessage(request_id, str(exc)))
+            return
+        self.outstanding[request_id] = (backend, backend_id)
+        if self._write_paused:
+            self._pause_backend(backend)
+        backend.forward(header, backend_id)
+
+    def _pause_backend(self, backend):
+        if backend not in self._paused_backends:
+            self._paused_backends.add(backend)
+            backend.pause_reading(self)
+
+    def _on_lost(self, exc):
+        self.router._client_lost(self)
+        # Nothing we're owed has anywhere to go now.
+        self.resume_writing()
+        # Results may still turn up, and have to keep their IDs reserved
+        # until they do, but they have nowhere to go.
+        outstanding, self.outstanding = self.outstanding, {}
+        for backend, backend_id in outstanding.values():
+            route = backend.requests.get(backend_id)
+            if route is not None:
+                route.client = None
+
+
+class _BackendLink(_FrameLink):
+    """
+    The connection to one backend, shared by every client.
+    """
+
+    def __init__(self, router, address):
+        super(_BackendLink, self).__init__(router)
+        self.address = address
+        # Backend request ID -> _Route.
+        self.requests = RequestIDAllocator()
+        # Clients that can't take any more results for now.
+        self._paused_for = set()
+
+    def open(self):
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        task = loop.create_task(
+            loop.create_connection(lambda: self, *self.address))
+        task.add_done_callback(self._opened)
+
+    def get_pending(self):
+        return len(self.requests)
+
+    def pause_writing(self):
+        self.router._backend_paused(self)
+
+    def resume_writing(self):
+        self.router._backend_resumed(self)
+
+    def connection_made(self, transport):
+        super(_BackendLink, self).connection_made(transport)
+        if self._paused_for:
+            transport.pause_reading()
+
+    def pause_reading(self, client):
+        """
+        Stops reading results until :py:meth:`resume_reading` has been
+        called for every client that has called this.
+
+        :param _ClientLink client: The client whose write buffer is full.
+        """
+
+        if not self._paused_for and self.transport is not None and \
+                not self.transport.is_closing():
+            self.transport.pause_reading()
+        self._paused_for.add(client)
+
+    def resume_reading(self, client):
+        """
+        :param _ClientLink client: The client whose write buffer has
+            drained.
+        """
+
+        self._paused_for.discard(client)
+        if not self._paused_for and self.transport is not None and \
+                not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def _opened(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.connection_lost(task.exception())
+
+    def _on_frame(self, header):
+        type_id = header.type_id
+        if type_id == STREAM_RESULT_TYPE:
+            route = self.requests.get(header.request_id)
+            if route is None:
+                return
+            # An empty part is the end of the results.
+            if not header.payload_length:
+                self._finish(header.request_id, route)
+            if route.client is not None:
+                route.client.forward(header, route.request_id)
+        elif type_id == SINGLE_RESULT_TYPE or type_id == ERROR_RESULT_TYPE \
+                or type_id == RETRY_RESULT_TYPE:
+            route = self.requests.get(header.request_id)
+            if route is None:
+                return
+            self._finish(header.request_id, route)
+            if route.client is not None:
+                route.client.forward(header, route.request_id)
+        elif type_id == SINGLE_REQUEST_TYPE or type_id == STREAM_REQUEST_TYPE:
+            self.send_message(ErrorResultMessage(
+                header.request_id, "Requests aren't forwarded to clients."))
+        elif type_id == PROTOCOL_ERROR_TYPE:
+            self.close()
+
+    def _finish(self, backend_id, route):
+        self.requests.pop(backend_id)
+        client = route.client
+        if client is not None and \
+                client.outstanding.get(route.request_id, (None,))[0] is self:
+            del client.outstanding[route.request_id]
+
+    def _on_lost(self, exc):
+        self.router._backend_lost(self)
+        error = "Backend {host}:{port} went away{reason}".format(
+            host=self.address[0], port=self.address[1],
+            reason=": {exc}".format(exc=exc) if exc else ".")
+        for route in self.requests.clear():
+            client = route.client
+            if client is None:
+                continue
+            client.outstanding.pop(route.request_id, None)
+            if not client.is_closing:
+                client.send_message(
+                    ErrorResultMessage(route.request_id, error))
@@ -0,0 +1,26 @@
+"""
+Helpers for running gotalk servers.
+"""
+
+import asyncio
+
+from gotalk.connection import Connection
+
+
+async def start_server(handlers, host=None, port=None,
+                       connection_class=Connection, **kwargs):
+    """
+    Starts accepting gotalk connections. Every connection dispatches to the
+    same ``handlers``.
+
+    :param Handlers handlers: The operations and notifications to serve.
+    :param str host: The interface(s) to listen on.
+    :param int port: The port to listen on.
+    :param type connection_class: The ``Connection`` sub-class to use.
+    :param kwargs: Passed on to ``loop.create_server()``.
+    :rtype: asyncio.AbstractServer
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: connection_class(handlers), host, port, **kwargs)
@@ -0,0 +1,230 @@
+"""
+Async iterators over the payloads of a gotalk stream, and the flow control
+that keeps them from buffering without bound.
+"""
+
+import asyncio
+import collections
+
+# Bytes a single stream may buffer before we stop reading from the socket.
+DEFAULT_STREAM_BUFFER_LIMIT = 256 * 1024
+# Bytes all of a connection's streams may buffer between them.
+DEFAULT_CONNECTION_BUFFER_LIMIT = 4 * 1024 * 1024
+
+
+class FlowControl(object):
+    """
+    Tracks how much data a connection's streams are holding on to, and
+    pauses reading from the transport while any stream is over its limit or
+    the streams are over the connection's limit between them. Reading
+    resumes once everything has drained to half of its limit.
+
+    Gotalk 01 has no per-stream window updates, so this throttles the whole
+    connection: one stalled consumer holds up every stream sharing its
+    socket, rather than letting memory grow without bound.
+    """
+
+    def __init__(self, limit=DEFAULT_CONNECTION_BUFFER_LIMIT):
+        """
+        :param int limit: The most bytes all streams may buffer in total
+            before reading is paused.
+        """
+
+        self.limit = limit
+        #: Bytes currently buffered across every stream.
+        self.buffered = 0
+        self.transport = None
+        self.paused = False
+        self._blocked_streams = 0
+
+    def attach(self, transport):
+        """
+        :param asyncio.ReadTransport transport: The transport to pause and
+            resume.
+        """
+
+        self.transport = transport
+
+    def add(self, nbytes):
+        """
+        Called when a stream buffers ``nbytes`` more bytes.
+        """
+
+        self.buffered += nbytes
+        if self.buffered > self.limit:
+            self._pause()
+
+    def remove(self, nbytes):
+        """
+        Called when ``nbytes`` buffered bytes have been consumed or dropped.
+        """
+
+        self.buffered -= nbytes
+        self._maybe_resume()
+
+    def block(self):
+        """
+        Called when a stream goes over its own limit.
+        """
+
+        self._blocked_streams += 1
+        self._pause()
+
+    def unblock(self):
+        """
+        Called when a stream that was over its limit has drained.
+        """
+
+        self._blocked_streams -= 1
+        self._maybe_resume()
+
+    def _pause(self):
+        if not self.paused and self.transport is not None and \
+                not self.transport.is_closing():
+            self.paused = True
+            self.transport.pause_reading()
+
+    def _maybe_resume(self):
+        if self.paused and not self._blocked_streams and \
+                self.buffered <= self.limit // 2:
+            self.paused = False
+            if not self.transport.is_closing():
+                self.transport.resume_reading()
+
+
+class Stream(object):
+    """
+    The receiving end of a stream request or stream result. The connection
+    feeds payloads in as the parts arrive, and the consumer reads them with
+    ``async for``. Iteration stops at the zero-length part that ends the
+    stream, or raises if the stream was aborted.
+
+    When a :py:class:`FlowControl` is attached, reading from the connection
+    is paused while more than ``limit`` bytes are waiting to be consumed.
+    """
+
+    def __init__(self, request_id, limit=DEFAULT_STREAM_BUFFER_LIMIT,
+                 flow_control=None):
+        """
+        :param bytes request_id: The request ID the stream belongs to.
+        :param int limit: The most bytes to buffer before asking for reading
+            to be paused.
+        :param FlowControl flow_control: The connection's flow control, if
+            any.
+        """
+
+        self.request_id = request_id
+        self.limit = limit
+        #: Bytes received but not yet consumed.
+        self.buffered = 0
+        self._flow_control = flow_control
+        self._blocked = False
+        self._parts = collections.deque()
+        self._eof = False
+        self._closed = False
+        self._exception = None
+        self._waiter = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        payload = await self.read()
+        if payload is None:
+            raise StopAsyncIteration
+        return payload
+
+    @property
+    def at_eof(self):
+        """
+        :rtype: bool
+        :returns: ``True`` once the stream has ended and been fully read.
+        """
+
+        return self._eof and not self._parts
+
+    async def read(self):
+        """
+        :returns: The next payload, or ``None`` at the end of the stream.
+        :raises: Whatever exception the stream was aborted with.
+        """
+
+        while not self._parts:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                return None
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        payload = self._parts.popleft()
+        self._consumed(len(payload))
+        return payload
+
+    def feed(self, payload):
+        """
+        Adds a received payload to the stream. A zero-length payload ends the
+        stream.
+        """
+
+        if self._eof or self._closed:
+            return
+        nbytes = len(payload)
+        if nbytes:
+            self._parts.append(payload)
+            self.buffered += nbytes
+            flow_control = self._flow_control
+            if flow_control is not None:
+                flow_control.add(nbytes)
+                if not self._blocked and self.buffered > self.limit:
+                    self._blocked = True
+                    flow_control.block()
+        else:
+            self._eof = True
+        self._wake_waiter()
+
+    def feed_eof(self):
+        """
+        Ends the stream without adding another payload.
+        """
+
+        self._eof = True
+        self._wake_waiter()
+
+    def set_exception(self, exc):
+        """
+        Aborts the stream. The consumer gets ``exc`` once it has read the
+        payloads that arrived before the failure.
+        """
+
+        self._exception = exc
+        self._wake_waiter()
+
+    def close(self):
+        """
+        Stops buffering. Anything not yet consumed is dropped, as is anything
+        that arrives later, so an abandoned stream can't hold up the
+        connection.
+        """
+
+        self._closed = True
+        self._parts.clear()
+        self._consumed(self.buffered)
+        self.feed_eof()
+
+    def _consumed(self, nbytes):
+        self.buffered -= nbytes
+        flow_control = self._flow_control
+        if flow_control is None:
+            return
+        flow_control.remove(nbytes)
+        if self._blocked and self.buffered <= self.limit // 2:
+            self._blocked = False
+            flow_control.unblock()
+
+    def _wake_waiter(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
@@ -0,0 +1,246 @@
+"""
+Timers that stay cheap when there are thousands of them pending.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+import weakref
+
+# The event loop runs timers that are due within this much of now, so we do
+# the same rather than going back to sleep for a few nanoseconds.
+_CLOCK_RESOLUTION = time.get_clock_info('monotonic').resolution
+
+
+class Timer(object):
+    """
+    A callback scheduled on a :py:class:`TimerHeap` or
+    :py:class:`TimerWheel`.
+    """
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stops the callback from running. Cancelled timers are dropped once
+        they come due, so cancelling is O(1).
+        """
+
+        self.cancelled = True
+        self.callback = self.args = None
+
+
+class TimerHeap(object):
+    """
+    Runs callbacks at given event loop times, off a single heap and a single
+    event loop timer however many are pending. Scheduling is O(log n), and
+    the loop only wakes up when the earliest timer is due.
+
+    Usage::
+
+        timers = TimerHeap()
+        timers.call_later(0.5, print, "half a second later")
+        await timers.sleep(1.0)
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._loop = None
+        self._handle = None
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of timers pending, including cancelled ones
+            that haven't been dropped yet.
+        """
+
+        return len(self._heap)
+
+    def call_at(self, when, callback, *args):
+        """
+        :param float when: The event loop time to run ``callback`` at.
+        :param callable callback: Called with ``args``.
+        :rtype: Timer
+        """
+
+        if not self._heap:
+            # Nothing pending, so nothing ties us to the loop we last ran on.
+            self._loop = asyncio.get_running_loop()
+        timer = Timer(when, callback, args)
+        heapq.heappush(self._heap, (when, next(self._counter), timer))
+        if self._handle is None or when < self._handle.when():
+            self._reschedule()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """
+        :param float delay: Seconds from now to run ``callback``.
+        :param callable callback: Called with ``args``.
+        :rtype: Timer
+        """
+
+        return self.call_at(
+            asyncio.get_running_loop().time() + delay, callback, *args)
+
+    def sleep(self, delay):
+        """
+        :param float delay: Seconds to sleep for.
+        :rtype: asyncio.Future
+        :returns: A future that resolves to ``None`` after ``delay``.
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        self.call_later(delay, _wake, future)
+        return future
+
+    def _reschedule(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._heap:
+            self._handle = self._loop.call_at(self._heap[0][0], self._fire)
+
+    def _fire(self):
+        self._handle = None
+        heap = self._heap
+        now = self._loop.time() + _CLOCK_RESOLUTION
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as exc:
+                self._loop.call_exception_handler({
+                    'message': "Exception in timer callback",
+                    'exception': exc,
+                })
+        self._reschedule()
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel: timers are dropped into one of ``slots`` buckets by
+    the tick they're due on, and the wheel visits a bucket per tick. Adding
+    and cancelling are O(1), however many timers are pending, at the cost of
+    firing up to ``resolution`` seconds late.
+
+    Suited to timeouts, which are set often and nearly always cancelled
+    before they fire. The wheel only ticks while it has timers pending.
+    """
+
+    def __init__(self, resolution=0.01, slots=512):
+        """
+        :param float resolution: Seconds per tick.
+        :param int slots: Buckets in the wheel. Timers further out than
+            ``resolution * slots`` go round more than once before firing.
+        """
+
+        self.resolution = resolution
+        self._slots = [[] for _ in range(slots)]
+        # Entries in the buckets, cancelled or not.
+        self._count = 0
+        # The last tick that has been processed.
+        self._tick = None
+        self._loop = None
+        self._handle = None
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of timers pending, including cancelled ones
+            that haven't been dropped yet.
+        """
+
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        """
+        :param float delay: Seconds from now to run ``callback``.
+        :param callable callback: Called with ``args``.
+        :rtype: Timer
+        """
+
+        if not self._count:
+            self._loop = asyncio.get_running_loop()
+            self._tick = int(self._loop.time() / self.resolution)
+        when = self._loop.time() + delay
+        tick = max(int(math.ceil(when / self.resolution)), self._tick + 1)
+        timer = Timer(when, callback, args)
+        self._slots[tick % len(self._slots)].append((tick, timer))
+        self._count += 1
+        if self._handle is None:
+            self._schedule()
+        return timer
+
+    def _schedule(self):
+        self._handle = self._loop.call_at(
+            (self._tick + 1) * self.resolution, self._advance)
+
+    def _advance(self):
+        self._handle = None
+        slots = self._slots
+        now = int((self._loop.time() + _CLOCK_RESOLUTION) / self.resolution)
+        # After a stall, one lap visits every bucket.
+        last = min(now, self._tick + len(slots))
+        for tick in range(self._tick + 1, last + 1):
+            bucket = slots[tick % len(slots)]
+            if not bucket:
+                continue
+            pending = []
+            for entry in bucket:
+                timer = entry[1]
+                if timer.cancelled:
+                    self._count -= 1
+                elif entry[0] <= now:
+                    self._count -= 1
+                    self._run(timer)
+                else:
+                    pending.append(entry)
+            slots[tick % len(slots)] = pending
+        self._tick = max(self._tick, now)
+        # Callbacks that set timers of their own have scheduled the next
+        # tick already.
+        if self._count and self._handle is None:
+            self._schedule()
+
+    def _run(self, timer):
+        try:
+            timer.callback(*timer.args)
+        except Exception as exc:
+            self._loop.call_exception_handler({
+                'message': "Exception in timer callback",
+                'exception': exc,
+            })
+
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+def get_timer_wheel():
+    """
+    :rtype: TimerWheel
+    :returns: The running event loop's shared timer wheel, so that every
+        connection's timeouts tick together.
+    """
+
+    loop = asyncio.get_running_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel()
+    return wheel
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
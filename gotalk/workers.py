@@ -0,0 +1,255 @@
+"""
+Running a server across several processes, to use more than one core.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+import weakref
+
+from gotalk.connection import Connection
+from gotalk.server import start_server
+
+logger = logging.getLogger(__name__)
+
+# Workers that die sooner than this after starting aren't restarted straight
+# away, so that a crash on startup doesn't turn into a fork loop.
+MIN_WORKER_LIFETIME = 1.0
+# A stopping worker closes the connections it has accepted once they've had
+# nothing in flight, and nothing from the peer, for this long. That leaves
+# time for the first request on a connection accepted just before the
+# worker stopped.
+SHUTDOWN_QUIET_TIME = 0.5
+
+
+class WorkerPool(object):
+    """
+    Forks worker processes that each run their own event loop and server on
+    the same port, with ``SO_REUSEPORT`` letting the kernel spread incoming
+    connections between them. Handlers are registered before the workers
+    are forked, so every worker serves the same operations.
+
+    The parent process opens the listening sockets, one per worker, and
+    only supervises: workers that die are replaced, ``SIGHUP`` replaces
+    every worker with a fresh one, and ``SIGTERM`` or ``SIGINT`` shut
+    everything down. Either way, outgoing workers stop accepting
+    connections straight away, but keep serving the ones they have until
+    those go quiet, for up to ``shutdown_timeout`` seconds. A replacement
+    worker takes over its predecessor's socket, connections still queued on
+    it included.
+
+    Usage::
+
+        handlers = Handlers()
+        ...
+        WorkerPool(handlers, "0.0.0.0", 1234, workers=32).run()
+
+    Only available where ``os.fork()`` and ``SO_REUSEPORT`` are, such as
+    Linux and the BSDs.
+    """
+
+    def __init__(self, handlers, host, port, workers=None,
+                 connection_class=Connection, shutdown_timeout=10.0,
+                 **kwargs):
+        """
+        :param Handlers handlers: The operations and notifications to serve.
+        :param str host: The interface to listen on.
+        :param int port: The port to listen on. If 0, a free port is picked
+            and stored in :py:attr:`port`.
+        :param int workers: How many worker processes to run. Defaults to
+            one per CPU.
+        :param type connection_class: The ``Connection`` sub-class to use.
+        :param float shutdown_timeout: Seconds a stopping worker waits for
+            its connections to go quiet.
+        :param kwargs: Passed on to :py:func:`gotalk.server.start_server`.
+        :raises: RuntimeError if the platform can't do this.
+        """
+
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError(
+                "Worker processes need os.fork() and SO_REUSEPORT.")
+        self.handlers = handlers
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.connection_class = connection_class
+        self.shutdown_timeout = shutdown_timeout
+        self._server_kwargs = kwargs
+        # pid -> (when the worker was started, the socket it accepts on).
+        self._pids = {}
+        # Workers that have been told to stop, and shouldn't be replaced.
+        self._retiring = set()
+        self._running = False
+        self._sockets = []
+
+    @property
+    def pids(self):
+        """
+        :rtype: list
+        :returns: The process IDs of the running workers.
+        """
+
+        return [pid for pid in self._pids if pid not in self._retiring]
+
+    def start(self):
+        """
+        Opens the listening sockets and forks the workers, then returns.
+        Call :py:meth:`run` to supervise them.
+        """
+
+        if self._running:
+            return
+        # The sockets stay open here for as long as we run, so that what's
+        # queued on one when its worker stops is left for the next one to
+        # accept, instead of being reset by the kernel.
+        family = socket.AF_INET6 if ":" in (self.host or "") \
+            else socket.AF_INET
+        for _ in range(self.workers):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.host or "", self.port))
+            # The rest bind to the port the first one got, if we asked for
+            # any.
+            self.port = sock.getsockname()[1]
+            sock.listen(self._server_kwargs.get("backlog", 100))
+            self._sockets.append(sock)
+        self._running = True
+        for sock in self._sockets:
+            self._spawn(sock)
+
+    def run(self):
+        """
+        Starts the workers if needed, and supervises them until told to
+        stop. Blocks, and installs handlers for ``SIGTERM``, ``SIGINT`` and
+        ``SIGHUP``, so call it from the main thread.
+        """
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.restart())
+        self.start()
+        try:
+            while self._pids:
+                try:
+                    pid, _ = os.waitpid(-1, 0)
+                except ChildProcessError:
+                    break
+                self._reap(pid)
+        finally:
+            for sock in self._sockets:
+                sock.close()
+            self._sockets = []
+
+    def restart(self):
+        """
+        Replaces every worker with a fresh one. Each new worker is started
+        on its predecessor's socket before the old one is stopped, so
+        connections are accepted throughout, and none are dropped.
+        """
+
+        if not self._running:
+            return
+        old = self.pids
+        for pid in old:
+            self._spawn(self._pids[pid][1])
+        for pid in old:
+            self._terminate(pid)
+
+    def stop(self):
+        """
+        Tells every worker to stop. :py:meth:`run` returns once they have.
+        """
+
+        self._running = False
+        for pid in list(self._pids):
+            self._terminate(pid)
+
+    def _spawn(self, sock):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker(sock)
+            except BaseException:
+                # os._exit() skips the usual traceback on the way out.
+                logger.exception("Worker {pid} failed.".format(
+                    pid=os.getpid()))
+                code = 1
+            finally:
+                # Never fall back into the parent's code.
+                os._exit(code)
+        self._pids[pid] = (time.monotonic(), sock)
+
+    def _terminate(self, pid):
+        self._retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self, pid):
+        worker = self._pids.pop(pid, None)
+        if worker is None:
+            return
+        if pid in self._retiring:
+            self._retiring.discard(pid)
+            return
+        started, sock = worker
+        if self._running:
+            lifetime = time.monotonic() - started
+            if lifetime < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME - lifetime)
+            if self._running:
+                self._spawn(sock)
+
+    def _run_worker(self, sock):
+        for other in self._sockets:
+            if other is not sock:
+                other.close()
+        # The parent decides when workers stop.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        asyncio.run(self._serve(sock))
+
+    async def _serve(self, sock):
+        loop = asyncio.get_running_loop()
+        # Closed connections drop out by themselves.
+        connections = weakref.WeakSet()
+
+        def connection_factory(handlers):
+            connection = self.connection_class(handlers)
+            connections.add(connection)
+            return connection
+
+        server = await start_server(
+            self.handlers, sock=sock, connection_class=connection_factory,
+            **self._server_kwargs)
+        stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+        await stopping.wait()
+        server.close()
+        # Let requests that are already being handled, or on their way,
+        # finish.
+        give_up = loop.time() + self.shutdown_timeout
+        busy = True
+        while busy:
+            now = loop.time()
+            busy = False
+            for connection in list(connections):
+                if connection.is_closing:
+                    continue
+                if now < give_up and (
+                        connection._tasks or now - connection._last_received
+                        < SHUTDOWN_QUIET_TIME):
+                    busy = True
+                else:
+                    connection.close()
+            if busy:
+                await asyncio.sleep(SHUTDOWN_QUIET_TIME / 10)
+        connections = list(connections)
+        await asyncio.gather(
+            *[connection.wait_closed() for connection in connections])
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import os
 import re
-import sys
 
 from setuptools import setup, find_packages
 
@@ -33,12 +32,9 @@ classes = """
     License :: OSI Approved :: BSD License
     Topic :: System :: Distributed Computing
     Programming Language :: Python
-    Programming Language :: Python :: 2
-    Programming Language :: Python :: 2.6
-    Programming Language :: Python :: 2.7
     Programming Language :: Python :: 3
-    Programming Language :: Python :: 3.3
-    Programming Language :: Python :: 3.4
+    Programming Language :: Python :: 3 :: Only
+    Programming Language :: Python :: 3.8
     Programming Language :: Python :: Implementation :: CPython
     Operating System :: OS Independent
 """
@@ -46,8 +42,6 @@ classifiers = [s.strip() for s in classes.split('\n') if s]
 
 
 install_requires = get_requirements('install.txt')
-if sys.version_info < (3, 0):
-    install_requires.append('futures')
 
 
 setup(
@@ -60,8 +54,10 @@ setup(
     url='https://github.com/gtaylor/python-gotalk',
     license='BSD',
     classifiers=classifiers,
-    packages=find_packages(exclude=['tests', 'tests.*']),
+    packages=find_packages(
+        exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*']),
     install_requires=install_requires,
+    python_requires='>=3.8',
     test_suite="tests",
     tests_require=get_requirements('test.txt'),
 )
@@ -0,0 +1,187 @@
+import asyncio
+import random
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from gotalk.balancer import LeastOutstandingBalancer, \
+    PowerOfTwoChoicesBalancer
+from gotalk.exceptions import ConnectionClosedError
+from gotalk.handlers import Handlers
+from gotalk.server import start_server
+
+PEERS = [("a", 1), ("b", 1), ("c", 1)]
+
+
+class FakeConnection(object):
+
+    def __init__(self, peer_load):
+        self.peer_load = peer_load
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.loads = {}
+
+    def connections(self, host, port):
+        load = self.loads.get((host, port))
+        return [] if load is None else [FakeConnection(load)]
+
+
+class CostTest(TestCase):
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.balancer = LeastOutstandingBalancer(PEERS, pool=self.pool)
+
+    def test_outstanding(self):
+        """
+        Peers we're waiting on more are more expensive.
+        """
+
+        self.balancer._outstanding[("a", 1)] = 2
+        self.balancer._outstanding[("b", 1)] = 1
+        self.balancer._outstanding[("c", 1)] = 3
+        self.assertEqual(self.balancer.choose(), ("b", 1))
+
+    def test_load(self):
+        """
+        The load peers report in heartbeats counts against them.
+        """
+
+        self.pool.loads = {("a", 1): 5, ("b", 1): 0, ("c", 1): 2}
+        self.assertEqual(self.balancer.choose(), ("b", 1))
+
+    def test_latency(self):
+        """
+        Slow peers are more expensive, and unknown ones average.
+        """
+
+        self.balancer._latency = {("a", 1): 0.3, ("b", 1): 0.1}
+        self.assertEqual(self.balancer.cost(("c", 1)), 0.2)
+        self.assertEqual(self.balancer.choose(), ("b", 1))
+        self.balancer._record_latency(("b", 1), 0.9)
+        self.assertAlmostEqual(self.balancer._latency[("b", 1)], 0.2)
+
+    def test_no_peers(self):
+        """
+        A balancer without peers is a mistake.
+        """
+
+        self.assertRaises(ValueError, LeastOutstandingBalancer, [])
+
+    def test_penalty(self):
+        """
+        Failures make a peer more expensive, up to a point, and a success
+        clears the penalty.
+        """
+
+        peer = ("a", 1)
+        self.balancer.penalty_half_life = 3600
+        self.balancer._penalize(peer)
+        self.assertAlmostEqual(self.balancer.cost(peer), 2.0)
+        for _ in range(20):
+            self.balancer._penalize(peer)
+        self.assertAlmostEqual(self.balancer.cost(peer), 64.0, places=2)
+        self.balancer._penalties.pop(peer)
+        self.assertEqual(self.balancer.cost(peer), 1.0)
+
+
+class PowerOfTwoChoicesTest(TestCase):
+
+    def test_choose(self):
+        """
+        The cheaper of two random peers is picked, so the most expensive
+        peer never is.
+        """
+
+        pool = FakePool()
+        pool.loads = {("a", 1): 0, ("b", 1): 1, ("c", 1): 9}
+        balancer = PowerOfTwoChoicesBalancer(
+            PEERS, pool=pool, rng=random.Random(0))
+        chosen = set(balancer.choose() for _ in range(100))
+        self.assertEqual(chosen, {("a", 1), ("b", 1)})
+
+    def test_single_peer(self):
+        """
+        With one peer there's nothing to choose between.
+        """
+
+        balancer = PowerOfTwoChoicesBalancer(PEERS[:1], pool=FakePool())
+        self.assertEqual(balancer.choose(), ("a", 1))
+
+
+class BalancerTest(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        # The delay of every request handled, by whichever server.
+        self.handled = []
+        # (host, port) -> the server listening there.
+        self.servers = {}
+
+    async def start(self, delay, port=0):
+        handlers = Handlers()
+
+        @handlers.request("work")
+        async def work(payload):
+            self.handled.append(delay)
+            await asyncio.sleep(delay)
+            return bytes(payload)
+
+        server = await start_server(handlers, "127.0.0.1", port)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        address = ("127.0.0.1", server.sockets[0].getsockname()[1])
+        self.servers[address] = server
+        return address
+
+    async def test_prefers_fast_peer(self):
+        """
+        Slow peers get fewer requests.
+        """
+
+        fast = await self.start(0)
+        slow = await self.start(0.02)
+        balancer = LeastOutstandingBalancer([fast, slow])
+        self.addAsyncCleanup(balancer.wait_closed)
+        self.addCleanup(balancer.close)
+        for _ in range(10):
+            await asyncio.gather(
+                *[balancer.request("work", b"x") for _ in range(4)])
+        self.assertLess(balancer._latency[fast], balancer._latency[slow])
+        self.assertEqual(balancer._outstanding, {fast: 0, slow: 0})
+        self.assertGreater(self.handled.count(0), self.handled.count(0.02))
+
+    async def test_recovery(self):
+        """
+        A peer that failed gets requests again once it's back.
+        """
+
+        fast = await self.start(0)
+        slow = await self.start(0.02)
+        balancer = LeastOutstandingBalancer([fast, slow])
+        balancer.penalty_half_life = 0.05
+        self.addAsyncCleanup(balancer.wait_closed)
+        self.addCleanup(balancer.close)
+        await asyncio.gather(
+            *[balancer.request("work", b"x") for _ in range(4)])
+
+        # Take the fast peer down, and wait for the balancer to give up on
+        # it.
+        server = self.servers.pop(fast)
+        server.close()
+        await server.wait_closed()
+        for connection in balancer.pool.connections(*fast):
+            connection.close()
+        for _ in range(10):
+            try:
+                await balancer.request("work", b"x")
+            except (ConnectionClosedError, OSError):
+                continue
+            break
+        self.assertEqual(self.handled[-1], 0.02)
+
+        await self.start(0, port=fast[1])
+        await asyncio.sleep(0.5)
+        del self.handled[:]
+        await balancer.request("work", b"x")
+        self.assertEqual(self.handled, [0])
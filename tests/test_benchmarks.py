@@ -0,0 +1,31 @@
+from unittest import TestCase
+
+from benchmarks import codec
+
+
+class CodecBenchmarkTest(TestCase):
+
+    def test_run(self):
+        """
+        Every benchmark runs, and a run compares evenly with itself.
+        """
+
+        results = codec.run(sizes=[0, 64], min_time=0.0001, repeat=1)
+        names = set(result["name"] for result in results["results"])
+        self.assertIn("encode/SingleRequest", names)
+        self.assertIn("decode/Heartbeat", names)
+        self.assertIn("decode_stream", names)
+        ratios = codec.compare(results, results)
+        self.assertEqual(len(ratios), len(results["results"]))
+        self.assertTrue(all(ratio == 1.0 for _, _, ratio in ratios))
+
+    def test_filter(self):
+        """
+        Only benchmarks matching the pattern are run.
+        """
+
+        results = codec.run(
+            sizes=[64], min_time=0.0001, repeat=1, pattern="decode_mixed")
+        self.assertEqual(
+            [result["name"] for result in results["results"]],
+            ["decode_mixed"])
@@ -0,0 +1,118 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from gotalk.client import ConnectionPool
+from gotalk.exceptions import ConnectionClosedError
+from gotalk.handlers import Handlers
+from gotalk.server import start_server
+
+
+class ConnectionPoolTest(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        handlers = Handlers()
+        self.release = asyncio.Event()
+
+        @handlers.request("echo")
+        def echo(payload):
+            return bytes(payload)
+
+        @handlers.request("wait")
+        async def wait(payload):
+            await self.release.wait()
+            return bytes(payload)
+
+        self.server = await start_server(handlers, "127.0.0.1", 0)
+        self.addAsyncCleanup(self.server.wait_closed)
+        self.addCleanup(self.server.close)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def make_pool(self, **kwargs):
+        pool = ConnectionPool(**kwargs)
+        self.addAsyncCleanup(pool.wait_closed)
+        self.addCleanup(pool.close)
+        return pool
+
+    async def test_reuse(self):
+        """
+        Sequential requests to a peer share one connection.
+        """
+
+        pool = self.make_pool()
+        for i in range(5):
+            payload = str(i).encode("ascii")
+            self.assertEqual(
+                await pool.request("127.0.0.1", self.port, "echo", payload),
+                payload)
+        self.assertEqual(len(pool), 1)
+
+    async def test_concurrent_opens(self):
+        """
+        A burst of requests at a cold pool opens one connection, not one
+        per request.
+        """
+
+        pool = self.make_pool()
+        results = await asyncio.gather(*[
+            pool.request("127.0.0.1", self.port, "echo", b"x")
+            for _ in range(20)])
+        self.assertEqual(results, [b"x"] * 20)
+        self.assertEqual(len(pool), 1)
+
+    async def test_max_per_host(self):
+        """
+        Busy connections are joined by more, up to the per-host limit, after
+        which requests share the least loaded one.
+        """
+
+        pool = self.make_pool(max_per_host=2, max_in_flight=1)
+        calls = [
+            asyncio.ensure_future(
+                pool.request("127.0.0.1", self.port, "wait", b"x"))
+            for _ in range(5)]
+        while sum(c.in_flight for c in pool._last_used) < 5:
+            await asyncio.sleep(0.001)
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(
+            sorted(c.in_flight for c in pool._last_used), [2, 3])
+        self.release.set()
+        self.assertEqual(await asyncio.gather(*calls), [b"x"] * 5)
+
+    async def test_idle_timeout(self):
+        """
+        Connections that sit unused are closed, and replaced when needed.
+        """
+
+        pool = self.make_pool(idle_timeout=0.01)
+        await pool.request("127.0.0.1", self.port, "echo", b"x")
+        connection = await pool.get("127.0.0.1", self.port)
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(pool), 0)
+        self.assertTrue(connection.is_closing)
+        await pool.request("127.0.0.1", self.port, "echo", b"x")
+        self.assertEqual(len(pool), 1)
+
+    async def test_dead_connections(self):
+        """
+        Connections closed under the pool aren't handed out again.
+        """
+
+        pool = self.make_pool()
+        connection = await pool.get("127.0.0.1", self.port)
+        connection.close()
+        await connection.wait_closed()
+        self.assertIsNot(await pool.get("127.0.0.1", self.port), connection)
+        self.assertEqual(len(pool), 1)
+
+    async def test_closed(self):
+        """
+        A closed pool closes its connections and refuses to open more.
+        """
+
+        pool = self.make_pool()
+        connection = await pool.get("127.0.0.1", self.port)
+        pool.close()
+        await pool.wait_closed()
+        self.assertTrue(connection.is_closing)
+        with self.assertRaises(ConnectionClosedError):
+            await pool.get("127.0.0.1", self.port)
@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+from gotalk.protocol.codecs import CodecRegistry
+from gotalk.protocol.framing import FrameDecoder
+from gotalk.protocol.messages import get_codecs, read_message, \
+    register_message_type, write_message
+from gotalk.protocol.version01.messages import SingleResultMessage, \
+    ErrorResultMessage
+
+
+_PROTO_VERSION = "01"
+
+
+class ExtensionMessage(SingleResultMessage):
+    """
+    A made-up message type laid out like a single result.
+    """
+
+    type_id = "x"
+
+
+class CodecRegistryTest(TestCase):
+
+    def tearDown(self):
+        codecs = get_codecs(_PROTO_VERSION)
+        type_byte = ord(ExtensionMessage.type_id)
+        codecs.message_classes.pop(type_byte, None)
+        codecs.decoders.pop(type_byte, None)
+        codecs.frame_lengths.pop(type_byte, None)
+        codecs.header_readers.pop(type_byte, None)
+
+    def test_builtin_tables(self):
+        """
+        Every version 01 message type is in the lookup tables.
+        """
+
+        codecs = get_codecs(_PROTO_VERSION)
+        self.assertEqual(
+            sorted(chr(type_byte) for type_byte in codecs.decoders),
+            sorted("rRspSEfenh"))
+        self.assertIs(
+            codecs.message_classes[ord("R")], SingleResultMessage)
+        self.assertEqual(
+            sorted(codecs.header_readers), sorted(codecs.decoders))
+
+    def test_register_message_type(self):
+        """
+        Newly registered message types can be read and framed.
+        """
+
+        register_message_type(ExtensionMessage)
+        m_bytes = write_message(
+            ExtensionMessage(request_id=b"0001", payload=b"hi"))
+        self.assertEqual(m_bytes, b"x000100000002hi")
+        message = read_message(m_bytes, _PROTO_VERSION)
+        self.assertIsInstance(message, ExtensionMessage)
+        self.assertEqual(message.payload, b"hi")
+
+        decoder = FrameDecoder(_PROTO_VERSION)
+        messages = decoder.feed(m_bytes + m_bytes)
+        self.assertEqual(
+            [type(message) for message in messages], [ExtensionMessage] * 2)
+
+    def test_conflict(self):
+        """
+        Type IDs can't be taken over by accident.
+        """
+
+        class Impostor(ErrorResultMessage):
+            type_id = "R"
+
+        codecs = CodecRegistry(_PROTO_VERSION)
+        codecs.register(SingleResultMessage)
+        # Registering the same class again is harmless.
+        codecs.register(SingleResultMessage)
+        self.assertRaises(ValueError, codecs.register, Impostor)
+        codecs.register(Impostor, replace=True)
+        self.assertIs(codecs.get_message_class(ord("R")), Impostor)
@@ -0,0 +1,702 @@
+import asyncio
+import io
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from gotalk.client import connect
+from gotalk.connection import Connection
+from gotalk.exceptions import ConnectionClosedError, ProtocolError, \
+    RemoteError, RequestTimeoutError, RetryRequestedError
+from gotalk.handlers import Handlers
+from gotalk.payloads import FilePayload
+from gotalk.protocol.pool import MessagePool
+from gotalk.protocol.version01.messages import NotificationMessage, \
+    RetryResultMessage
+from gotalk.server import start_server
+
+
+def _make_handlers():
+    handlers = Handlers()
+
+    @handlers.request("echo")
+    def echo(payload):
+        return bytes(payload)
+
+    @handlers.request("slow-echo")
+    async def slow_echo(payload):
+        await asyncio.sleep(0.01)
+        return bytes(payload)
+
+    @handlers.request("fail")
+    def fail(payload):
+        raise ValueError("nope")
+
+    @handlers.request("bad-result")
+    def bad_result(payload):
+        return 42
+
+    @handlers.request("hang")
+    async def hang(payload):
+        await asyncio.Event().wait()
+
+    @handlers.stream("upper")
+    async def upper(stream):
+        async for part in stream:
+            yield bytes(part).upper()
+
+    @handlers.stream("blob")
+    def blob(stream):
+        return io.BytesIO(b"#" * 200000)
+
+    @handlers.request("file")
+    def file(payload):
+        return FilePayload.open(bytes(payload).decode("utf-8"))
+
+    @handlers.stream("file-parts")
+    async def file_parts(stream):
+        path = bytes(await stream.read()).decode("utf-8")
+        return FilePayload.open(path)
+
+    @handlers.stream("count")
+    def count(stream):
+        return [b"1", b"2", b"3"]
+
+    return handlers
+
+
+class ConnectionTestCase(IsolatedAsyncioTestCase):
+    """
+    Runs a server on a loopback port for the duration of each test.
+    """
+
+    async def asyncSetUp(self):
+        self.handlers = _make_handlers()
+        self.server_connections = []
+        test = self
+
+        class RecordingConnection(Connection):
+            def connection_made(self, transport):
+                super(RecordingConnection, self).connection_made(transport)
+                test.server_connections.append(self)
+
+        self.server = await start_server(
+            self.handlers, "127.0.0.1", 0,
+            connection_class=RecordingConnection)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def connect(self, handlers=None):
+        connection = await connect("127.0.0.1", self.port, handlers)
+        self.addAsyncCleanup(connection.wait_closed)
+        self.addCleanup(connection.close)
+        return connection
+
+
+class RequestTest(ConnectionTestCase):
+
+    async def test_handshake(self):
+        """
+        Connecting completes the version exchange.
+        """
+
+        connection = await self.connect()
+        self.assertEqual(connection.ready.result(), "01")
+
+    async def test_request(self):
+        """
+        A single request gets its result back.
+        """
+
+        connection = await self.connect()
+        result = await connection.request("echo", b"Hello World")
+        self.assertEqual(result, b"Hello World")
+
+    async def test_concurrent_requests(self):
+        """
+        Many requests in flight on one connection all get the right result,
+        even when they complete out of order.
+        """
+
+        connection = await self.connect()
+        payloads = [str(i).encode("ascii") for i in range(500)]
+        results = await asyncio.gather(*[
+            connection.request("slow-echo" if i % 2 else "echo", payload)
+            for i, payload in enumerate(payloads)])
+        self.assertEqual(results, payloads)
+
+    async def test_message_pool(self):
+        """
+        Connections can recycle the messages they decode.
+        """
+
+        pool = MessagePool()
+        connection = await connect(
+            "127.0.0.1", self.port,
+            connection_class=lambda handlers: Connection(
+                handlers, message_pool=pool))
+        self.addAsyncCleanup(connection.wait_closed)
+        self.addCleanup(connection.close)
+        for i in range(3):
+            payload = str(i).encode("ascii")
+            self.assertEqual(
+                await connection.request("slow-echo", payload), payload)
+        self.assertEqual(len(pool), 1)
+
+    async def test_handler_error(self):
+        """
+        Exceptions raised by handlers come back as error results.
+        """
+
+        connection = await self.connect()
+        with self.assertRaises(RemoteError) as ctx:
+            await connection.request("fail", b"")
+        self.assertEqual(ctx.exception.payload, b"nope")
+
+    async def test_bad_result(self):
+        """
+        A result that can't be sent comes back as an error result, rather
+        than leaving the request hanging.
+        """
+
+        connection = await self.connect()
+        with self.assertRaises(RemoteError):
+            await asyncio.wait_for(connection.request("bad-result", b""), 1)
+        self.assertEqual(
+            await connection.request("echo", b"still here"), b"still here")
+
+    async def test_unknown_operation(self):
+        """
+        Requests for operations nobody handles fail.
+        """
+
+        connection = await self.connect()
+        with self.assertRaises(RemoteError) as ctx:
+            await connection.request("nope", b"")
+        self.assertEqual(ctx.exception.payload, b'Unknown operation "nope"')
+
+    async def test_retry_result(self):
+        """
+        Retry results surface the requested wait.
+        """
+
+        connection = await self.connect()
+        task = asyncio.ensure_future(connection.request("hang", b""))
+        await asyncio.sleep(0.01)
+        request_id = next(iter(dict(connection._requests.items())))
+        connection.data_received(
+            RetryResultMessage(request_id, 250, b"restarting").to_bytes())
+        with self.assertRaises(RetryRequestedError) as ctx:
+            await task
+        self.assertEqual(ctx.exception.wait, 250)
+
+    async def test_close_fails_pending(self):
+        """
+        Requests waiting on a closed connection don't hang.
+        """
+
+        connection = await self.connect()
+        task = asyncio.ensure_future(connection.request("hang", b""))
+        await asyncio.sleep(0.01)
+        connection.close()
+        with self.assertRaises(ConnectionClosedError):
+            await task
+        with self.assertRaises(ConnectionClosedError):
+            await connection.request("echo", b"")
+
+    async def test_malformed_frame_length(self):
+        """
+        A payloadSize that isn't plain hex gets a protocol error back,
+        rather than stalling the server.
+        """
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        try:
+            writer.write(b"01R0001-000000d")
+            reply = await asyncio.wait_for(reader.read(), 1)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        self.assertEqual(reply, b"01f00000002")
+        # And everybody else is still being served.
+        connection = await self.connect()
+        self.assertEqual(await connection.request("echo", b"hi"), b"hi")
+
+
+class TimeoutTest(ConnectionTestCase):
+
+    async def test_request_timeout(self):
+        """
+        Requests that take too long fail, and are dropped from the in-flight
+        table.
+        """
+
+        connection = await self.connect()
+        with self.assertRaises(RequestTimeoutError):
+            await connection.request("hang", b"", timeout=0.02)
+        self.assertEqual(connection.in_flight, 0)
+        self.assertEqual(await connection.request("echo", b"x", 1), b"x")
+
+    async def test_default_timeout(self):
+        """
+        Connections can give every request a timeout.
+        """
+
+        connection = await connect(
+            "127.0.0.1", self.port,
+            connection_class=lambda handlers: Connection(
+                handlers, request_timeout=0.02))
+        self.addAsyncCleanup(connection.wait_closed)
+        self.addCleanup(connection.close)
+        with self.assertRaises(RequestTimeoutError):
+            await connection.request("hang")
+        call = connection.stream_request("upper", b"never closed")
+        with self.assertRaises(RequestTimeoutError):
+            async for part in call:
+                pass
+        self.assertEqual(connection.in_flight, 0)
+
+    async def test_late_result(self):
+        """
+        Results that arrive after the deadline are discarded.
+        """
+
+        connection = await self.connect()
+        with self.assertRaises(RequestTimeoutError):
+            await connection.request("slow-echo", b"late", timeout=0.001)
+        await asyncio.sleep(0.02)
+        self.assertEqual(connection.in_flight, 0)
+        self.assertFalse(connection.is_closing)
+
+    async def test_expired_id_reserved(self):
+        """
+        The ID of a request that timed out isn't handed out again until its
+        result has turned up, so that it can't be taken for another
+        request's.
+        """
+
+        connection = await self.connect()
+        with self.assertRaises(RequestTimeoutError):
+            await connection.request("slow-echo", b"late", timeout=0.001)
+        # Come straight back around to the expired request's ID.
+        connection._requests._next -= 1
+        self.assertEqual(
+            await connection.request("slow-echo", b"fresh"), b"fresh")
+        await asyncio.sleep(0.02)
+        self.assertEqual(len(connection._requests), 0)
+
+    async def test_stream_deadline_cancelled(self):
+        """
+        A stream request's deadline is cancelled once its results are in,
+        rather than holding on to the stream until it comes due.
+        """
+
+        connection = await self.connect()
+        call = connection.stream_request("count", timeout=60)
+        self.assertEqual(len(connection._stream_deadlines), 1)
+        deadline = connection._stream_deadlines[call.results]
+        self.assertEqual([bytes(part) async for part in call],
+                         [b"1", b"2", b"3"])
+        self.assertEqual(connection._stream_deadlines, {})
+        self.assertTrue(deadline.cancelled)
+
+    async def test_cancel(self):
+        """
+        Cancelled requests are dropped from the in-flight table.
+        """
+
+        connection = await self.connect()
+        task = asyncio.ensure_future(connection.request("hang"))
+        await asyncio.sleep(0.01)
+        self.assertEqual(connection.in_flight, 1)
+        task.cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(connection.in_flight, 0)
+
+        call = connection.stream_request("upper", b"x")
+        call.cancel()
+        self.assertEqual(connection.in_flight, 0)
+        self.assertEqual([part async for part in call], [])
+
+
+class NotificationTest(ConnectionTestCase):
+
+    async def test_notification(self):
+        """
+        Notifications reach the handler on the other end.
+        """
+
+        received = asyncio.get_running_loop().create_future()
+        self.handlers.register_notification(
+            "chat", lambda payload: received.set_result(bytes(payload)))
+        connection = await self.connect()
+        connection.notify("chat", b"Hi")
+        self.assertEqual(await received, b"Hi")
+
+    async def test_handler_error(self):
+        """
+        A notification handler that raises is reported, without closing
+        the connection or losing the messages that arrived with it.
+        """
+
+        loop = asyncio.get_running_loop()
+        errors = []
+        loop.set_exception_handler(
+            lambda loop, context: errors.append(context["exception"]))
+        self.addCleanup(loop.set_exception_handler, None)
+
+        def broken(payload):
+            raise ValueError("nope")
+
+        async def broken_async(payload):
+            raise ValueError("nope")
+
+        self.handlers.register_notification("broken", broken)
+        self.handlers.register_notification("broken-async", broken_async)
+        connection = await self.connect()
+        connection.notify("broken", b"")
+        connection.notify("broken-async", b"")
+        self.assertEqual(await connection.request("echo", b"hi"), b"hi")
+        self.assertEqual(await connection.request("echo", b"hi"), b"hi")
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(
+            all(isinstance(exc, ValueError) for exc in errors))
+
+    async def test_server_to_client(self):
+        """
+        Either end can make requests of the other.
+        """
+
+        client_handlers = Handlers()
+        client_handlers.register_request("whoami", lambda payload: b"client")
+        await self.connect(client_handlers)
+        server_connection = self.server_connections[0]
+        await server_connection.ready
+        result = await server_connection.request("whoami")
+        self.assertEqual(result, b"client")
+
+
+class FilePayloadTest(ConnectionTestCase):
+
+    async def asyncSetUp(self):
+        await super(FilePayloadTest, self).asyncSetUp()
+        f = tempfile.NamedTemporaryFile()
+        self.addCleanup(f.close)
+        self.contents = bytes(range(256)) * 1024
+        f.write(self.contents)
+        f.flush()
+        self.path = f.name
+
+    async def test_single_result(self):
+        """
+        File payloads are sent without being read in first, and messages
+        written after them wait their turn.
+        """
+
+        connection = await self.connect()
+        results = await asyncio.gather(
+            connection.request("file", self.path.encode("utf-8")),
+            connection.request("echo", b"after"))
+        self.assertEqual(bytes(results[0]), self.contents)
+        self.assertEqual(results[1], b"after")
+
+    async def test_stream_result(self):
+        """
+        File payloads returned from stream handlers go out in chunks.
+        """
+
+        connection = await self.connect()
+        call = connection.stream_request(
+            "file-parts", self.path.encode("utf-8"))
+        call.close()
+        parts = [bytes(part) async for part in call]
+        self.assertEqual(b"".join(parts), self.contents)
+        self.assertEqual(len(parts), 4)
+
+    async def test_close_waits_for_file(self):
+        """
+        Closing while a file is being sent lets it finish first.
+        """
+
+        received = []
+        handlers = Handlers()
+        handlers.register_notification("file", received.append)
+        connection = await self.connect(handlers)
+        await connection.request("echo", b"")
+        server_connection = self.server_connections[0]
+        with open(self.path, "rb") as f:
+            server_connection.write_message(
+                NotificationMessage("file", FilePayload(f)))
+            server_connection.notify("done", b"")
+            server_connection.close()
+            self.assertTrue(server_connection.is_closing)
+            await server_connection.wait_closed()
+        await connection.wait_closed()
+        self.assertEqual(bytes(received[0]), self.contents)
+
+
+class StreamTest(ConnectionTestCase):
+
+    async def test_stream_echo(self):
+        """
+        Request parts flow to the handler and result parts flow back.
+        """
+
+        connection = await self.connect()
+        call = connection.stream_request("upper", b"hello ")
+        call.send(b"world")
+        call.close()
+        parts = [bytes(part) async for part in call]
+        self.assertEqual(b"".join(parts), b"HELLO WORLD")
+
+    async def test_stream_sync_results(self):
+        """
+        Stream handlers may return a plain iterable.
+        """
+
+        connection = await self.connect()
+        call = connection.stream_request("count")
+        call.close()
+        self.assertEqual([bytes(part) async for part in call],
+                         [b"1", b"2", b"3"])
+
+    async def test_stream_backpressure(self):
+        """
+        Streams bigger than the buffer limits still make it through.
+        """
+
+        connection = await connect(
+            "127.0.0.1", self.port,
+            connection_class=lambda handlers: Connection(
+                handlers, stream_buffer_limit=1024,
+                connection_buffer_limit=4096))
+        self.addAsyncCleanup(connection.wait_closed)
+        self.addCleanup(connection.close)
+        call = connection.stream_request("upper")
+        for _ in range(64):
+            call.send(b"x" * 512)
+            await call.drain()
+        call.close()
+        received = 0
+        async for part in call:
+            received += len(part)
+            await asyncio.sleep(0)
+        self.assertEqual(received, 64 * 512)
+        self.assertEqual(connection._flow_control.buffered, 0)
+
+    async def test_stream_chunked(self):
+        """
+        Large payloads go both ways as a series of bounded parts.
+        """
+
+        connection = await self.connect()
+        call = connection.stream_request("upper")
+        await call.send_from(io.BytesIO(b"x" * 200000), chunk_size=1000)
+        call.close()
+        parts = [bytes(part) async for part in call]
+        self.assertEqual(b"".join(parts), b"X" * 200000)
+        self.assertEqual(max(len(part) for part in parts), 1000)
+
+        call = connection.stream_request("blob")
+        call.close()
+        parts = [bytes(part) async for part in call]
+        self.assertEqual(b"".join(parts), b"#" * 200000)
+        self.assertEqual(len(parts), 4)
+
+    async def test_stream_unknown_operation(self):
+        """
+        Unknown stream operations fail the result stream.
+        """
+
+        connection = await self.connect()
+        call = connection.stream_request("nope", b"x")
+        with self.assertRaises(RemoteError):
+            async for part in call:
+                pass
+
+
+class FakeTransport(asyncio.Transport):
+    """
+    Records writes instead of sending them anywhere.
+    """
+
+    def __init__(self):
+        super(FakeTransport, self).__init__()
+        self.writes = []
+        self.closed = False
+
+    def writelines(self, buffers):
+        self.writes.append(b"".join(buffers))
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class WriteCoalescingTest(IsolatedAsyncioTestCase):
+
+    async def test_one_write_per_tick(self):
+        """
+        Messages written during one loop iteration go out in one write.
+        """
+
+        transport = FakeTransport()
+        connection = Connection()
+        connection.connection_made(transport)
+        for i in range(100):
+            connection.notify("ping", b"")
+        self.assertEqual(transport.writes, [])
+        await asyncio.sleep(0)
+        self.assertEqual(len(transport.writes), 1)
+        self.assertEqual(
+            transport.writes[0], b"01" + b"n004ping00000000" * 100)
+
+    async def test_close_flushes(self):
+        """
+        Closing doesn't drop messages that haven't been flushed yet.
+        """
+
+        transport = FakeTransport()
+        connection = Connection()
+        connection.connection_made(transport)
+        connection.notify("bye", b"")
+        connection.close()
+        self.assertEqual(transport.writes, [b"01n003bye00000000"])
+        self.assertTrue(transport.closed)
+
+
+    async def test_drain(self):
+        """
+        Draining waits while the transport has asked us to stop writing.
+        """
+
+        transport = FakeTransport()
+        connection = Connection()
+        connection.connection_made(transport)
+        await connection.drain()
+        connection.pause_writing()
+        drain = asyncio.ensure_future(connection.drain())
+        await asyncio.sleep(0)
+        self.assertFalse(drain.done())
+        connection.resume_writing()
+        await drain
+
+    async def test_drain_closed(self):
+        """
+        Losing the connection wakes anyone waiting to drain.
+        """
+
+        transport = FakeTransport()
+        connection = Connection()
+        connection.connection_made(transport)
+        connection.pause_writing()
+        drain = asyncio.ensure_future(connection.drain())
+        await asyncio.sleep(0)
+        connection.connection_lost(None)
+        with self.assertRaises(ConnectionClosedError):
+            await drain
+
+
+class HeartbeatTest(ConnectionTestCase):
+
+    async def connect_with_heartbeats(self, **kwargs):
+        connection = await connect(
+            "127.0.0.1", self.port,
+            connection_class=lambda handlers: Connection(handlers, **kwargs))
+        self.addAsyncCleanup(connection.wait_closed)
+        self.addCleanup(connection.close)
+        return connection
+
+    async def test_heartbeats(self):
+        """
+        Heartbeats carry the sender's load, and requests update the RTT.
+        """
+
+        connection = await self.connect_with_heartbeats(
+            heartbeat_interval=0.01)
+        self.assertIsNone(connection.rtt)
+        await connection.request("echo", b"x")
+        self.assertGreater(connection.rtt, 0)
+        server_connection = self.server_connections[0]
+        while server_connection.peer_time is None:
+            await asyncio.sleep(0.01)
+        self.assertEqual(server_connection.peer_load, 0)
+
+    async def test_dead_peer(self):
+        """
+        Requests to a peer that's gone silent fail instead of hanging.
+        """
+
+        connection = await self.connect_with_heartbeats(
+            heartbeat_interval=0.01, heartbeat_timeout=0.05)
+        # Stop hearing from the server, as if the network had gone away.
+        server_connection = self.server_connections[0]
+        server_connection._heartbeat_handle.cancel()
+        server_connection.transport.pause_reading()
+        # It won't notice the client going away by itself.
+        self.addAsyncCleanup(server_connection.wait_closed)
+        self.addCleanup(server_connection.close)
+        with self.assertRaises(ConnectionClosedError) as cm:
+            await connection.request("hang")
+        self.assertIn("Nothing heard", str(cm.exception))
+
+    async def test_paused_peer(self):
+        """
+        A peer isn't taken for dead while we've stopped reading from it
+        because a stream's consumer is slow.
+        """
+
+        connection = await self.connect_with_heartbeats(
+            heartbeat_interval=0.02, heartbeat_timeout=0.06,
+            stream_buffer_limit=16384)
+        call = connection.stream_request("blob")
+        call.close()
+        received = 0
+        async for part in call:
+            if not received:
+                await asyncio.sleep(0.2)
+                self.assertFalse(connection.transport.is_reading())
+            received += len(part)
+        self.assertEqual(received, 200000)
+        self.assertFalse(connection.is_closing)
+
+    async def test_quiet_peer(self):
+        """
+        Peers that don't send heartbeats aren't dropped while idle.
+        """
+
+        connection = await self.connect_with_heartbeats(
+            heartbeat_interval=0.01, heartbeat_timeout=0.02)
+        self.server_connections[0]._heartbeat_handle.cancel()
+        await asyncio.sleep(0.1)
+        self.assertFalse(connection.is_closing)
+
+
+class HandshakeTest(IsolatedAsyncioTestCase):
+
+    async def test_unsupported_version(self):
+        """
+        Peers speaking a different protocol version are turned away.
+        """
+
+        async def fake_server(reader, writer):
+            writer.write(b"99")
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(fake_server, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            with self.assertRaises(ProtocolError) as ctx:
+                await connect("127.0.0.1", port)
+            self.assertEqual(ctx.exception.code, 1)
+        finally:
+            server.close()
+            await server.wait_closed()
@@ -0,0 +1,172 @@
+from unittest import TestCase
+from gotalk.exceptions import InvalidMessageTypeIDError, \
+    InvalidPayloadError
+
+from gotalk.protocol.framing import FrameDecoder
+from gotalk.protocol.version01.messages import SingleRequestMessage, \
+    SingleResultMessage, NotificationMessage, ProtocolErrorMessage, \
+    RetryResultMessage
+
+
+_PROTO_VERSION = "01"
+
+_FRAMES = [
+    b'r0001004echo00000019{"message":"Hello World"}',
+    b'R00010000000bHello World',
+    b'n00cchat message00000002hi',
+    b'f00000001',
+    b'e00010000000000000014"service restarting"',
+    b'R000200000000',
+    b's0001004echo00000002hi',
+    b'p00010000000e"Hello World"}',
+    b'S00010000000b{"message":',
+    b'E000100000003err',
+]
+
+
+class FrameDecoderTest(TestCase):
+
+    def test_whole_frames(self):
+        """
+        Several complete messages in one chunk all come out at once.
+        """
+
+        decoder = FrameDecoder(_PROTO_VERSION)
+        messages = decoder.feed(b''.join(_FRAMES))
+        self.assertEqual(len(messages), len(_FRAMES))
+        self.assertIsInstance(messages[0], SingleRequestMessage)
+        self.assertEqual(messages[0].payload, b'{"message":"Hello World"}')
+        self.assertIsInstance(messages[1], SingleResultMessage)
+        self.assertEqual(messages[1].payload, b'Hello World')
+        self.assertIsInstance(messages[2], NotificationMessage)
+        self.assertEqual(messages[2].name, 'chat message')
+        self.assertEqual(messages[2].payload, b'hi')
+        self.assertIsInstance(messages[3], ProtocolErrorMessage)
+        self.assertIsInstance(messages[4], RetryResultMessage)
+        self.assertEqual(messages[4].payload, b'"service restarting"')
+        self.assertEqual(messages[5].payload, b'')
+        self.assertEqual(len(decoder), 0)
+
+    def test_byte_at_a_time(self):
+        """
+        Feeding one byte at a time yields each message exactly when its last
+        byte arrives.
+        """
+
+        decoder = FrameDecoder(_PROTO_VERSION)
+        for frame in _FRAMES:
+            for index in range(len(frame) - 1):
+                self.assertEqual(decoder.feed(frame[index:index + 1]), [])
+            messages = decoder.feed(frame[-1:])
+            self.assertEqual(len(messages), 1)
+        self.assertEqual(len(decoder), 0)
+
+    def test_split_across_chunks(self):
+        """
+        Chunk boundaries that fall anywhere in the stream don't matter.
+        """
+
+        data = b''.join(_FRAMES)
+        for chunk_size in (2, 5, 7, 13, 64):
+            decoder = FrameDecoder(_PROTO_VERSION)
+            messages = []
+            for start in range(0, len(data), chunk_size):
+                messages.extend(decoder.feed(data[start:start + chunk_size]))
+            self.assertEqual(
+                [m.to_bytes() for m in messages], _FRAMES)
+
+    def test_partial_is_buffered(self):
+        """
+        Leftover bytes of an incomplete message are kept for later.
+        """
+
+        decoder = FrameDecoder(_PROTO_VERSION)
+        messages = decoder.feed(_FRAMES[1] + _FRAMES[0][:10])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(len(decoder), 10)
+        messages = decoder.feed(_FRAMES[0][10:])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].operation, 'echo')
+
+    def test_reused_chunk_buffer(self):
+        """
+        Callers may re-use the buffer they read into once it's been fed.
+        """
+
+        decoder = FrameDecoder(_PROTO_VERSION)
+        read_buffer = bytearray(_FRAMES[1][:8])
+        self.assertEqual(decoder.feed(read_buffer), [])
+        read_buffer[:] = b'XXXXXXXX'
+        messages = decoder.feed(_FRAMES[1][8:])
+        self.assertEqual(messages[0].payload, b'Hello World')
+
+    def test_payload_is_view(self):
+        """
+        Payloads are views into the receive buffer rather than copies.
+        """
+
+        decoder = FrameDecoder(_PROTO_VERSION)
+        message = decoder.feed(_FRAMES[1])[0]
+        self.assertIsInstance(message.payload, memoryview)
+
+    def test_invalid_type(self):
+        """
+        Garbage in the type ID position is reported.
+        """
+
+        decoder = FrameDecoder(_PROTO_VERSION)
+        self.assertRaises(InvalidMessageTypeIDError, decoder.feed, b'X0001')
+
+    def test_invalid_frame_length(self):
+        """
+        A payloadSize that isn't plain hex is reported, by lazy decoders
+        too.
+        """
+
+        for lazy in (False, True):
+            decoder = FrameDecoder(_PROTO_VERSION, lazy=lazy)
+            self.assertRaises(
+                InvalidPayloadError, decoder.feed, b'R0001-000000d')
+
+    def test_frame_sizes(self):
+        """
+        The length of every decoded message can be collected on the way.
+        """
+
+        decoder = FrameDecoder(_PROTO_VERSION)
+        data = b''.join(_FRAMES)
+        frame_sizes = []
+        messages = decoder.feed(data[:30], frame_sizes)
+        messages += decoder.feed(data[30:], frame_sizes)
+        self.assertEqual(len(messages), len(_FRAMES))
+        self.assertEqual(frame_sizes, [len(frame) for frame in _FRAMES])
+
+    def test_lazy(self):
+        """
+        Lazy decoders only read headers.
+        """
+
+        decoder = FrameDecoder(_PROTO_VERSION, lazy=True)
+        data = b''.join(_FRAMES)
+        headers = decoder.feed(data[:30]) + decoder.feed(data[30:])
+        self.assertEqual(
+            [header.type_id for header in headers],
+            [chr(frame[0]) for frame in _FRAMES])
+        self.assertEqual([bytes(header.frame) for header in headers], _FRAMES)
+        self.assertEqual(headers[0].operation, "echo")
+        self.assertEqual(headers[2].name, "chat message")
+
+    def test_lazy_split_operation(self):
+        """
+        Lazy decoders wait for the rest of an operation or notification
+        name that's split in the middle of a UTF-8 sequence.
+        """
+
+        for frame in (b'r0001006h\xc3\xa9llo00000000',
+                      b'n006h\xc3\xa9llo00000000'):
+            split = frame.index(b'\xa9')
+            decoder = FrameDecoder(_PROTO_VERSION, lazy=True)
+            self.assertEqual(decoder.feed(frame[:split]), [])
+            header = decoder.feed(frame[split:])[0]
+            self.assertEqual(
+                header.operation or header.name, u"h\u00e9llo")
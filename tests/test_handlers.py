@@ -0,0 +1,104 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest import IsolatedAsyncioTestCase
+
+from gotalk.client import connect
+from gotalk.handlers import Handlers
+from gotalk.server import start_server
+
+
+def get_pid(payload):
+    return str(os.getpid()).encode("ascii") + payload
+
+
+class OffloadTest(IsolatedAsyncioTestCase):
+
+    async def start(self, handlers):
+        server = await start_server(handlers, "127.0.0.1", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        connection = await connect(
+            "127.0.0.1", server.sockets[0].getsockname()[1])
+        self.addAsyncCleanup(connection.wait_closed)
+        self.addCleanup(connection.close)
+        return connection
+
+    async def test_thread_offload(self):
+        """
+        Offloaded handlers run off the event loop, so they don't hold up
+        other requests.
+        """
+
+        handlers = Handlers()
+        threads = []
+
+        @handlers.request("slow", offload=True)
+        def slow(payload):
+            threads.append(threading.current_thread())
+            time.sleep(0.1)
+            return payload
+
+        @handlers.request("echo")
+        def echo(payload):
+            return bytes(payload)
+
+        connection = await self.start(handlers)
+        slow_call = asyncio.ensure_future(connection.request("slow", b"zz"))
+        await asyncio.sleep(0.01)
+        self.assertEqual(await connection.request("echo", b"x"), b"x")
+        self.assertFalse(slow_call.done())
+        self.assertEqual(await slow_call, b"zz")
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    async def test_executor(self):
+        """
+        Handlers can be given an executor of their own, and errors are sent
+        back as usual.
+        """
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        handlers = Handlers()
+
+        @handlers.request("fail", executor=executor)
+        def fail(payload):
+            raise ValueError("nope")
+
+        connection = await self.start(handlers)
+        with self.assertRaisesRegex(Exception, "nope"):
+            await connection.request("fail")
+
+    async def test_process_pool(self):
+        """
+        Picklable handlers can run in other processes.
+        """
+
+        executor = ProcessPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        handlers = Handlers(executor=executor)
+        handlers.register_request("pid", get_pid, offload=True)
+        connection = await self.start(handlers)
+        result = bytes(await connection.request("pid", b"!"))
+        self.assertTrue(result.endswith(b"!"))
+        self.assertNotEqual(int(result[:-1]), os.getpid())
+
+    async def test_notification(self):
+        """
+        Notification handlers can be offloaded too.
+        """
+
+        handlers = Handlers()
+        received = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        @handlers.notification("ping", offload=True)
+        def ping(payload):
+            self.assertIsInstance(payload, bytes)
+            loop.call_soon_threadsafe(received.set)
+
+        connection = await self.start(handlers)
+        connection.notify("ping", b"x")
+        await asyncio.wait_for(received.wait(), 1)
@@ -0,0 +1,49 @@
+from unittest import IsolatedAsyncioTestCase
+
+from benchmarks import loadgen
+
+
+class LoadGeneratorTest(IsolatedAsyncioTestCase):
+
+    mix = {"request": 2, "stream": 1, "notify": 1}
+
+    async def test_open_loop(self):
+        """
+        Open loop runs start every scheduled operation.
+        """
+
+        results = await loadgen.run(
+            connections=2, rate=200, duration=0.25, warmup=0.05,
+            mix=self.mix)
+        self.assertEqual(results["mode"], "open")
+        self.assertEqual(results["errors"], 0)
+        self.assertEqual(results["completed"], 50)
+        for kind in self.mix:
+            operations = results["operations"][kind]
+            self.assertGreater(operations["completed"], 0)
+            self.assertGreater(operations["latency_ms"]["p99.9"], 0)
+
+    async def test_closed_loop(self):
+        """
+        Closed loop runs measure every kind of operation.
+        """
+
+        results = await loadgen.run(
+            connections=2, concurrency=4, duration=0.2, warmup=0.05,
+            mix=self.mix)
+        self.assertEqual(results["mode"], "closed")
+        self.assertEqual(results["errors"], 0)
+        for kind in self.mix:
+            self.assertGreater(
+                results["operations"][kind]["completed"], 0)
+        latency = results["latency_ms"]
+        self.assertLessEqual(latency["p50"], latency["p99"])
+        self.assertLessEqual(latency["p99"], latency["max"])
+
+    def test_unknown_kind(self):
+        """
+        Misspelt operation kinds are caught up front.
+        """
+
+        self.assertRaises(
+            ValueError, loadgen.LoadGenerator, [], {"requests": 1})
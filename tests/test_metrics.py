@@ -0,0 +1,186 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from gotalk.client import connect
+from gotalk.connection import Connection
+from gotalk.exceptions import RemoteError, RequestTimeoutError
+from gotalk.handlers import Handlers
+from gotalk.metrics import LatencyHistogram, Metrics, OUTCOME_ERROR, \
+    OUTCOME_OK, OUTCOME_TIMEOUT
+from gotalk.server import start_server
+
+
+class LatencyHistogramTest(TestCase):
+
+    def test_percentiles(self):
+        """
+        Percentiles are within the histogram's precision of the true ones.
+        """
+
+        histogram = LatencyHistogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.5, delta=0.005)
+        self.assertAlmostEqual(histogram.percentile(99), 0.99, delta=0.01)
+        self.assertEqual(histogram.percentile(100), 1.0)
+        self.assertAlmostEqual(histogram.mean, 0.5005)
+
+    def test_expected_interval(self):
+        """
+        A stall also records the samples it held up.
+        """
+
+        histogram = LatencyHistogram()
+        histogram.record(0.1, expected_interval=0.01)
+        self.assertEqual(histogram.count, 10)
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.001)
+        self.assertEqual(histogram.max, 0.1)
+
+    def test_merge(self):
+        """
+        Merged histograms hold both sets of samples.
+        """
+
+        first = LatencyHistogram()
+        second = LatencyHistogram()
+        first.record(0.001)
+        second.record(0.002)
+        first.merge(second)
+        self.assertEqual(first.count, 2)
+        self.assertEqual(first.max, 0.002)
+
+    def test_empty(self):
+        """
+        An empty histogram summarizes to zeroes.
+        """
+
+        summary = LatencyHistogram().summary()
+        self.assertEqual(summary["count"], 0)
+        self.assertEqual(summary["p99.9"], 0.0)
+
+
+class MetricsTest(TestCase):
+
+    def test_operations(self):
+        """
+        Requests are counted by operation and outcome, and the gauge tracks
+        the ones still going.
+        """
+
+        metrics = Metrics()
+        metrics.request_started("echo")
+        metrics.request_started("echo")
+        metrics.request_finished("echo", OUTCOME_OK, 0.002)
+        stats = metrics.requests["echo"]
+        self.assertEqual(stats.in_flight, 1)
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(stats.outcomes, {OUTCOME_OK: 1})
+        self.assertEqual(stats.latency.max, 0.002)
+        self.assertEqual(metrics.handlers, {})
+
+    def test_frames(self):
+        """
+        Frames and bytes are counted by message type.
+        """
+
+        metrics = Metrics()
+        metrics.frame_sent("r", 20)
+        metrics.frame_sent("r", 30)
+        metrics.frame_received("R", 15)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["frames_sent"], {"r": 2})
+        self.assertEqual(snapshot["bytes_sent"], {"r": 50})
+        self.assertEqual(snapshot["frames_received"], {"R": 1})
+        self.assertEqual(snapshot["bytes_received"], {"R": 15})
+
+
+class ConnectionMetricsTest(IsolatedAsyncioTestCase):
+    """
+    Runs a server and a client that report to their own metrics.
+    """
+
+    async def asyncSetUp(self):
+        handlers = Handlers()
+
+        @handlers.request("echo")
+        def echo(payload):
+            return payload
+
+        @handlers.request("fail")
+        def fail(payload):
+            raise ValueError("nope")
+
+        @handlers.request("hang")
+        async def hang(payload):
+            await asyncio.Event().wait()
+
+        @handlers.stream("count")
+        def count(stream):
+            return [b"1", b"2", b"3"]
+
+        self.server_metrics = Metrics()
+        self.server = await start_server(
+            handlers, "127.0.0.1", 0,
+            connection_class=lambda handlers: Connection(
+                handlers, metrics=self.server_metrics))
+        port = self.server.sockets[0].getsockname()[1]
+        self.metrics = Metrics()
+        self.connection = await connect(
+            "127.0.0.1", port,
+            connection_class=lambda handlers: Connection(
+                handlers, metrics=self.metrics))
+
+    async def asyncTearDown(self):
+        self.connection.close()
+        await self.connection.wait_closed()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_requests(self):
+        """
+        Both ends count requests and their outcomes.
+        """
+
+        await self.connection.request("echo", b"hi")
+        with self.assertRaises(RemoteError):
+            await self.connection.request("fail")
+        with self.assertRaises(RequestTimeoutError):
+            await self.connection.request("hang", timeout=0.01)
+
+        requests = self.metrics.requests
+        self.assertEqual(requests["echo"].outcomes, {OUTCOME_OK: 1})
+        self.assertEqual(requests["fail"].outcomes, {OUTCOME_ERROR: 1})
+        self.assertEqual(requests["hang"].outcomes, {OUTCOME_TIMEOUT: 1})
+        self.assertEqual(requests["echo"].in_flight, 0)
+        self.assertEqual(requests["echo"].latency.count, 1)
+
+        handlers = self.server_metrics.handlers
+        self.assertEqual(handlers["echo"].outcomes, {OUTCOME_OK: 1})
+        self.assertEqual(handlers["fail"].outcomes, {OUTCOME_ERROR: 1})
+        # The peer carries on with requests we've given up on.
+        self.assertEqual(handlers["hang"].in_flight, 1)
+
+    async def test_frames(self):
+        """
+        Every message is counted on both ends, with its full length.
+        """
+
+        await self.connection.request("echo", b"hi")
+        call = self.connection.stream_request("count")
+        call.close()
+        self.assertEqual([bytes(part) async for part in call],
+                         [b"1", b"2", b"3"])
+
+        self.assertEqual(self.metrics.frames_sent, {"r": 1, "s": 1, "p": 1})
+        self.assertEqual(self.metrics.bytes_sent["r"],
+                         len(b"r0001004echo00000002hi"))
+        self.assertEqual(self.metrics.frames_received, {"R": 1, "S": 4})
+        self.assertEqual(self.server_metrics.frames_received,
+                         self.metrics.frames_sent)
+        self.assertEqual(self.server_metrics.bytes_received,
+                         self.metrics.bytes_sent)
+        self.assertEqual(self.server_metrics.bytes_sent,
+                         self.metrics.bytes_received)
+        self.assertEqual(
+            self.server_metrics.handlers["count"].outcomes, {OUTCOME_OK: 1})
@@ -0,0 +1,159 @@
+import io
+import mmap
+import tempfile
+from unittest import TestCase
+
+from gotalk.payloads import FilePayload, iter_chunks
+
+
+class IterChunksTest(TestCase):
+
+    def test_bytes(self):
+        """
+        In-memory buffers are split into memoryview slices.
+        """
+
+        chunks = list(iter_chunks(b"abcdefg", chunk_size=3))
+        self.assertTrue(all(isinstance(c, memoryview) for c in chunks))
+        self.assertEqual([bytes(c) for c in chunks], [b"abc", b"def", b"g"])
+        self.assertEqual(list(iter_chunks(b"", chunk_size=3)), [])
+
+    def test_mmap(self):
+        """
+        Memory-mapped files are sliced, and can be closed afterwards.
+        """
+
+        with tempfile.TemporaryFile() as f:
+            f.write(b"0123456789")
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            chunks = [bytes(c) for c in iter_chunks(mapped, chunk_size=4)]
+            mapped.close()
+        self.assertEqual(chunks, [b"0123", b"4567", b"89"])
+
+    def test_file(self):
+        """
+        File objects are read a chunk at a time.
+        """
+
+        reads = []
+
+        class RecordingFile(io.BytesIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super(RecordingFile, self).read(size)
+
+        chunks = list(iter_chunks(RecordingFile(b"abcde"), chunk_size=2))
+        self.assertEqual(chunks, [b"ab", b"cd", b"e"])
+        self.assertEqual(reads, [2, 2, 2, 2])
+
+    def test_iterable(self):
+        """
+        Oversized pieces are split, and empty ones dropped.
+        """
+
+        def generate():
+            yield b"ab"
+            yield b""
+            yield b"cdefg"
+            yield "h"
+
+        chunks = [bytes(c) for c in iter_chunks(generate(), chunk_size=3)]
+        self.assertEqual(chunks, [b"ab", b"cde", b"fg", b"h"])
+
+    def test_lazy(self):
+        """
+        Nothing is read from the source until chunks are asked for.
+        """
+
+        def generate():
+            raise AssertionError("Read too early.")
+            yield b""
+
+        iter_chunks(generate())
+        iter_chunks(io.BytesIO(b"abc"))
+
+    def test_invalid_chunk_size(self):
+        """
+        Chunks must hold at least one byte.
+        """
+
+        self.assertRaises(ValueError, iter_chunks, b"abc", chunk_size=0)
+
+
+class FilePayloadTest(TestCase):
+
+    def setUp(self):
+        self.file = tempfile.TemporaryFile()
+        self.addCleanup(self.file.close)
+        self.file.write(b"0123456789")
+        self.file.flush()
+
+    def test_length_from_metadata(self):
+        """
+        The length comes from the file's size, less the offset.
+        """
+
+        self.assertEqual(len(FilePayload(self.file)), 10)
+        self.assertEqual(len(FilePayload(self.file, offset=4)), 6)
+        self.assertEqual(len(FilePayload(self.file.fileno(), 2, 3)), 3)
+
+    def test_out_of_range(self):
+        """
+        Ranges that run off the end of the file are rejected.
+        """
+
+        self.assertRaises(ValueError, FilePayload, self.file, offset=11)
+        self.assertRaises(ValueError, FilePayload, self.file, 4, 7)
+        self.assertRaises(ValueError, FilePayload, self.file, 0, -1)
+
+    def test_read(self):
+        """
+        Reading the range doesn't disturb the file position.
+        """
+
+        self.file.seek(1)
+        payload = FilePayload(self.file, 2, 5)
+        self.assertEqual(list(payload.read_chunks(chunk_size=2)),
+                         [b"23", b"45", b"6"])
+        self.assertEqual(bytes(payload), b"23456")
+        self.assertEqual(self.file.tell(), 1)
+
+    def test_chunks(self):
+        """
+        Splitting a file payload gives ranges of the same file.
+        """
+
+        chunks = list(iter_chunks(FilePayload(self.file, 1), chunk_size=4))
+        self.assertTrue(all(isinstance(c, FilePayload) for c in chunks))
+        self.assertEqual([bytes(c) for c in chunks],
+                         [b"1234", b"5678", b"9"])
+
+    def test_empty_chunks(self):
+        """
+        An empty payload has no parts to close its file, so it's closed
+        once the parts run out.
+        """
+
+        with tempfile.NamedTemporaryFile() as named:
+            payload = FilePayload.open(named.name)
+            self.assertEqual(list(iter_chunks(payload)), [])
+            self.assertTrue(payload.file.closed)
+
+    def test_open(self):
+        """
+        Payloads opened from a path close their file when done, and so does
+        the last of their slices.
+        """
+
+        with tempfile.NamedTemporaryFile() as named:
+            named.write(b"abcdef")
+            named.flush()
+            payload = FilePayload.open(named.name)
+            first, last = iter_chunks(payload, chunk_size=3)
+            first.close()
+            self.assertFalse(payload.file.closed)
+            last.close()
+            self.assertTrue(payload.file.closed)
+            FilePayload(self.file).close()
+            self.assertFalse(self.file.closed)
@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+from gotalk.protocol.framing import FrameDecoder
+from gotalk.protocol.messages import read_message, read_messages
+from gotalk.protocol.pool import MessagePool
+from gotalk.protocol.version01.messages import SingleRequestMessage, \
+    StreamRequestPartMessage
+
+
+_PROTO_VERSION = "01"
+
+
+class MessagePoolTest(TestCase):
+
+    def test_recycles(self):
+        """
+        Released messages are re-used for the next message of their class.
+        """
+
+        pool = MessagePool()
+        first = read_message(
+            b'r0001004echo00000005Hello', _PROTO_VERSION, pool=pool)
+        self.assertIsInstance(first, SingleRequestMessage)
+        pool.release(first)
+        self.assertIsNone(first.payload)
+        second = read_message(
+            b'r0002004ping00000005World', _PROTO_VERSION, pool=pool)
+        self.assertIs(second, first)
+        self.assertEqual(second.request_id, b"0002")
+        self.assertEqual(second.operation, "ping")
+        self.assertEqual(second.payload, b"World")
+        self.assertEqual(len(pool), 0)
+
+    def test_per_class(self):
+        """
+        Instances are only recycled as their own class.
+        """
+
+        pool = MessagePool()
+        request = read_message(
+            b'r0001004echo00000005Hello', _PROTO_VERSION, pool=pool)
+        pool.release(request)
+        part = read_message(b'p000100000005Hello', _PROTO_VERSION, pool=pool)
+        self.assertIsInstance(part, StreamRequestPartMessage)
+        self.assertEqual(len(pool), 1)
+
+    def test_bounded(self):
+        """
+        The pool doesn't grow past its limit.
+        """
+
+        pool = MessagePool(max_size=2)
+        for i in range(5):
+            pool.release(SingleRequestMessage(i, "echo", b""))
+        self.assertEqual(len(pool), 2)
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+
+    def test_batch_and_framing(self):
+        """
+        Batch decoding and the frame decoder both draw from the pool.
+        """
+
+        m_bytes = b'p000100000001ap000100000001b'
+        pool = MessagePool()
+        messages, consumed = read_messages(m_bytes, _PROTO_VERSION, pool=pool)
+        self.assertEqual(consumed, len(m_bytes))
+        for message in messages:
+            pool.release(message)
+
+        decoder = FrameDecoder(_PROTO_VERSION, pool=pool)
+        recycled = decoder.feed(m_bytes)
+        self.assertEqual(
+            set(map(id, recycled)), set(map(id, messages)))
+        self.assertEqual(
+            [bytes(message.payload) for message in recycled], [b"a", b"b"])
@@ -0,0 +1,121 @@
+from unittest import TestCase
+from gotalk.exceptions import InvalidRequestIDError, RequestIDsExhaustedError
+
+from gotalk.protocol.messages import write_message
+from gotalk.protocol.version01.messages import SingleResultMessage
+from gotalk.request_ids import REQUEST_ID_SPACE, RequestIDAllocator, \
+    format_request_id
+
+
+class FormatRequestIDTest(TestCase):
+
+    def test_format(self):
+        """
+        Request numbers become 4 base-36 digits.
+        """
+
+        self.assertEqual(format_request_id(0), b"0000")
+        self.assertEqual(format_request_id(1), b"0001")
+        self.assertEqual(format_request_id(35), b"000z")
+        self.assertEqual(format_request_id(36), b"0010")
+        self.assertEqual(format_request_id(REQUEST_ID_SPACE - 1), b"zzzz")
+
+    def test_out_of_range(self):
+        """
+        Numbers that don't fit in 4 digits are rejected.
+        """
+
+        self.assertRaises(
+            InvalidRequestIDError, format_request_id, REQUEST_ID_SPACE)
+        self.assertRaises(InvalidRequestIDError, format_request_id, -1)
+
+    def test_message_request_ids(self):
+        """
+        Messages pad short IDs to 4 bytes and reject long ones.
+        """
+
+        message = SingleResultMessage(request_id=1, payload=b"")
+        self.assertEqual(write_message(message)[1:5], b"0001")
+        message = SingleResultMessage(request_id="1", payload=b"")
+        self.assertEqual(write_message(message)[1:5], b"0001")
+        message = SingleResultMessage(request_id=b"00001", payload=b"")
+        self.assertRaises(InvalidRequestIDError, write_message, message)
+
+
+class RequestIDAllocatorTest(TestCase):
+
+    def test_allocate(self):
+        """
+        IDs are unique and map to their values until released.
+        """
+
+        allocator = RequestIDAllocator()
+        first = allocator.allocate("first")
+        second = allocator.allocate("second")
+        self.assertEqual(first, b"0001")
+        self.assertEqual(second, b"0002")
+        self.assertEqual(len(allocator), 2)
+        self.assertIn(first, allocator)
+        self.assertEqual(allocator.get(second), "second")
+        self.assertEqual(allocator.pop(first), "first")
+        self.assertNotIn(first, allocator)
+        self.assertIsNone(allocator.pop(first))
+
+    def test_replace(self):
+        """
+        The value for an ID in flight can be swapped, but IDs can't be
+        reserved that way.
+        """
+
+        allocator = RequestIDAllocator()
+        request_id = allocator.allocate("waiting")
+        allocator[request_id] = "given up"
+        self.assertEqual(allocator.get(request_id), "given up")
+        self.assertEqual(len(allocator), 1)
+        with self.assertRaises(KeyError):
+            allocator[b"0042"] = "sneaky"
+
+    def test_wraparound(self):
+        """
+        Allocation wraps around at the end of the ID space.
+        """
+
+        allocator = RequestIDAllocator(start=REQUEST_ID_SPACE - 1)
+        self.assertEqual(allocator.allocate(), b"zzzz")
+        self.assertEqual(allocator.allocate(), b"0000")
+
+    def test_skips_in_flight(self):
+        """
+        IDs still in flight after a wraparound aren't handed out again.
+        """
+
+        allocator = RequestIDAllocator(start=0)
+        slow = allocator.allocate("slow")
+        allocator.allocate("also slow")
+        allocator._next = 0
+        self.assertEqual(allocator.allocate("new"), b"0002")
+        self.assertEqual(allocator.get(slow), "slow")
+
+    def test_exhausted(self):
+        """
+        Running out of IDs is an error rather than an endless loop.
+        """
+
+        class Full(dict):
+            def __len__(self):
+                return REQUEST_ID_SPACE
+
+        allocator = RequestIDAllocator()
+        allocator._in_flight = Full()
+        self.assertRaises(RequestIDsExhaustedError, allocator.allocate)
+
+    def test_clear(self):
+        """
+        Clearing releases everything and hands back the values.
+        """
+
+        allocator = RequestIDAllocator()
+        allocator.allocate(1)
+        allocator.allocate(2)
+        self.assertEqual(sorted(allocator.clear()), [1, 2])
+        self.assertEqual(len(allocator), 0)
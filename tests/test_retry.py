@@ -0,0 +1,112 @@
+import asyncio
+import random
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from gotalk.exceptions import RemoteError, RetryRequestedError
+from gotalk.retry import RetryBudget, Retrier
+
+
+class FlakySender(object):
+    """
+    Asks for a retry a given number of times, then succeeds.
+    """
+
+    def __init__(self, retries, wait=10):
+        self.retries = retries
+        self.wait = wait
+        self.calls = []
+
+    async def __call__(self, operation, payload):
+        self.calls.append(asyncio.get_running_loop().time())
+        if len(self.calls) <= self.retries:
+            raise RetryRequestedError(self.wait, b"busy")
+        return payload
+
+
+class RetryBudgetTest(TestCase):
+
+    def test_budget(self):
+        """
+        Retries are capped at a fraction of requests once savings run out.
+        """
+
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        for _ in range(10):
+            budget.deposit()
+        self.assertEqual(budget.tokens, 2)
+
+
+class RetrierTest(IsolatedAsyncioTestCase):
+
+    async def test_retry(self):
+        """
+        Requests are sent again after the wait the peer asked for.
+        """
+
+        send = FlakySender(retries=2, wait=10)
+        retrier = Retrier(jitter=0)
+        self.assertEqual(await retrier.call(send, "echo", b"hi"), b"hi")
+        self.assertEqual(len(send.calls), 3)
+        self.assertGreaterEqual(send.calls[1] - send.calls[0], 0.009)
+
+    async def test_max_attempts(self):
+        """
+        We give up after so many attempts, with the last retry result.
+        """
+
+        send = FlakySender(retries=10, wait=0)
+        retrier = Retrier(max_attempts=3)
+        with self.assertRaises(RetryRequestedError):
+            await retrier.call(send, "echo", b"hi")
+        self.assertEqual(len(send.calls), 3)
+
+    async def test_timeout(self):
+        """
+        Retries that wouldn't start before the timeout aren't made.
+        """
+
+        send = FlakySender(retries=10, wait=50)
+        retrier = Retrier(jitter=0)
+        with self.assertRaises(RetryRequestedError):
+            await retrier.call(send, "echo", b"hi", timeout=0.12)
+        self.assertEqual(len(send.calls), 3)
+
+    async def test_budget(self):
+        """
+        Retries stop once the budget is spent.
+        """
+
+        send = FlakySender(retries=10, wait=0)
+        retrier = Retrier(budget=RetryBudget(ratio=0, max_tokens=1))
+        with self.assertRaises(RetryRequestedError):
+            await retrier.call(send, "echo", b"hi")
+        self.assertEqual(len(send.calls), 2)
+
+    async def test_other_errors(self):
+        """
+        Only retry results are retried.
+        """
+
+        async def send():
+            raise RemoteError(b"nope")
+
+        with self.assertRaises(RemoteError):
+            await Retrier().call(send)
+
+    def test_jitter(self):
+        """
+        Waits are stretched by up to the jitter, and never shortened.
+        """
+
+        retrier = Retrier(jitter=0.5, min_wait=0.1, rng=random.Random(0))
+        delays = [retrier.get_delay(1000) for _ in range(100)]
+        self.assertTrue(all(1.0 <= delay <= 1.5 for delay in delays))
+        self.assertGreater(max(delays) - min(delays), 0.1)
+        self.assertGreaterEqual(retrier.get_delay(0), 0.1)
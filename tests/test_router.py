@@ -0,0 +1,303 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from gotalk.client import connect
+from gotalk.exceptions import RemoteError, RequestIDsExhaustedError, \
+    RetryRequestedError
+from gotalk.handlers import Handlers
+from gotalk.protocol.messages import read_headers
+from gotalk.protocol.version01.messages import RetryResultMessage, \
+    SingleRequestMessage
+from gotalk.router import Router
+from gotalk.server import start_server
+
+
+def _make_handlers(label, notifications):
+    handlers = Handlers()
+
+    @handlers.request("whoami")
+    def whoami(payload):
+        return label
+
+    @handlers.request("echo")
+    async def echo(payload):
+        # Answer out of order.
+        await asyncio.sleep(0.01 * (len(payload) % 3))
+        return payload
+
+    @handlers.request("fail")
+    def fail(payload):
+        raise ValueError("nope")
+
+    @handlers.request(u"caf\u00e9")
+    def cafe(payload):
+        return label
+
+    @handlers.stream("upper")
+    async def upper(stream):
+        async for part in stream:
+            yield bytes(part).upper()
+
+    @handlers.notification("ping")
+    def ping(payload):
+        notifications.append((label, bytes(payload)))
+
+    return handlers
+
+
+class RouterTest(IsolatedAsyncioTestCase):
+    """
+    Runs two backends, "a" and "b", behind a router.
+    """
+
+    async def asyncSetUp(self):
+        self.notifications = []
+        self.backends = {}
+        addresses = {}
+        for label in ("a", "b"):
+            server = await start_server(
+                _make_handlers(label, self.notifications), "127.0.0.1", 0)
+            self.backends[label] = server
+            addresses[label] = server.sockets[0].getsockname()[:2]
+        self.router = Router(
+            {"whoami": addresses["b"], "ping": addresses["b"]},
+            default=addresses["a"])
+        server = await self.router.start("127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.router.close()
+        await self.router.wait_closed()
+        for server in self.backends.values():
+            server.close()
+            await server.wait_closed()
+
+    async def connect(self):
+        connection = await connect("127.0.0.1", self.port)
+        self.addAsyncCleanup(connection.wait_closed)
+        self.addCleanup(connection.close)
+        return connection
+
+    async def test_routes(self):
+        """
+        Requests go to the backend for their operation, or the default.
+        """
+
+        connection = await self.connect()
+        self.assertEqual(await connection.request("whoami"), b"b")
+        self.assertEqual(await connection.request("echo", b"hi"), b"hi")
+
+    async def test_request_ids(self):
+        """
+        Results from many clients come back to the right requests, in
+        whatever order the backend answers them.
+        """
+
+        connections = [await self.connect() for _ in range(3)]
+        payloads = [str(i).encode("ascii") * (i + 1) for i in range(30)]
+        results = await asyncio.gather(*[
+            connections[i % 3].request("echo", payload)
+            for i, payload in enumerate(payloads)])
+        self.assertEqual([bytes(result) for result in results], payloads)
+        self.assertEqual(self.router.get_load(), 0)
+
+    async def test_stream(self):
+        """
+        Stream request parts and results are forwarded both ways.
+        """
+
+        connection = await self.connect()
+        call = connection.stream_request("upper", b"hello ")
+        call.send(b"world")
+        call.close()
+        parts = [bytes(part) async for part in call]
+        self.assertEqual(b"".join(parts), b"HELLO WORLD")
+
+    async def test_large_payload(self):
+        """
+        Payloads far bigger than a socket read go through intact.
+        """
+
+        connection = await self.connect()
+        payload = bytes(range(256)) * 8192
+        self.assertEqual(
+            bytes(await connection.request("echo", payload)), payload)
+
+    async def test_errors(self):
+        """
+        Error results are forwarded, and unknown operations are answered by
+        the router itself.
+        """
+
+        connection = await self.connect()
+        with self.assertRaises(RemoteError):
+            await connection.request("fail")
+        self.router.default = None
+        with self.assertRaises(RemoteError) as cm:
+            await connection.request("echo")
+        self.assertIn("Unknown operation", str(cm.exception))
+
+    async def test_split_operation(self):
+        """
+        An operation name split in the middle of a UTF-8 sequence by the
+        network is put back together.
+        """
+
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", self.port)
+        try:
+            writer.write(b"01r0001005caf\xc3")
+            await writer.drain()
+            await asyncio.sleep(0.01)
+            writer.write(b"\xa900000000")
+            reply = await reader.readexactly(16)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        self.assertEqual(reply, b"01R000100000001a")
+
+    async def test_request_ids_exhausted(self):
+        """
+        Requests for a backend that has no request IDs left are answered
+        with an error.
+        """
+
+        connection = await self.connect()
+        await connection.request("echo")
+        backend = next(iter(self.router._backends.values()))
+
+        def allocate(value=None):
+            raise RequestIDsExhaustedError("All request IDs are in flight.")
+
+        backend.requests.allocate = allocate
+        with self.assertRaises(RemoteError) as cm:
+            await connection.request("echo")
+        self.assertIn("request IDs", str(cm.exception))
+
+    async def test_slow_client(self):
+        """
+        Results for a client that isn't reading them hold up the backend
+        they come from, rather than piling up in the router, and the backend
+        isn't taken for dead meanwhile.
+        """
+
+        self.router.heartbeat_interval = 0.02
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", self.port)
+        try:
+            payload = b"#" * 262144
+            writer.write(b"01" + b"".join(
+                SingleRequestMessage(
+                    "{:04d}".format(i).encode("ascii"), "echo",
+                    payload).to_bytes()
+                for i in range(20)))
+            backend = None
+            for _ in range(200):
+                await asyncio.sleep(0.01)
+                backend = backend or next(
+                    iter(self.router._backends.values()), None)
+                if backend is not None and backend.transport is not None \
+                        and not backend.transport.is_reading():
+                    break
+            else:
+                self.fail("The backend was never paused.")
+            await asyncio.sleep(0.2)
+
+            data = await reader.readexactly(2)
+            results = []
+            while len(results) < 20:
+                data += await reader.read(262144)
+                headers, _ = read_headers(data[2:], "01")
+                # Skipping the router's heartbeats.
+                results = [header for header in headers
+                           if header.request_id is not None]
+            self.assertTrue(backend.transport.is_reading())
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        self.assertEqual(
+            sorted(header.request_id for header in results),
+            ["{:04d}".format(i).encode("ascii") for i in range(20)])
+
+    async def test_notification(self):
+        """
+        Notifications are forwarded by name.
+        """
+
+        connection = await self.connect()
+        connection.notify("ping", b"hi")
+        # Messages are handled in order, so a request after the
+        # notification is answered after it has arrived.
+        await connection.request("whoami")
+        self.assertEqual(self.notifications, [("b", b"hi")])
+
+    async def test_client_gone(self):
+        """
+        Results for clients that have gone away are dropped once they
+        arrive, and don't reach anyone else.
+        """
+
+        gone = await connect("127.0.0.1", self.port)
+        request = asyncio.ensure_future(gone.request("echo", b"xx"))
+        await asyncio.sleep(0.005)
+        gone.close()
+        await gone.wait_closed()
+        request.cancel()
+        connection = await self.connect()
+        self.assertEqual(await connection.request("echo", b"yyy"), b"yyy")
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.router.get_load(), 0)
+
+    async def test_backend_down(self):
+        """
+        Requests for a backend that can't be reached fail with an error, and
+        the router tries again for the next request.
+        """
+
+        server = self.backends["a"]
+        address = server.sockets[0].getsockname()[:2]
+        server.close()
+        await server.wait_closed()
+        connection = await self.connect()
+        with self.assertRaises(RemoteError) as cm:
+            await connection.request("echo", b"hi")
+        self.assertIn("went away", str(cm.exception))
+
+        self.backends["a"] = await start_server(
+            _make_handlers("a", self.notifications), *address)
+        self.assertEqual(await connection.request("echo", b"hi"), b"hi")
+
+    async def test_retry_result(self):
+        """
+        Retry results are forwarded with their wait.
+        """
+
+        async def retrying_backend(reader, writer):
+            # Answers every request with a retry result, straight from the
+            # wire format.
+            try:
+                writer.write(b"01")
+                data = await reader.readexactly(2)
+                while True:
+                    data += await reader.read(65536)
+                    headers, _ = read_headers(data[2:], "01")
+                    if headers:
+                        break
+                writer.write(RetryResultMessage(
+                    headers[0].request_id, 250, b"later").to_bytes())
+                await writer.drain()
+                await reader.read()
+            finally:
+                writer.close()
+                await writer.wait_closed()
+
+        server = await asyncio.start_server(
+            retrying_backend, "127.0.0.1", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        self.router.add_route("busy", *server.sockets[0].getsockname()[:2])
+        connection = await self.connect()
+        with self.assertRaises(RetryRequestedError) as cm:
+            await connection.request("busy")
+        self.assertEqual(cm.exception.wait, 250)
+        self.assertEqual(cm.exception.payload, b"later")
@@ -0,0 +1,126 @@
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from gotalk.streams import FlowControl, Stream
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.reading = True
+        self.closing = False
+
+    def is_closing(self):
+        return self.closing
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+
+class FlowControlTest(TestCase):
+
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.flow_control = FlowControl(limit=100)
+        self.flow_control.attach(self.transport)
+
+    def test_connection_limit(self):
+        """
+        Reading pauses over the limit and resumes at half of it.
+        """
+
+        self.flow_control.add(100)
+        self.assertTrue(self.transport.reading)
+        self.flow_control.add(1)
+        self.assertFalse(self.transport.reading)
+        self.flow_control.remove(40)
+        self.assertFalse(self.transport.reading)
+        self.flow_control.remove(11)
+        self.assertTrue(self.transport.reading)
+
+    def test_blocked_stream(self):
+        """
+        A stream over its own limit keeps reading paused.
+        """
+
+        self.flow_control.block()
+        self.assertFalse(self.transport.reading)
+        self.flow_control.remove(0)
+        self.assertFalse(self.transport.reading)
+        self.flow_control.unblock()
+        self.assertTrue(self.transport.reading)
+
+    def test_closing_transport(self):
+        """
+        A closing transport isn't paused or resumed.
+        """
+
+        self.transport.closing = True
+        self.flow_control.block()
+        self.assertTrue(self.transport.reading)
+        self.assertFalse(self.flow_control.paused)
+
+
+class StreamTest(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.flow_control = FlowControl(limit=1000)
+        self.flow_control.attach(self.transport)
+        self.stream = Stream(
+            b"0001", limit=10, flow_control=self.flow_control)
+
+    async def test_read(self):
+        """
+        Payloads come out in order, and iteration stops at the empty part.
+        """
+
+        self.stream.feed(b"a")
+        self.stream.feed(b"b")
+        self.stream.feed(b"")
+        self.stream.feed(b"ignored")
+        self.assertEqual([p async for p in self.stream], [b"a", b"b"])
+        self.assertTrue(self.stream.at_eof)
+
+    async def test_exception(self):
+        """
+        An aborted stream raises after the parts that arrived first.
+        """
+
+        self.stream.feed(b"a")
+        self.stream.set_exception(ValueError("nope"))
+        self.assertEqual(await self.stream.read(), b"a")
+        with self.assertRaises(ValueError):
+            await self.stream.read()
+
+    async def test_stream_limit(self):
+        """
+        Going over the stream's limit pauses reading until it's half read.
+        """
+
+        for _ in range(3):
+            self.stream.feed(b"aaaa")
+        self.assertFalse(self.transport.reading)
+        self.assertEqual(self.flow_control.buffered, 12)
+        await self.stream.read()
+        self.assertFalse(self.transport.reading)
+        await self.stream.read()
+        self.assertTrue(self.transport.reading)
+        self.assertEqual(self.stream.buffered, 4)
+        self.assertEqual(self.flow_control.buffered, 4)
+
+    async def test_close(self):
+        """
+        Closing drops what's buffered and releases its accounting.
+        """
+
+        for _ in range(3):
+            self.stream.feed(b"aaaa")
+        self.stream.close()
+        self.assertTrue(self.transport.reading)
+        self.assertEqual(self.flow_control.buffered, 0)
+        self.stream.feed(b"late")
+        self.assertEqual(self.flow_control.buffered, 0)
+        self.assertIsNone(await self.stream.read())
@@ -0,0 +1,151 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from gotalk.timers import TimerHeap, TimerWheel, get_timer_wheel
+
+
+class TimerHeapTest(IsolatedAsyncioTestCase):
+
+    async def test_order(self):
+        """
+        Timers run in order of their due time, not of scheduling.
+        """
+
+        timers = TimerHeap()
+        fired = []
+        for delay in (0.03, 0.01, 0.02, 0.01):
+            timers.call_later(delay, fired.append, delay)
+        await timers.sleep(0.04)
+        self.assertEqual(fired, [0.01, 0.01, 0.02, 0.03])
+        self.assertEqual(len(timers), 0)
+
+    async def test_single_loop_timer(self):
+        """
+        However many timers are pending, the loop only has one of ours.
+        """
+
+        timers = TimerHeap()
+        loop = asyncio.get_running_loop()
+        before = len(loop._scheduled)
+        for i in range(100):
+            timers.call_later(1 + i / 100.0, lambda: None)
+        self.assertEqual(len(loop._scheduled), before + 1)
+        timers.call_later(0.01, lambda: None)
+        await asyncio.sleep(0)
+        self.assertEqual(
+            len([h for h in loop._scheduled if not h.cancelled()]),
+            before + 1)
+
+    async def test_cancel(self):
+        """
+        Cancelled timers don't run.
+        """
+
+        timers = TimerHeap()
+        fired = []
+        timers.call_later(0.01, fired.append, 1).cancel()
+        timers.call_later(0.01, fired.append, 2)
+        await timers.sleep(0.02)
+        self.assertEqual(fired, [2])
+
+    async def test_callback_error(self):
+        """
+        A failing callback doesn't stop the others from running.
+        """
+
+        timers = TimerHeap()
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: errors.append(context["exception"]))
+        fired = []
+        timers.call_later(0, lambda: 1 / 0)
+        timers.call_later(0, fired.append, 1)
+        await timers.sleep(0.01)
+        self.assertEqual(fired, [1])
+        self.assertIsInstance(errors[0], ZeroDivisionError)
+
+
+class TimerWheelTest(IsolatedAsyncioTestCase):
+
+    async def test_fire(self):
+        """
+        Timers fire once due, and not before.
+        """
+
+        wheel = TimerWheel(resolution=0.01, slots=8)
+        loop = asyncio.get_running_loop()
+        fired = []
+        start = loop.time()
+        wheel.call_later(0.03, lambda: fired.append(loop.time() - start))
+        await asyncio.sleep(0.02)
+        self.assertEqual(fired, [])
+        await asyncio.sleep(0.03)
+        self.assertEqual(len(fired), 1)
+        self.assertGreaterEqual(fired[0], 0.03)
+        self.assertEqual(len(wheel), 0)
+
+    async def test_rounds(self):
+        """
+        Timers further out than one lap of the wheel wait for their round.
+        """
+
+        wheel = TimerWheel(resolution=0.005, slots=4)
+        fired = []
+        wheel.call_later(0.005, fired.append, "soon")
+        wheel.call_later(0.045, fired.append, "later")
+        await asyncio.sleep(0.025)
+        self.assertEqual(fired, ["soon"])
+        await asyncio.sleep(0.04)
+        self.assertEqual(fired, ["soon", "later"])
+
+    async def test_cancel(self):
+        """
+        Cancelled timers don't fire, and the wheel stops ticking once
+        they've been dropped.
+        """
+
+        wheel = TimerWheel(resolution=0.005, slots=8)
+        fired = []
+        for i in range(1000):
+            wheel.call_later(0.01, fired.append, i).cancel()
+        wheel.call_later(0.01, fired.append, "kept")
+        await asyncio.sleep(0.03)
+        self.assertEqual(fired, ["kept"])
+        self.assertEqual(len(wheel), 0)
+        self.assertIsNone(wheel._handle)
+
+    async def test_rearm(self):
+        """
+        A timer that sets itself again from its callback doesn't make the
+        wheel tick more often than it should.
+        """
+
+        wheel = TimerWheel(resolution=0.01, slots=8)
+        advance = wheel._advance
+        advances = []
+
+        def counting_advance():
+            advances.append(None)
+            advance()
+
+        wheel._advance = counting_advance
+        fired = []
+
+        def rearm():
+            fired.append(None)
+            if len(fired) < 10:
+                wheel.call_later(0.01, rearm)
+
+        wheel.call_later(0.01, rearm)
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(fired), 10)
+        # At most a tick for the re-armed timer and one to get to it.
+        self.assertLessEqual(len(advances), 2 * len(fired) + 2)
+        self.assertIsNone(wheel._handle)
+
+    async def test_shared(self):
+        """
+        Each event loop has one shared wheel.
+        """
+
+        self.assertIs(get_timer_wheel(), get_timer_wheel())
@@ -1,12 +1,17 @@
+import tempfile
 from unittest import TestCase
-from gotalk.exceptions import PayloadTooLongError, OperationTooLongError
+from gotalk.exceptions import PayloadTooLongError, OperationTooLongError, \
+    InvalidPayloadError
 
 from gotalk.protocol.messages import read_version_message, write_message, \
-    read_message
+    read_message, read_messages, write_message_buffers, write_messages, \
+    peek_header, read_headers
 from gotalk.protocol.version01.messages import ProtocolVersionMessage, \
     SingleRequestMessage, SingleResultMessage, StreamRequestMessage, \
     StreamRequestPartMessage, StreamResultMessage, ErrorResultMessage, \
-    NotificationMessage, RetryResultMessage, ProtocolErrorMessage
+    NotificationMessage, RetryResultMessage, ProtocolErrorMessage, \
+    HeartbeatMessage
+from gotalk.payloads import FilePayload
 
 
 _PROTO_VERSION = "01"
@@ -19,8 +24,8 @@ class VersionTest(TestCase):
         Test parsing of valid version message.
         """
 
-        valid = _PROTO_VERSION
-        self.assertEqual(read_version_message(valid), valid)
+        valid = b"01"
+        self.assertEqual(read_version_message(valid), _PROTO_VERSION)
 
     def test_write_version(self):
         """
@@ -29,7 +34,7 @@ class VersionTest(TestCase):
 
         message = ProtocolVersionMessage()
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, _PROTO_VERSION)
+        self.assertEqual(m_bytes, b"01")
 
 
 class CommonTest(TestCase):
@@ -42,15 +47,49 @@ class CommonTest(TestCase):
         Make sure payload length errors are triggering.
         """
 
-        self.skipTest("See if there's a way to do this without the RAM usage.")
-        valid_payload = "#" * SingleRequestMessage.payload_max_length
-        message = SingleRequestMessage(
-            request_id="0001", operation="echo", payload=valid_payload)
-        # This shouldn't raise an error.
-        write_message(message)
-        # Now make it too big.
-        message.payload += "#"
-        self.assertRaises(PayloadTooLongError, write_message, message)
+        # A sparse file gets us a 4 GB payload without the RAM usage.
+        max_length = SingleRequestMessage.payload_max_length
+        with tempfile.TemporaryFile() as f:
+            f.truncate(max_length + 1)
+            message = SingleRequestMessage(
+                request_id="0001", operation="echo",
+                payload=FilePayload(f, length=max_length))
+            # This shouldn't raise an error.
+            header = write_message_buffers(message)[0]
+            self.assertEqual(header[-8:], b"ffffffff")
+            # Now make it too big.
+            message.payload = FilePayload(f)
+            self.assertRaises(
+                PayloadTooLongError, write_message_buffers, message)
+
+    def test_file_payload(self):
+        """
+        File payloads are read in when encoding to plain buffers, and closed
+        afterwards. Empty ones are closed straight away.
+        """
+
+        with tempfile.NamedTemporaryFile() as named:
+            named.write(b"Hello World")
+            named.flush()
+            payload = FilePayload.open(named.name)
+            m_bytes = write_message(SingleResultMessage(b"0001", payload))
+            self.assertEqual(m_bytes, b'R00010000000bHello World')
+            self.assertTrue(payload.file.closed)
+
+            payload = FilePayload.open(named.name)
+            buffers = write_messages([
+                SingleResultMessage(b"0001", payload),
+                SingleResultMessage(b"0002", b"!")])
+            self.assertEqual(
+                b"".join(buffers),
+                b'R00010000000bHello WorldR000200000001!')
+            self.assertTrue(payload.file.closed)
+
+            payload = FilePayload.open(named.name, offset=11)
+            self.assertEqual(
+                write_message_buffers(SingleResultMessage(b"0001", payload)),
+                [b'R000100000000'])
+            self.assertTrue(payload.file.closed)
 
     def test_large_operation(self):
         """
@@ -66,6 +105,308 @@ class CommonTest(TestCase):
         message.operation += "#"
         self.assertRaises(OperationTooLongError, write_message, message)
 
+    def test_buffer_types(self):
+        """
+        Anything that supports the buffer protocol can be parsed, and the
+        payload comes back as a view of the original buffer.
+        """
+
+        valid = b'R00010000000bHello World'
+        for m_bytes in (valid, bytearray(valid), memoryview(valid)):
+            message = read_message(m_bytes, _PROTO_VERSION)
+            self.assertIsInstance(message.payload, memoryview)
+            self.assertIs(message.payload.obj, memoryview(m_bytes).obj)
+            self.assertEqual(message.request_id, b"0001")
+            self.assertEqual(message.payload, b"Hello World")
+
+    def test_binary_payload(self):
+        """
+        Payloads don't have to be text.
+        """
+
+        payload = bytes(range(256))
+        message = SingleResultMessage(request_id=b"0001", payload=payload)
+        m_bytes = write_message(message)
+        self.assertEqual(
+            read_message(m_bytes, _PROTO_VERSION).payload, payload)
+
+    def test_slots(self):
+        """
+        Messages don't carry a per-instance ``__dict__``.
+        """
+
+        messages = [
+            ProtocolVersionMessage(),
+            ProtocolErrorMessage(code=1),
+            SingleRequestMessage(
+                request_id=b"0001", operation="echo", payload=b""),
+            SingleResultMessage(request_id=b"0001", payload=b""),
+            StreamRequestMessage(
+                request_id=b"0001", operation="echo", payload=b""),
+            StreamRequestPartMessage(request_id=b"0001", payload=b""),
+            StreamResultMessage(request_id=b"0001", payload=b""),
+            ErrorResultMessage(request_id=b"0001", payload=b""),
+            RetryResultMessage(request_id=b"0001", wait=0, payload=b""),
+            NotificationMessage(name="test", payload=b""),
+            HeartbeatMessage(load=0),
+        ]
+        for message in messages:
+            self.assertFalse(hasattr(message, "__dict__"), message)
+
+    def test_buffers(self):
+        """
+        Scatter-gather encoding hands back the payload object untouched.
+        """
+
+        payload = bytearray(b"Hello World")
+        messages = [
+            SingleRequestMessage(
+                request_id=b"0001", operation="echo", payload=payload),
+            SingleResultMessage(request_id=b"0001", payload=payload),
+            StreamRequestMessage(
+                request_id=b"0001", operation="echo", payload=payload),
+            StreamRequestPartMessage(request_id=b"0001", payload=payload),
+            StreamResultMessage(request_id=b"0001", payload=payload),
+            ErrorResultMessage(request_id=b"0001", payload=payload),
+            RetryResultMessage(request_id=b"0001", wait=5, payload=payload),
+            NotificationMessage(name="test", payload=payload),
+        ]
+        for message in messages:
+            buffers = write_message_buffers(message)
+            self.assertEqual(len(buffers), 2)
+            self.assertIs(buffers[1], payload)
+            self.assertEqual(b"".join(buffers), write_message(message))
+
+    def test_buffers_empty_payload(self):
+        """
+        Empty payloads don't add an empty buffer.
+        """
+
+        message = SingleResultMessage(request_id=b"0001", payload=b"")
+        self.assertEqual(write_message_buffers(message), [b"R000100000000"])
+        message = ProtocolErrorMessage(code=2)
+        self.assertEqual(write_message_buffers(message), [b"f00000002"])
+
+    def test_trailing_bytes(self):
+        """
+        The payload ends where payloadSize says it does.
+        """
+
+        message = read_message(b'R000100000005HelloWorld', _PROTO_VERSION)
+        self.assertEqual(message.payload, b"Hello")
+
+    def test_truncated_payload(self):
+        """
+        A message that's shorter than its payloadSize is rejected.
+        """
+
+        self.assertRaises(
+            InvalidPayloadError, read_message, b'R00010000000bHello',
+            _PROTO_VERSION)
+
+    def test_invalid_hex(self):
+        """
+        Hex fields only take hex digits, not what else ``int()`` accepts.
+        """
+
+        for m_bytes in (b'R0001-000000dxx', b'R0001+000000d',
+                        b'R0001 000000d', b'R00010x00000d', b'R00010000_00d',
+                        b'r0001-01x00000000'):
+            self.assertRaises(
+                InvalidPayloadError, read_message, m_bytes, _PROTO_VERSION)
+
+    def test_utf8_operation(self):
+        """
+        Operation lengths are hex byte counts of the UTF-8 encoded text.
+        """
+
+        operation = u"caf\u00e9 operation"
+        message = SingleRequestMessage(
+            request_id=b"0001", operation=operation, payload=b"")
+        m_bytes = write_message(message)
+        self.assertEqual(m_bytes[5:8], b"00f")
+        self.assertEqual(
+            read_message(m_bytes, _PROTO_VERSION).operation, operation)
+
+
+class ReadMessagesTest(TestCase):
+
+    def test_many(self):
+        """
+        Every complete message in the buffer is parsed.
+        """
+
+        m_bytes = b'n004ping00000002hiR00010000000bHello Worldf00000001'
+        messages, consumed = read_messages(m_bytes, _PROTO_VERSION)
+        self.assertEqual(consumed, len(m_bytes))
+        self.assertEqual(
+            [type(message) for message in messages],
+            [NotificationMessage, SingleResultMessage, ProtocolErrorMessage])
+        self.assertEqual(messages[0].name, "ping")
+        self.assertEqual(messages[0].payload, b"hi")
+        self.assertEqual(messages[1].request_id, b"0001")
+        self.assertEqual(messages[1].payload, b"Hello World")
+        self.assertIs(messages[1].payload.obj, m_bytes)
+
+    def test_incomplete(self):
+        """
+        A trailing partial message is left for later.
+        """
+
+        complete = b'R00010000000bHello World'
+        for partial in (b'R', b'R0001000', b'R00010000000bHello'):
+            messages, consumed = read_messages(
+                complete + partial, _PROTO_VERSION)
+            self.assertEqual(len(messages), 1)
+            self.assertEqual(consumed, len(complete))
+
+    def test_empty(self):
+        """
+        Nothing in, nothing out.
+        """
+
+        self.assertEqual(read_messages(b'', _PROTO_VERSION), ([], 0))
+
+    def test_negative_length(self):
+        """
+        A payloadSize that would make the message shorter than its header
+        is rejected instead of looping forever.
+        """
+
+        for read in (read_messages, read_headers):
+            self.assertRaises(
+                InvalidPayloadError, read, b'R0001-000000dxx', _PROTO_VERSION)
+
+
+class PeekHeaderTest(TestCase):
+
+    def test_fields(self):
+        """
+        Every message type's routing fields can be read from its header.
+        """
+
+        cases = [
+            (b'r0001004echo00000002hi', "r", b"0001", "echo", None),
+            (b's0002004echo00000002hi', "s", b"0002", "echo", None),
+            (b'p000300000002hi', "p", b"0003", None, None),
+            (b'R000400000002hi', "R", b"0004", None, None),
+            (b'S000500000002hi', "S", b"0005", None, None),
+            (b'E000600000002hi', "E", b"0006", None, None),
+            (b'e00070000000000000002hi', "e", b"0007", None, None),
+            (b'n004ping00000002hi', "n", None, None, "ping"),
+        ]
+        for m_bytes, type_id, request_id, operation, name in cases:
+            header = peek_header(m_bytes, _PROTO_VERSION)
+            self.assertEqual(header.type_id, type_id)
+            self.assertEqual(header.request_id, request_id)
+            self.assertEqual(header.operation, operation)
+            self.assertEqual(header.name, name)
+            self.assertEqual(header.payload_length, 2)
+            self.assertEqual(header.frame_length, len(m_bytes))
+            self.assertEqual(header.payload, b"hi")
+            self.assertEqual(header.frame, m_bytes)
+            self.assertEqual(
+                type(header.decode()),
+                type(read_message(m_bytes, _PROTO_VERSION)))
+
+    def test_fixed_length(self):
+        """
+        Messages without payloads have fixed length headers.
+        """
+
+        for m_bytes in (b'f00000001', b'h000254d7de9a'):
+            header = peek_header(b'xx' + m_bytes, _PROTO_VERSION, offset=2)
+            self.assertEqual(header.frame_length, len(m_bytes))
+            self.assertEqual(header.payload, b"")
+            self.assertIsNone(header.request_id)
+        self.assertIsNone(peek_header(b'h0002', _PROTO_VERSION))
+
+    def test_header_only(self):
+        """
+        Only the header needs to have arrived, and the payload is left
+        alone until it's asked for.
+        """
+
+        header = peek_header(b'r0001004echoffffffff', _PROTO_VERSION)
+        self.assertEqual(header.operation, "echo")
+        self.assertEqual(header.payload_length, 0xffffffff)
+        with self.assertRaises(InvalidPayloadError):
+            header.payload
+        for partial in (b'r', b'r0001004ec', b'r0001004echo0000'):
+            self.assertIsNone(peek_header(partial, _PROTO_VERSION))
+
+    def test_nothing_yet(self):
+        """
+        An empty buffer, or an offset at its end, holds no header yet.
+        """
+
+        self.assertIsNone(peek_header(b'', _PROTO_VERSION))
+        self.assertIsNone(peek_header(memoryview(b''), _PROTO_VERSION))
+        self.assertIsNone(peek_header(b'h0002', _PROTO_VERSION, offset=5))
+
+    def test_payload_is_view(self):
+        """
+        Payloads are views into the buffer rather than copies.
+        """
+
+        m_bytes = b'R000100000002hi'
+        header = peek_header(m_bytes, _PROTO_VERSION)
+        self.assertIs(header.payload.obj, m_bytes)
+
+    def test_read_headers(self):
+        """
+        Every complete message in the buffer is peeked at.
+        """
+
+        m_bytes = b'n004ping00000002hiR00010000000bHello Worldf00000001'
+        headers, consumed = read_headers(m_bytes + b'R0001', _PROTO_VERSION)
+        self.assertEqual(consumed, len(m_bytes))
+        self.assertEqual(
+            [header.type_id for header in headers], ["n", "R", "f"])
+        self.assertEqual(headers[1].payload, b"Hello World")
+
+
+class WriteMessagesTest(TestCase):
+
+    def test_coalesced(self):
+        """
+        Small messages are packed into one buffer.
+        """
+
+        messages = [
+            SingleResultMessage(request_id=i, payload=b"ok")
+            for i in range(100)]
+        buffers = write_messages(messages)
+        self.assertEqual(len(buffers), 1)
+        self.assertEqual(
+            bytes(buffers[0]),
+            b"".join(write_message(message) for message in messages))
+
+    def test_large_payloads_by_reference(self):
+        """
+        Large payloads are passed through rather than copied.
+        """
+
+        large = b"#" * 100000
+        messages = [
+            SingleResultMessage(request_id=1, payload=b"small"),
+            SingleResultMessage(request_id=2, payload=large),
+            SingleResultMessage(request_id=3, payload=b"small"),
+        ]
+        buffers = write_messages(messages)
+        self.assertEqual(len(buffers), 3)
+        self.assertIs(buffers[1], large)
+        self.assertEqual(
+            b"".join(buffers),
+            b"".join(write_message(message) for message in messages))
+
+    def test_empty(self):
+        """
+        Nothing in, nothing out.
+        """
+
+        self.assertEqual(write_messages([]), [])
+
 
 class ProtocolErrorMessageTest(TestCase):
 
@@ -74,7 +415,7 @@ class ProtocolErrorMessageTest(TestCase):
         Tests the reading of properly formed single request messages.
         """
 
-        valid1 = 'f00000001'
+        valid1 = b'f00000001'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, ProtocolErrorMessage)
         self.assertEqual(message.code, 1)
@@ -86,7 +427,7 @@ class ProtocolErrorMessageTest(TestCase):
 
         message = ProtocolErrorMessage(code=1)
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 'f00000001')
+        self.assertEqual(m_bytes, b'f00000001')
 
 
 class SingleRequestMessageTest(TestCase):
@@ -96,12 +437,12 @@ class SingleRequestMessageTest(TestCase):
         Tests the reading of properly formed single request messages.
         """
 
-        valid1 = 'r0001004echo00000019{"message":"Hello World"}'
+        valid1 = b'r0001004echo00000019{"message":"Hello World"}'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, SingleRequestMessage)
-        self.assertEqual(message.request_id, "0001")
+        self.assertEqual(message.request_id, b"0001")
         self.assertEqual(message.operation, "echo")
-        self.assertEqual(message.payload, '{"message":"Hello World"}')
+        self.assertEqual(message.payload, b'{"message":"Hello World"}')
 
     def test_write(self):
         """
@@ -111,7 +452,7 @@ class SingleRequestMessageTest(TestCase):
         message = SingleRequestMessage(
             request_id="0001", operation="echo", payload="Hello World")
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 'r0001004echo0000000bHello World')
+        self.assertEqual(m_bytes, b'r0001004echo0000000bHello World')
 
 
 class SingleResultMessageTest(TestCase):
@@ -121,11 +462,11 @@ class SingleResultMessageTest(TestCase):
         Tests the reading of properly formed single result messages.
         """
 
-        valid1 = 'R000100000019{"message":"Hello World"}'
+        valid1 = b'R000100000019{"message":"Hello World"}'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, SingleResultMessage)
-        self.assertEqual(message.request_id, "0001")
-        self.assertEqual(message.payload, '{"message":"Hello World"}')
+        self.assertEqual(message.request_id, b"0001")
+        self.assertEqual(message.payload, b'{"message":"Hello World"}')
 
     def test_write(self):
         """
@@ -135,7 +476,7 @@ class SingleResultMessageTest(TestCase):
         message = SingleResultMessage(
             request_id="0001", payload="Hello World")
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 'R00010000000bHello World')
+        self.assertEqual(m_bytes, b'R00010000000bHello World')
 
 
 class StreamRequestMessageTest(TestCase):
@@ -145,12 +486,12 @@ class StreamRequestMessageTest(TestCase):
         Tests the reading of properly formed stream request messages.
         """
 
-        valid1 = 's0001004echo0000000b{"message":'
+        valid1 = b's0001004echo0000000b{"message":'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, StreamRequestMessage)
-        self.assertEqual(message.request_id, "0001")
+        self.assertEqual(message.request_id, b"0001")
         self.assertEqual(message.operation, "echo")
-        self.assertEqual(message.payload, '{"message":')
+        self.assertEqual(message.payload, b'{"message":')
 
     def test_write(self):
         """
@@ -160,7 +501,7 @@ class StreamRequestMessageTest(TestCase):
         message = StreamRequestMessage(
             request_id="0001", operation="echo", payload="Hello World")
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 's0001004echo0000000bHello World')
+        self.assertEqual(m_bytes, b's0001004echo0000000bHello World')
 
 
 class StreamRequestPartMessageTest(TestCase):
@@ -170,11 +511,11 @@ class StreamRequestPartMessageTest(TestCase):
         Tests the reading of properly formed stream request part messages.
         """
 
-        valid1 = 'p00010000000e"Hello World"}'
+        valid1 = b'p00010000000e"Hello World"}'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, StreamRequestPartMessage)
-        self.assertEqual(message.request_id, "0001")
-        self.assertEqual(message.payload, '"Hello World"}')
+        self.assertEqual(message.request_id, b"0001")
+        self.assertEqual(message.payload, b'"Hello World"}')
 
     def test_write(self):
         """
@@ -184,7 +525,7 @@ class StreamRequestPartMessageTest(TestCase):
         message = StreamRequestPartMessage(
             request_id="0001", payload="Hello World")
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 'p00010000000bHello World')
+        self.assertEqual(m_bytes, b'p00010000000bHello World')
 
 
 class StreamResultMessageTest(TestCase):
@@ -194,11 +535,11 @@ class StreamResultMessageTest(TestCase):
         Tests the reading of properly formed stream result messages.
         """
 
-        valid1 = 'S00010000000b{"message":'
+        valid1 = b'S00010000000b{"message":'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, StreamResultMessage)
-        self.assertEqual(message.request_id, "0001")
-        self.assertEqual(message.payload, '{"message":')
+        self.assertEqual(message.request_id, b"0001")
+        self.assertEqual(message.payload, b'{"message":')
 
     def test_write(self):
         """
@@ -208,7 +549,7 @@ class StreamResultMessageTest(TestCase):
         message = StreamResultMessage(
             request_id="0001", payload="Hello World")
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 'S00010000000bHello World')
+        self.assertEqual(m_bytes, b'S00010000000bHello World')
 
 
 class ErrorResultMessageTest(TestCase):
@@ -218,11 +559,11 @@ class ErrorResultMessageTest(TestCase):
         Tests the reading of properly formed error result messages.
         """
 
-        valid1 = 'E000100000026{"error":"Unknown operation \"echo\""}'
+        valid1 = rb'E000100000026{"error":"Unknown operation \"echo\""}'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, ErrorResultMessage)
-        self.assertEqual(message.request_id, "0001")
-        self.assertEqual(message.payload, '{"error":"Unknown operation \"echo\""}')
+        self.assertEqual(message.request_id, b"0001")
+        self.assertEqual(message.payload, rb'{"error":"Unknown operation \"echo\""}')
 
     def test_write(self):
         """
@@ -232,7 +573,7 @@ class ErrorResultMessageTest(TestCase):
         message = ErrorResultMessage(
             request_id="0001", payload="Hello World")
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 'E00010000000bHello World')
+        self.assertEqual(m_bytes, b'E00010000000bHello World')
 
 
 class RetryResultMessageTest(TestCase):
@@ -242,11 +583,11 @@ class RetryResultMessageTest(TestCase):
         Tests the reading of properly formed retry result messages.
         """
 
-        valid1 = 'e00010000000000000014"service restarting"'
+        valid1 = b'e00010000000000000014"service restarting"'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, RetryResultMessage)
-        self.assertEqual(message.request_id, "0001")
-        self.assertEqual(message.payload, '"service restarting"')
+        self.assertEqual(message.request_id, b"0001")
+        self.assertEqual(message.payload, b'"service restarting"')
 
     def test_write(self):
         """
@@ -256,7 +597,7 @@ class RetryResultMessageTest(TestCase):
         message = RetryResultMessage(
             request_id="0001", wait=0, payload='"service restarting"')
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 'e00010000000000000014"service restarting"')
+        self.assertEqual(m_bytes, b'e00010000000000000014"service restarting"')
 
 
 class NotificationMessageTest(TestCase):
@@ -266,11 +607,11 @@ class NotificationMessageTest(TestCase):
         Tests the reading of properly formed notification messages.
         """
 
-        valid1 = 'n00cchat message00000032{"message":"Hi","from":"nthn","chat_room":"gonuts"}'
+        valid1 = b'n00cchat message00000033{"message":"Hi","from":"nthn","chat_room":"gonuts"}'
         message = read_message(valid1, _PROTO_VERSION)
         self.assertIsInstance(message, NotificationMessage)
         self.assertEqual(message.name, "chat message")
-        self.assertEqual(message.payload, '{"message":"Hi","from":"nthn","chat_room":"gonuts"}')
+        self.assertEqual(message.payload, b'{"message":"Hi","from":"nthn","chat_room":"gonuts"}')
 
     def test_write(self):
         """
@@ -279,4 +620,40 @@ class NotificationMessageTest(TestCase):
 
         message = NotificationMessage(name="test_name", payload="Hello World")
         m_bytes = write_message(message)
-        self.assertEqual(m_bytes, 'n009test_name0000000bHello World')
+        self.assertEqual(m_bytes, b'n009test_name0000000bHello World')
+
+
+class HeartbeatMessageTest(TestCase):
+
+    def test_valid_read(self):
+        """
+        Tests the reading of properly formed heartbeat messages.
+        """
+
+        message = read_message(b'h000254d7de9a', _PROTO_VERSION)
+        self.assertIsInstance(message, HeartbeatMessage)
+        self.assertEqual(message.load, 2)
+        self.assertEqual(message.time, 1423433370)
+
+    def test_write(self):
+        """
+        Makes sure our heartbeat serialization is good, and that out of
+        range loads are clamped.
+        """
+
+        message = HeartbeatMessage(load=2, time=1423433370)
+        self.assertEqual(write_message(message), b'h000254d7de9a')
+        message = HeartbeatMessage(load=100000, time=0)
+        self.assertEqual(write_message(message), b'hffff00000000')
+
+    def test_framing(self):
+        """
+        Heartbeats are framed by their fixed length.
+        """
+
+        m_bytes = b'h000254d7de9a' + b'f00000001'
+        messages, consumed = read_messages(m_bytes, _PROTO_VERSION)
+        self.assertEqual(
+            [type(message) for message in messages],
+            [HeartbeatMessage, ProtocolErrorMessage])
+        self.assertEqual(consumed, len(m_bytes))
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import unittest
+from unittest import IsolatedAsyncioTestCase
+
+from gotalk.client import connect
+
+SCRIPT = """
+import os
+from gotalk.handlers import Handlers
+from gotalk.workers import WorkerPool
+
+handlers = Handlers()
+
+@handlers.request("pid")
+def pid(payload):
+    return str(os.getpid())
+
+pool = WorkerPool(handlers, "127.0.0.1", 0, workers=2)
+pool.start()
+print(pool.port, flush=True)
+pool.run()
+"""
+
+
+@unittest.skipUnless(
+    hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT"),
+    "Needs os.fork() and SO_REUSEPORT.")
+class WorkerPoolTest(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", SCRIPT], stdout=subprocess.PIPE,
+            cwd=root)
+        self.addCleanup(self.process.stdout.close)
+        self.addCleanup(self.process.wait)
+        self.addCleanup(self.process.kill)
+        self.port = int(self.process.stdout.readline())
+
+    async def get_pid(self):
+        for _ in range(100):
+            try:
+                connection = await connect("127.0.0.1", self.port)
+            except OSError:
+                # The workers may not be listening yet.
+                await asyncio.sleep(0.02)
+                continue
+            try:
+                return int(await connection.request("pid"))
+            finally:
+                connection.close()
+                await connection.wait_closed()
+        self.fail("No worker answered.")
+
+    async def get_pids(self, count, exclude=()):
+        pids = set()
+        for _ in range(200):
+            pid = await self.get_pid()
+            if pid not in exclude:
+                pids.add(pid)
+            if len(pids) == count:
+                return pids
+        self.fail("Only heard from {pids}.".format(pids=pids))
+
+    async def test_workers(self):
+        """
+        Connections are spread over the workers, which are replaced on
+        SIGHUP and all stop on SIGTERM.
+        """
+
+        pids = await self.get_pids(2)
+        self.assertNotIn(self.process.pid, pids)
+        # Connections made while the workers are being replaced are all
+        # answered, by one or the other.
+        connecting = [asyncio.ensure_future(self.get_pid())
+                      for _ in range(50)]
+        self.process.send_signal(signal.SIGHUP)
+        await asyncio.gather(*connecting)
+        new_pids = await self.get_pids(2, exclude=pids)
+        self.assertFalse(pids & new_pids)
+        self.process.send_signal(signal.SIGTERM)
+        returncode = await asyncio.get_running_loop().run_in_executor(
+            None, self.process.wait, 10)
+        self.assertEqual(returncode, 0)